@@ -46,6 +46,22 @@ async def test_set_get_delete_object(datastore):  # noqa
     assert len(objects) == 0
 
 
+@pytest.mark.asyncio
+async def test_add_objects(datastore):  # noqa
+    """
+    Many objects can be added at once, with unique ids, and retrieved.
+    """
+    object_ids = await datastore.add_objects(
+        *[{"name": f"thing {i}"} for i in range(5)]
+    )
+    assert len(set(object_ids)) == 5
+    objects = await datastore.get_objects(object_ids)
+    for i, object_id in enumerate(object_ids):
+        assert objects[object_id]["name"] == f"thing {i}"
+    object_id = await datastore.add_object(name="another")
+    assert object_id not in object_ids
+
+
 @pytest.mark.asyncio
 async def test_update_delete_object(datastore):  # noqa
     """
@@ -84,6 +100,11 @@ async def test_update_delete_object(datastore):  # noqa
     # Getting an unknown attribute results in a KeyError.
     with pytest.raises(KeyError):
         await datastore.get_attribute(object_id, "foo")
+    # Many attributes may be fetched at once.
+    values = await datastore.get_attributes(
+        [(object_id, "name"), (object_id, "size"), (object_id, "foo")]
+    )
+    assert values == {(object_id, "name"): "test", (object_id, "size"): 3.141}
     # Delete the attribute.
     assert 1 == await datastore.delete_attributes(
         object_id,
@@ -209,6 +230,9 @@ async def test_set_get_last_seen(datastore):  # noqa
     # None existent user objects result in None.
     last_seen = await datastore.get_last_seen(-1)
     assert last_seen is None
+    # The user is also recently seen.
+    recently_seen = await datastore.get_recently_seen(0)
+    assert object_id in recently_seen
 
 
 @pytest.mark.asyncio
@@ -222,10 +246,10 @@ async def test_set_get_location(datastore):  # noqa
     user_id = await datastore.add_object(name="user")
     item_id = await datastore.add_object(name="item")
 
-    # The item is carried by the user.
-    await datastore.set_container(item_id, user_id)
+    # The item is carried by the user. It wasn't contained anywhere before.
+    assert await datastore.set_container(item_id, user_id) is None
     # The user is in the room.
-    await datastore.set_container(user_id, room_id)
+    assert await datastore.set_container(user_id, room_id) is None
     # Check this is the case.
     room_location = await datastore.get_location(room_id)
     assert room_location is None  # The room isn't contained within anything.
@@ -247,7 +271,7 @@ async def test_set_get_location(datastore):  # noqa
     item_contents = await datastore.get_contents(item_id)
     assert item_contents == {}
     # The user drops the item into the room.
-    await datastore.set_container(item_id, room_id)
+    assert await datastore.set_container(item_id, room_id) == user_id
     # The room contains two things: the user and the item.
     room_contents = await datastore.get_contents(room_id)
     assert len(room_contents) == 2
@@ -262,7 +286,7 @@ async def test_set_get_location(datastore):  # noqa
     item_location = await datastore.get_location(item_id)
     assert item_location == room_id
     # Setting a location to < 0 means the thing is not contained by anything.
-    await datastore.set_container(item_id, -1)
+    assert await datastore.set_container(item_id, -1) == room_id
     # Now the room contains just one thing again.
     room_contents = await datastore.get_contents(room_id)
     assert len(room_contents) == 1
@@ -20,7 +20,7 @@ async def test_subscribe_unsubscribe(pool, pubsub, mocker):  # noqa
     await asyncio.sleep(0.1)
     # Get the next message for the player with object ID of 1.
     msg = await pubsub.get_message(1)
-    assert msg == "Hello player 1"
+    assert msg["body"] == "Hello player 1"
     # Publish a message for the player with object ID of 1.
     await pool.publish("1", "Hello again player 1")
     await asyncio.sleep(0.1)
@@ -3,6 +3,7 @@ Tests for the Quart application layer (web based frontend).
 
 Copyright (C) 2020 Nicholas H.Tollervey
 """
+import json
 import pytest  # type: ignore
 from unittest import mock
 from uuid import uuid4
@@ -14,8 +15,12 @@ async def _app():
     from textsmith.app import app
 
     mock_redis = mock.AsyncMock()
+    mock_redis.poolsize = 11
+    mock_redis.connections_in_use = 1
+    mock_redis.connections_connected = 11
     mock_subscriber = mock.AsyncMock()
-    mock_redis.start_subscribe.return_value = mock_subscriber
+    mock_connection = mock.AsyncMock()
+    mock_connection.start_subscribe.return_value = mock_subscriber
     mock_message = mock.MagicMock()
     mock_message.channel = "1"
     mock_message.value = "A message"
@@ -24,17 +29,41 @@ async def _app():
     mock_pubsub = mock.MagicMock()
     mock_pubsub.subscribe = mock.AsyncMock()
     mock_pubsub.unsubscribe = mock.AsyncMock()
+    mock_pubsub.stop = mock.AsyncMock()
     with mock.patch(
         "textsmith.app.asyncio_redis.Pool.create", mock_pool
-    ), mock.patch("textsmith.app.PubSub"):
+    ), mock.patch(
+        "textsmith.app.asyncio_redis.Connection.create",
+        mock.AsyncMock(return_value=mock_connection),
+    ) as mock_create, mock.patch(
+        "textsmith.app.PubSub"
+    ), mock.patch(
+        "textsmith.app.Outbox"
+    ), mock.patch(
+        "textsmith.app.LastSeen"
+    ):
         await app.startup()
+    # The PubSub subscriber has its own connection, which doesn't reconnect
+    # automatically.
+    assert mock_create.call_args[1]["auto_reconnect"] is False
+    mock_connection.start_subscribe.assert_called_once_with()
     app.testing = True
     app.logic = mock.MagicMock()
     app.pubsub = mock_pubsub
     app.parser = mock.MagicMock()
+    app.scheduler = mock.MagicMock()
+    app.scheduler.stop = mock.AsyncMock()
+    app.scheduler.submit = mock.AsyncMock()
+    app.outbox = mock.MagicMock()
+    app.outbox.stop = mock.AsyncMock()
+    app.last_seen = mock.MagicMock()
+    app.last_seen.stop = mock.AsyncMock()
+    app.limiter = mock.MagicMock()
+    app.limiter.allow = mock.AsyncMock(return_value=True)
     app.config["WTF_CSRF_ENABLED"] = False
     yield app
     await app.shutdown()
+    mock_pubsub.stop.assert_called_once_with()
 
 
 @pytest.mark.asyncio
@@ -57,6 +86,77 @@ async def test_static_pages(app):
         assert response.status_code == 200
 
 
+@pytest.mark.asyncio
+async def test_health(app):
+    """
+    The health endpoint reports the pub/sub statistics, message latency,
+    Redis pool statistics and DataStore latency, with a 200 response if the
+    pub/sub layer is connected and a 503 response otherwise.
+    """
+    client = app.test_client()
+    app.pubsub.stats = mock.MagicMock(return_value={"state": "connected"})
+    response = await client.get("/health")
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result["state"] == "connected"
+    assert "parse_to_send" in result["latency"]
+    assert result["redis"]["localhost:6379"]["poolsize"] == 11
+    assert "datastore" in result
+    app.pubsub.stats = mock.MagicMock(return_value={"state": "reconnecting"})
+    response = await client.get("/health")
+    assert response.status_code == 503
+
+
+@pytest.mark.asyncio
+async def test_metrics(app):
+    """
+    The metrics endpoint reports the application's metrics in the Prometheus
+    text format, including gauges read from the application's objects.
+    """
+    client = app.test_client()
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    result = (await response.get_data()).decode("utf-8")
+    assert "# TYPE textsmith_websockets gauge" in result
+    assert 'textsmith_redis_poolsize{node="localhost:6379"} 11.0' in result
+    assert "textsmith_pubsub_queued_messages 0.0" in result
+    assert "textsmith_datastore_seconds_count" in result
+
+
+@pytest.mark.asyncio
+async def test_metrics_workers(app):
+    """
+    When several workers serve the application, the metrics endpoint
+    reports the metrics of every worker.
+    """
+    app.exporter = mock.MagicMock()
+    app.exporter.render = mock.AsyncMock(return_value="all workers\n")
+    try:
+        response = await app.test_client().get("/metrics")
+    finally:
+        app.exporter = None
+    assert response.status_code == 200
+    assert await response.get_data() == b"all workers\n"
+
+
+@pytest.mark.asyncio
+async def test_drain(app):
+    """
+    Draining tells the users connected to this instance that the server is
+    restarting and, after the grace period, closes their connections.
+    """
+    from textsmith.app import drain
+
+    app.presence.user_ids = mock.MagicMock(return_value=[1, 2])
+    app.presence.close_all = mock.MagicMock()
+    app.logic.emit_to_user = mock.AsyncMock()
+    await drain(0)
+    assert app.logic.emit_to_user.call_count == 2
+    assert "restarting" in app.logic.emit_to_user.call_args[0][1]
+    app.presence.close_all.assert_called_once_with()
+
+
 @pytest.mark.asyncio
 async def test_client_not_logged_in(app):
     """
@@ -103,13 +203,42 @@ async def test_websocket(app):
     """
     client = app.test_client()
     app.parser.eval = mock.AsyncMock()
-    app.pubsub.get_message = mock.AsyncMock(return_value="pong")
+    app.pubsub.get_message = mock.AsyncMock(
+        return_value={"id": None, "seq": 1, "body": "pong", "t": {}}
+    )
     async with client.session_transaction() as local_session:
         local_session["user_id"] = "1"
     async with client.websocket("/ws") as test_websocket:
         await test_websocket.send("ping")
+        result = json.loads(await test_websocket.receive())
+        assert result["body"] == "pong"
+        assert "send" in result["t"]
+
+
+@pytest.mark.asyncio
+async def test_websocket_batched(app):
+    """
+    In batching mode, queued messages are sent in a single frame separated by
+    the message delimiter.
+    """
+    client = app.test_client()
+    app.config["WS_BATCH"] = True
+    app.parser.eval = mock.AsyncMock()
+    app.pubsub.get_messages = mock.AsyncMock(
+        return_value=[
+            json.dumps({"id": None, "seq": 1, "body": "ping", "t": {}}),
+            json.dumps({"id": None, "seq": 2, "body": "pong", "t": {}}),
+        ]
+    )
+    async with client.session_transaction() as local_session:
+        local_session["user_id"] = "1"
+    async with client.websocket("/ws") as test_websocket:
+        await test_websocket.send("hello")
         result = await test_websocket.receive()
-        assert result == "pong"
+        ping, pong = [json.loads(m) for m in result.split("\x1e")]
+        assert ping["body"] == "ping"
+        assert pong["body"] == "pong"
+    app.config["WS_BATCH"] = False
 
 
 @pytest.mark.asyncio
@@ -148,7 +277,6 @@ async def test_login_post_ok(app):
     """
     client = app.test_client()
     app.logic.verify_credentials = mock.AsyncMock(return_value=1)
-    app.logic.set_last_seen = mock.AsyncMock()
     data = {
         "email": "foo@bar.com",
         "password": "password123",
@@ -160,7 +288,29 @@ async def test_login_post_ok(app):
     async with client.session_transaction() as local_session:
         assert local_session["user_id"] == 1
     # User login time set.
-    app.logic.set_last_seen.assert_called_once_with(1)
+    app.last_seen.touch.assert_called_once_with(1)
+
+
+@pytest.mark.asyncio
+async def test_login_post_rate_limited(app):
+    """
+    If attempts to log in are rate limited, a 429 response is returned and the
+    credentials are not checked.
+    """
+    client = app.test_client()
+    app.limiter.allow = mock.AsyncMock(return_value=False)
+    app.logic.verify_credentials = mock.AsyncMock(return_value=1)
+    data = {
+        "email": "foo@bar.com",
+        "password": "password123",
+    }
+    response = await client.post("/login", json=data)
+    content = await response.get_data()
+    content = content.decode("utf-8")
+    assert response.status_code == 429
+    assert "Too many attempts to log in." in content
+    assert app.logic.verify_credentials.call_count == 0
+    app.limiter.allow.assert_called_once_with("login_ip", mock.ANY)
 
 
 @pytest.mark.asyncio
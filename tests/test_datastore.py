@@ -7,10 +7,12 @@ import pytest  # type: ignore
 import quart.flask_patch  # type: ignore # noqa
 import json
 import asyncio
+import contextvars
 import uuid
 import datetime
 from unittest import mock
-from textsmith.datastore import DataStore
+from asyncio_redis.exceptions import ScriptKilledError  # type: ignore
+from textsmith.datastore import DataStore, IdAllocator, SET_CONTAINER
 from textsmith import constants
 
 
@@ -27,6 +29,94 @@ def test_init(mocker):
     mock_pool = mocker.MagicMock()
     datastore = DataStore(mock_pool)
     assert datastore.redis == mock_pool
+    assert datastore.ids.redis == mock_pool
+    assert datastore.ids.block_size == 1
+    assert datastore.replicas == []
+    assert datastore.sticky == 1.0
+    datastore = DataStore(mock_pool, 100)
+    assert datastore.ids.block_size == 100
+    mock_replica = mocker.MagicMock()
+    datastore = DataStore(mock_pool, 1, [mock_replica], 2.5)
+    assert datastore.replicas == [mock_replica]
+    assert datastore.sticky == 2.5
+
+
+def test_reader(mocker):
+    """
+    Without replicas reads use the primary. With replicas, reads are shared
+    between them in turn, unless the current context wrote to the primary
+    within the sticky window.
+    """
+    mock_pool = mocker.MagicMock()
+    datastore = DataStore(mock_pool)
+    assert datastore.reader() == mock_pool
+    replicas = [mocker.MagicMock(), mocker.MagicMock()]
+    datastore = DataStore(mock_pool, 1, replicas, 1.0)
+
+    def check():
+        assert datastore.reader() == replicas[0]
+        assert datastore.reader() == replicas[1]
+        assert datastore.reader() == replicas[0]
+        with mock.patch(
+            "textsmith.datastore.time.monotonic", return_value=100.0
+        ):
+            datastore.wrote()
+        with mock.patch(
+            "textsmith.datastore.time.monotonic", return_value=100.5
+        ):
+            assert datastore.reader() == mock_pool
+        with mock.patch(
+            "textsmith.datastore.time.monotonic", return_value=101.0
+        ):
+            assert datastore.reader() == replicas[1]
+
+    # Run in a copy of the context so the write doesn't leak into others.
+    contextvars.copy_context().run(check)
+
+
+@pytest.mark.asyncio
+async def test_read_from_replica(mocker):
+    """
+    Read-only operations use a replica, and a write sends later reads in the
+    same context to the primary.
+    """
+    mock_pool = mocker.MagicMock()
+    mock_pool.hmset = mock.AsyncMock()
+    mock_pool.get = mock.AsyncMock(return_value="2")
+    mock_replica = mocker.MagicMock()
+    mock_replica.get = mock.AsyncMock(return_value="1")
+    datastore = DataStore(mock_pool, 1, [mock_replica], 60.0)
+
+    async def check():
+        assert await datastore.get_location(3) == 1
+        await datastore.set_user_active("foo@bar.com")
+        assert await datastore.get_location(3) == 2
+
+    await asyncio.create_task(check())
+    mock_replica.get.assert_called_once_with(datastore.location_key(3))
+    mock_pool.get.assert_called_once_with(datastore.location_key(3))
+
+
+@pytest.mark.asyncio
+async def test_id_allocator(mocker):
+    """
+    Ids are handed out from blocks reserved with INCRBY. A block is only
+    reserved when the current one is used up, and is big enough for the
+    number of ids requested.
+    """
+    redis = mocker.MagicMock()
+    redis.incrby = mock.AsyncMock(side_effect=[10, 30])
+    allocator = IdAllocator(redis, block_size=10)
+    assert await allocator.allocate() == [1]
+    redis.incrby.assert_called_once_with("object_counter", 10)
+    assert await allocator.allocate(8) == list(range(2, 10))
+    assert await allocator.allocate() == [10]
+    assert await allocator.allocate(0) == []
+    assert redis.incrby.call_count == 1
+    # The block is used up, and more ids are needed than the block size. Other
+    # instances have reserved ids 11 to 18 in the meantime.
+    assert await allocator.allocate(12) == list(range(19, 31))
+    redis.incrby.assert_called_with("object_counter", 12)
 
 
 def test_user_key(datastore):
@@ -54,6 +144,14 @@ def test_last_seen_key(datastore):
     "lastseen:123".
     """
     assert datastore.last_seen_key(123) == "lastseen:123"
+    assert datastore.recently_seen_key() == "lastseen"
+
+
+def test_presence_key(datastore):
+    """
+    The key of the sorted set of heartbeats is "presence".
+    """
+    assert datastore.presence_key() == "presence"
 
 
 def test_inventory_key(datastore):
@@ -88,13 +186,35 @@ async def test_add_object(datastore):
     It is possible to add a new object with arbitrary attributes to the
     datastore, and immediately retrieve it.
     """
-    datastore.redis.incr = mock.AsyncMock(return_value=123456)
+    datastore.redis.incrby = mock.AsyncMock(return_value=123456)
     datastore.annotate_object = mock.AsyncMock()
     result = await datastore.add_object(name="something")
     assert result == 123456
     datastore.annotate_object.assert_called_once_with(123456, name="something")
 
 
+@pytest.mark.asyncio
+async def test_add_objects(datastore):
+    """
+    Many objects are created in a single transaction, using ids reserved in
+    a single block. Objects without attributes aren't written. No objects
+    means no work.
+    """
+    datastore.redis.incrby = mock.AsyncMock(return_value=12)
+    mock_transaction = mock.AsyncMock()
+    datastore.redis.multi = mock.AsyncMock(return_value=mock_transaction)
+    assert await datastore.add_objects() == []
+    assert datastore.redis.incrby.call_count == 0
+    result = await datastore.add_objects({"name": "a"}, {}, {"name": "c"})
+    assert result == [10, 11, 12]
+    datastore.redis.incrby.assert_called_once_with("object_counter", 3)
+    assert mock_transaction.hmset.call_args_list == [
+        mock.call("10", {"name": json.dumps("a")}),
+        mock.call("12", {"name": json.dumps("c")}),
+    ]
+    mock_transaction.exec.assert_called_once_with()
+
+
 @pytest.mark.asyncio
 async def test_annotate_object(datastore):
     """
@@ -168,7 +288,7 @@ async def test_get_attribute_that_does_not_exist(datastore):
     If the referenced attribute on the object doesn't exist, then the method
     should raise a KeyError.
     """
-    datastore.redis.hexists = mock.AsyncMock(return_value=False)
+    datastore.redis.hget = mock.AsyncMock(return_value=None)
     with pytest.raises(KeyError):
         await datastore.get_attribute(1, "foo")
 
@@ -179,11 +299,42 @@ async def test_get_attribute(datastore):
     The attribute on the referenced object is returned as a value of the
     correct native Python type.
     """
-    datastore.redis.hexists = mock.AsyncMock(return_value=True)
     datastore.redis.hget = mock.AsyncMock(return_value=json.dumps("hello"))
     result = await datastore.get_attribute(1, "foo")
     assert result == "hello"
     datastore.redis.hget.assert_called_once_with("1", "foo")
+    # Falsy values are still values.
+    datastore.redis.hget = mock.AsyncMock(return_value=json.dumps(None))
+    assert await datastore.get_attribute(1, "foo") is None
+
+
+@pytest.mark.asyncio
+async def test_get_attributes(datastore):
+    """
+    Many attributes on many objects are fetched in a single transaction.
+    Attributes that don't exist are missing from the result.
+    """
+    values = {
+        ("1", "foo"): json.dumps("hello"),
+        ("2", "bar"): json.dumps([1, 2]),
+        ("2", "baz"): None,
+    }
+
+    async def hget(key, field):
+        result = asyncio.get_running_loop().create_future()
+        result.set_result(values[(key, field)])
+        return result
+
+    mock_transaction = mock.AsyncMock()
+    mock_transaction.hget.side_effect = hget
+    datastore.redis.multi = mock.AsyncMock(return_value=mock_transaction)
+    result = await datastore.get_attributes(
+        [(1, "foo"), (2, "bar"), (2, "baz")]
+    )
+    assert result == {(1, "foo"): "hello", (2, "bar"): [1, 2]}
+    with pytest.raises(KeyError):
+        result[(2, "baz")]
+    mock_transaction.exec.assert_called_once_with()
 
 
 @pytest.mark.asyncio
@@ -435,19 +586,44 @@ async def test_set_user_active(datastore):
 @pytest.mark.asyncio
 async def test_set_last_seen(datastore):
     """
-    Set an isoformat timestamp against the referenced user to represent when
-    they last interacted with the system.
+    Record the current time against the user with the referenced email
+    address to represent when they last interacted with the system.
     """
     email = "foo@bar.com"
     datastore.email_to_object_id = mock.AsyncMock(return_value=123)
-    datastore.redis.set = mock.AsyncMock()
-    mock_datetime = mock.MagicMock()
-    mock_datetime.now().isoformat.return_value = "a date"
-    with mock.patch("textsmith.datastore.datetime", mock_datetime):
+    datastore.set_last_seen_many = mock.AsyncMock()
+    with mock.patch("textsmith.datastore.time.time", return_value=1.0):
         await datastore.set_last_seen(email)
-    datastore.redis.set.assert_called_once_with(
-        datastore.last_seen_key(123), "a date"
+    datastore.set_last_seen_many.assert_called_once_with({123: 1.0})
+
+
+@pytest.mark.asyncio
+async def test_set_last_seen_many(datastore):
+    """
+    An isoformat timestamp is set against each referenced user, and all the
+    users are added to the sorted set of recently seen users, in a single
+    transaction. Nothing happens if there are no users.
+    """
+    mock_transaction = mock.AsyncMock()
+    datastore.redis.multi = mock.AsyncMock(return_value=mock_transaction)
+    await datastore.set_last_seen_many({})
+    assert datastore.redis.multi.call_count == 0
+    now = datetime.datetime.now().timestamp()
+    await datastore.set_last_seen_many({1: now, 2: now})
+    assert mock_transaction.set.call_args_list == [
+        mock.call(
+            datastore.last_seen_key(1),
+            datetime.datetime.fromtimestamp(now).isoformat(),
+        ),
+        mock.call(
+            datastore.last_seen_key(2),
+            datetime.datetime.fromtimestamp(now).isoformat(),
+        ),
+    ]
+    mock_transaction.zadd.assert_called_once_with(
+        "lastseen", {"1": now, "2": now}
     )
+    mock_transaction.exec.assert_called_once_with()
 
 
 @pytest.mark.asyncio
@@ -466,6 +642,73 @@ async def test_get_last_seen(datastore):
     assert result is None
 
 
+@pytest.mark.asyncio
+async def test_get_recently_seen(datastore):
+    """
+    The ids of users seen since the referenced time are returned with a
+    datetime representation of when they were last seen.
+    """
+    reply = mock.MagicMock()
+    reply.asdict = mock.AsyncMock(return_value={"1": 100.0, "2": 200.0})
+    datastore.redis.zrangebyscore = mock.AsyncMock(return_value=reply)
+    result = await datastore.get_recently_seen(50.0)
+    assert result == {
+        1: datetime.datetime.fromtimestamp(100.0),
+        2: datetime.datetime.fromtimestamp(200.0),
+    }
+    key, boundary = datastore.redis.zrangebyscore.call_args[0]
+    assert key == "lastseen"
+    assert boundary.value == 50.0
+
+
+@pytest.mark.asyncio
+async def test_set_presence(datastore):
+    """
+    The heartbeat of each referenced user is added to the sorted set of
+    heartbeats, and expired heartbeats are removed, in a single transaction.
+    Nothing happens if there's nothing to do.
+    """
+    mock_transaction = mock.AsyncMock()
+    datastore.redis.multi = mock.AsyncMock(return_value=mock_transaction)
+    await datastore.set_presence({})
+    assert datastore.redis.multi.call_count == 0
+    await datastore.set_presence({1: 100.0, 2: 100.0}, 70.0)
+    mock_transaction.zadd.assert_called_once_with(
+        "presence", {"1": 100.0, "2": 100.0}
+    )
+    key, _, boundary = mock_transaction.zremrangebyscore.call_args[0]
+    assert key == "presence"
+    assert boundary.value == 70.0
+    assert boundary.exclude_boundary is True
+    mock_transaction.exec.assert_called_once_with()
+    await datastore.set_presence({}, 80.0)
+    assert mock_transaction.zadd.call_count == 1
+    assert mock_transaction.zremrangebyscore.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_get_presence(datastore):
+    """
+    The heartbeats of the referenced users are read in a single transaction.
+    Users without a heartbeat are left out.
+    """
+    scores = {"1": 99.0, "2": None}
+
+    async def zscore(key, member):
+        assert key == "presence"
+        result = asyncio.get_running_loop().create_future()
+        result.set_result(scores[member])
+        return result
+
+    mock_transaction = mock.AsyncMock()
+    mock_transaction.zscore.side_effect = zscore
+    datastore.redis.multi = mock.AsyncMock(return_value=mock_transaction)
+    assert await datastore.get_presence([1, 2]) == {1: 99.0}
+    mock_transaction.exec.assert_called_once_with()
+    assert await datastore.get_presence([]) == {}
+    assert datastore.redis.multi.call_count == 1
+
+
 @pytest.mark.asyncio
 async def test_delete_user(datastore):
     """
@@ -484,53 +727,68 @@ async def test_delete_user(datastore):
 @pytest.mark.asyncio
 async def test_set_container(datastore):
     """
-    The referenced object is moved from its old container to the new container.
+    The referenced object is moved from its old container to the new container
+    by a script registered once and run on the Redis server. The id of the old
+    container is returned.
     """
-    datastore.redis.get = mock.AsyncMock(return_value="321")
-    mock_transaction = mock.AsyncMock()
-    mock_transaction.srem = mock.AsyncMock()
-    mock_transaction.sadd = mock.AsyncMock()
-    mock_transaction.set = mock.AsyncMock()
-    mock_transaction.exec = mock.AsyncMock()
-    datastore.redis.multi = mock.AsyncMock(return_value=mock_transaction)
+    mock_reply = mock.MagicMock()
+    mock_reply.return_value = mock.AsyncMock(return_value="321")
+    mock_script = mock.MagicMock()
+    mock_script.run = mock.AsyncMock(return_value=mock_reply)
+    datastore.redis.register_script = mock.AsyncMock(return_value=mock_script)
     object_id = 123
     container_id = 234
-    await datastore.set_container(object_id, container_id)
-    mock_transaction.srem.assert_called_once_with(
-        datastore.inventory_key(321), [json.dumps(object_id)]
-    )
-    mock_transaction.sadd.assert_called_once_with(
-        datastore.inventory_key(container_id), [json.dumps(object_id)]
+    result = await datastore.set_container(object_id, container_id)
+    assert result == 321
+    datastore.redis.register_script.assert_called_once_with(SET_CONTAINER)
+    mock_script.run.assert_called_once_with(
+        keys=[datastore.location_key(object_id)],
+        args=[json.dumps(object_id), json.dumps(container_id), "inventory:"],
     )
-    mock_transaction.set.assert_called_once_with(
-        datastore.location_key(object_id), json.dumps(container_id)
-    )
-    mock_transaction.exec.assert_called_once_with()
+    await datastore.set_container(object_id, container_id)
+    assert datastore.redis.register_script.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_set_container_reload_script(datastore):
+    """
+    If the script is no longer cached by Redis (e.g. Redis was restarted),
+    running it fails, so the script is registered again and run once more.
+    """
+    mock_reply = mock.MagicMock()
+    mock_reply.return_value = mock.AsyncMock(return_value="321")
+    stale_script = mock.MagicMock()
+    stale_script.run = mock.AsyncMock(side_effect=ScriptKilledError())
+    mock_script = mock.MagicMock()
+    mock_script.run = mock.AsyncMock(return_value=mock_reply)
+    datastore.set_container_script = stale_script
+    datastore.redis.register_script = mock.AsyncMock(return_value=mock_script)
+    result = await datastore.set_container(123, 234)
+    assert result == 321
+    datastore.redis.register_script.assert_called_once_with(SET_CONTAINER)
+    assert datastore.set_container_script == mock_script
+    assert mock_script.run.call_count == 1
 
 
 @pytest.mark.asyncio
 async def test_set_container_limbo(datastore):
     """
-    The referenced object is moved from its old container to limbo (-1).
+    The referenced object is moved from its old container to limbo (-1),
+    which the script is told about with an empty container id. If the object
+    wasn't contained anywhere, None is returned.
     """
-    datastore.redis.get = mock.AsyncMock(return_value="321")
-    mock_transaction = mock.AsyncMock()
-    mock_transaction.srem = mock.AsyncMock()
-    mock_transaction.delete = mock.AsyncMock()
-    mock_transaction.exec = mock.AsyncMock()
-    datastore.redis.multi = mock.AsyncMock(return_value=mock_transaction)
+    mock_reply = mock.MagicMock()
+    mock_reply.return_value = mock.AsyncMock(return_value=None)
+    mock_script = mock.MagicMock()
+    mock_script.run = mock.AsyncMock(return_value=mock_reply)
+    datastore.set_container_script = mock_script
     object_id = 123
-    container_id = -1
-    await datastore.set_container(object_id, container_id)
-    mock_transaction.srem.assert_called_once_with(
-        datastore.inventory_key(321), [json.dumps(object_id)]
-    )
-    mock_transaction.delete.assert_called_once_with(
-        [
-            datastore.location_key(object_id),
-        ]
+    result = await datastore.set_container(object_id, -1)
+    assert result is None
+    mock_script.run.assert_called_once_with(
+        keys=[datastore.location_key(object_id)],
+        args=[json.dumps(object_id), "", "inventory:"],
     )
-    mock_transaction.exec.assert_called_once_with()
 
 
 @pytest.mark.asyncio
@@ -644,6 +902,17 @@ async def test_get_script_context(datastore):
     ]
 
 
+@pytest.mark.asyncio
+async def test_publish(datastore):
+    """
+    Messages are published on the referenced channel, and the number of
+    subscribers that received it is returned.
+    """
+    datastore.redis.publish = mock.AsyncMock(return_value=1)
+    assert await datastore.publish("123", "hello") == 1
+    datastore.redis.publish.assert_called_once_with("123", "hello")
+
+
 @pytest.mark.asyncio
 async def test_get_location(datastore):
     """
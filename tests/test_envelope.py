@@ -0,0 +1,83 @@
+"""
+Tests for the envelopes wrapping messages sent to users.
+
+Copyright (C) 2020 Nicholas H.Tollervey
+"""
+import json
+from unittest import mock
+from textsmith import envelope
+
+
+def test_wrap_with_current_message():
+    """
+    A message emitted while handling user input is linked to the input's
+    message_id and records the parse and publish times.
+    """
+    with mock.patch("textsmith.envelope.time.time", return_value=1.0):
+        envelope.start("message-id")
+    with mock.patch("textsmith.envelope.time.time", return_value=2.0):
+        result = json.loads(envelope.wrap("<p>Hello</p>"))
+    assert result == {
+        "id": "message-id",
+        "body": "<p>Hello</p>",
+        "t": {"parse": 1.0, "publish": 2.0},
+    }
+    envelope.current_message.set(None)
+
+
+def test_wrap_without_current_message():
+    """
+    A message emitted outside the handling of user input has no message_id or
+    parse time.
+    """
+    envelope.current_message.set(None)
+    result = json.loads(envelope.wrap("<p>Hello</p>"))
+    assert result["id"] is None
+    assert list(result["t"].keys()) == ["publish"]
+
+
+def test_receive():
+    """
+    A received envelope is annotated with the sequence number and time of
+    receipt.
+    """
+    raw = json.dumps({"id": "abc", "body": "Hi", "t": {"publish": 1.0}})
+    with mock.patch("textsmith.envelope.time.time", return_value=2.0):
+        result = envelope.receive(raw, 7)
+    assert result == {
+        "id": "abc",
+        "body": "Hi",
+        "seq": 7,
+        "t": {"publish": 1.0, "receive": 2.0},
+    }
+
+
+def test_receive_not_an_envelope():
+    """
+    Anything that isn't an envelope becomes the body of a new envelope.
+    """
+    for raw in ["<p>Hello</p>", "123", '{"foo": "bar"}']:
+        result = envelope.receive(raw, 1)
+        assert result["body"] == raw
+        assert result["id"] is None
+        assert "receive" in result["t"]
+
+
+def test_send_records_latency():
+    """
+    Sending annotates the send time and records the latency of each stage in
+    the histograms.
+    """
+    before = {name: h.count for name, h in envelope.LATENCY.items()}
+    message = {
+        "id": "abc",
+        "seq": 1,
+        "body": "Hi",
+        "t": {"parse": 1.0, "publish": 1.5, "receive": 2.0},
+    }
+    with mock.patch("textsmith.envelope.time.time", return_value=3.0):
+        result = json.loads(envelope.send(message))
+    assert result["t"]["send"] == 3.0
+    for name, histogram in envelope.LATENCY.items():
+        assert histogram.count == before[name] + 1
+    assert envelope.latency()["parse_to_send"]["count"] >= 1
@@ -0,0 +1,74 @@
+"""
+Tests for buffering the times at which users were last seen.
+
+Copyright (C) 2020 Nicholas H.Tollervey
+"""
+import asyncio
+import pytest  # type: ignore
+from unittest import mock
+from textsmith.datastore import DataStore
+from textsmith.lastseen import LastSeen
+
+
+@pytest.fixture
+def last_seen(mocker):
+    return LastSeen(DataStore(mocker.MagicMock()), 10)
+
+
+def test_init(mocker):
+    """
+    Ensure the LastSeen object is initialised with the expected state.
+    """
+    datastore = DataStore(mocker.MagicMock())
+    last_seen = LastSeen(datastore, 5)
+    assert last_seen.datastore == datastore
+    assert last_seen.interval == 5
+    assert last_seen.dirty == {}
+    assert last_seen.task is None
+
+
+def test_touch(last_seen):
+    """
+    Touching a user records the current time, replacing any earlier time.
+    """
+    with mock.patch("textsmith.lastseen.time.time", return_value=1.0):
+        last_seen.touch(1)
+    with mock.patch("textsmith.lastseen.time.time", return_value=2.0):
+        last_seen.touch(1)
+        last_seen.touch(2)
+    assert last_seen.dirty == {1: 2.0, 2: 2.0}
+
+
+@pytest.mark.asyncio
+async def test_flush(last_seen):
+    """
+    All dirty entries are written in a single batch and the buffer is
+    emptied. An empty buffer isn't written.
+    """
+    last_seen.datastore.set_last_seen_many = mock.AsyncMock()
+    last_seen.dirty = {1: 2.0, 2: 3.0}
+    await last_seen.flush()
+    last_seen.datastore.set_last_seen_many.assert_called_once_with(
+        {1: 2.0, 2: 3.0}
+    )
+    assert last_seen.dirty == {}
+    await last_seen.flush()
+    assert last_seen.datastore.set_last_seen_many.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_start_stop(last_seen):
+    """
+    Starting schedules a task to flush the buffer every interval, and
+    stopping cancels it and flushes whatever remains.
+    """
+    last_seen.flush = mock.AsyncMock()
+    last_seen.interval = 0
+    last_seen.start()
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert last_seen.flush.call_count >= 1
+    flushes = last_seen.flush.call_count
+    await last_seen.stop()
+    assert last_seen.task is None
+    assert last_seen.flush.call_count == flushes + 1
@@ -3,7 +3,12 @@ Tests for log configuration.
 
 Copyright (C) 2020 Nicholas H.Tollervey
 """
+import io
+import json
 import platform
+import pytest  # type: ignore
+import structlog  # type: ignore
+from unittest import mock
 from textsmith import log
 
 
@@ -27,3 +32,168 @@ def test_host_info():
     assert event_dict["version"] == host_info.version
     assert event_dict["machine"] == host_info.machine
     assert event_dict["processor"] == host_info.processor
+
+
+def test_parse_rates():
+    """
+    Sample rates are parsed from comma separated "event:rate" pairs. Event
+    names may contain punctuation and spaces.
+    """
+    assert log.parse_rates("") == {}
+    assert log.parse_rates("Message.:0.01, Incoming message.:0.5") == {
+        "Message.": 0.01,
+        "Incoming message.": 0.5,
+    }
+
+
+def test_sampler():
+    """
+    Only the sampled fraction of the referenced events are kept, and those
+    dropped are counted. Other events are always kept.
+    """
+    sampler = log.Sampler({"Noisy.": 0.25})
+    dropped = sampler.dropped.value
+    assert sampler(None, None, {"event": "Other."}) == {"event": "Other."}
+    with mock.patch("textsmith.log.random.random", return_value=0.1):
+        assert sampler(None, None, {"event": "Noisy."})
+    with mock.patch("textsmith.log.random.random", return_value=0.5):
+        with pytest.raises(structlog.DropEvent):
+            sampler(None, None, {"event": "Noisy."})
+    assert sampler.dropped.value == dropped + 1
+
+
+def test_serializer():
+    """
+    Entries are serialized to the same JSON with either library. Values that
+    can't be serialized use the default function.
+    """
+    value = {"event": "Hello.", "when": object()}
+    expected = json.loads(json.dumps(value, default=lambda obj: "x"))
+    for name in ["json", "orjson"]:
+        dumps = log.serializer(name)
+        assert json.loads(dumps(value, default=lambda obj: "x")) == expected
+
+
+def test_queue_sink():
+    """
+    Entries are written, in order, by a background thread. When stopped, any
+    queued entries are written first.
+    """
+    stream = io.StringIO()
+    sink = log.QueueSink(stream=stream)
+    sink.start()
+    for i in range(5):
+        sink.msg(str(i))
+    sink.stop()
+    assert sink.thread is None
+    assert stream.getvalue() == "0\n1\n2\n3\n4\n"
+
+
+def test_queue_sink_full():
+    """
+    Entries are dropped, and counted, rather than waiting for space in a
+    full queue.
+    """
+    sink = log.QueueSink(maxsize=1, stream=io.StringIO())
+    dropped = sink.dropped.value
+    sink.msg("a")
+    sink.msg("b")
+    assert sink.dropped.value == dropped + 1
+    assert sink.queue.get_nowait() == "a"
+
+
+def test_configure():
+    """
+    Configured logging samples events and sends rendered JSON to the sink.
+    """
+    sink = log.QueueSink(stream=io.StringIO())
+    try:
+        log.configure({"Dropped.": 0}, "json", sink)
+        logger = structlog.get_logger()
+        logger.msg("Dropped.")
+        logger.msg("Kept.", value=1)
+    finally:
+        log.configure(log.sample, log.json_library, log.sink, log.policy)
+    entry = json.loads(sink.queue.get_nowait())
+    assert sink.queue.empty()
+    assert entry["event"] == "Kept."
+    assert entry["value"] == 1
+    assert entry["hostname"] == platform.uname().node
+
+
+def test_policy_full():
+    """
+    In full mode, long strings are truncated and large collections are
+    summarised. Other values are left alone.
+    """
+    policy = log.Policy({}, max_field=5, max_items=2)
+    result = policy(
+        None,
+        None,
+        {
+            "event": "Hello.",
+            "short": "abc",
+            "long": "abcdefgh",
+            "small": [1, 2],
+            "large": [{"id": 1}, {"id": 2}, {"id": 3}],
+            "number": 123,
+        },
+    )
+    assert result["short"] == "abc"
+    assert result["long"] == "abcde... (8 characters)"
+    assert result["small"] == [1, 2]
+    assert result["large"] == {"count": 3, "ids": [1, 2]}
+    assert result["number"] == 123
+
+
+def test_policy_summary():
+    """
+    In summary mode every collection is summarised. Objects are summarised
+    as their id, and a dictionary of plain values as its keys.
+    """
+    policy = log.Policy({"User context.": "summary"})
+    context = {
+        "user": {"id": 1, "name": "user"},
+        "room": {"id": 2, "name": "room"},
+        "exits": [{"id": 3}, {"id": 4}],
+        "users": [],
+    }
+    result = policy(
+        None,
+        None,
+        {
+            "event": "User context.",
+            "context": context,
+            "headers": {"Host": "localhost", "Accept": "*/*"},
+        },
+    )
+    assert result["context"] == {
+        "user": 1,
+        "room": 2,
+        "exits": {"count": 2, "ids": [3, 4]},
+        "users": {"count": 0, "ids": []},
+    }
+    assert result["headers"] == {"count": 2, "keys": ["Host", "Accept"]}
+    # The logged values themselves aren't changed.
+    assert context["user"] == {"id": 1, "name": "user"}
+
+
+def test_policy_compact():
+    """
+    In compact mode only the event, ids, durations and errors are kept.
+    """
+    policy = log.Policy({"Access": "compact"})
+    result = policy(
+        None,
+        None,
+        {
+            "event": "Access",
+            "user_id": 1,
+            "endpoint": "/",
+            "headers": {"Host": "localhost"},
+            "duration": 0.1,
+        },
+    )
+    assert result == {"event": "Access", "user_id": 1, "duration": 0.1}
+    with pytest.raises(ValueError):
+        log.Policy({"Access": "tiny"})
@@ -8,7 +8,7 @@ import quart.flask_patch  # type: ignore # noqa
 from unittest import mock
 from uuid import uuid4
 from email.message import EmailMessage
-from textsmith.logic import Logic
+from textsmith.logic import Logic, MARKDOWN
 from textsmith.datastore import DataStore
 from textsmith import constants
 
@@ -42,6 +42,7 @@ def test_init(datastore):
     assert logic.email_port == EMAIL_PORT
     assert logic.email_from == EMAIL_FROM
     assert logic.email_password == EMAIL_PASSWORD
+    assert logic.outbox is None
 
 
 @pytest.mark.asyncio
@@ -177,17 +178,39 @@ async def test_send_email(logic):
         )
 
 
+@pytest.mark.asyncio
+async def test_send_email_outbox(logic):
+    """
+    If there's an outbox, email is queued there rather than sent.
+    """
+    logic.outbox = mock.MagicMock()
+    logic.outbox.put = mock.AsyncMock()
+    msg = EmailMessage()
+    msg["To"] = "user@domain.com"
+    msg.set_content("Test content...")
+    mock_smtp = mock.AsyncMock()
+    with mock.patch("textsmith.logic.aiosmtplib.send", mock_smtp):
+        await logic.send_email(msg)
+    logic.outbox.put.assert_called_once_with(msg)
+    assert mock_smtp.call_count == 0
+
+
 @pytest.mark.asyncio
 async def test_emit_to_user(logic):
     """
-    The referenced message is converted from Markdown into HTML and sent to the
-    message queue for the referenced user.
+    The referenced message is converted from Markdown into HTML and sent, in
+    an envelope, to the message queue for the referenced user. The time
+    taken to render the Markdown is recorded.
     """
     logic.datastore.redis.publish = mock.AsyncMock()
-    await logic.emit_to_user(123, "# Hello world")
-    logic.datastore.redis.publish.assert_called_once_with(
-        "123", "<h1>Hello world</h1>"
-    )
+    rendered = MARKDOWN.count
+    with mock.patch(
+        "textsmith.logic.envelope.wrap", return_value="envelope"
+    ) as mock_wrap:
+        await logic.emit_to_user(123, "# Hello world")
+    mock_wrap.assert_called_once_with("<h1>Hello world</h1>")
+    logic.datastore.redis.publish.assert_called_once_with("123", "envelope")
+    assert MARKDOWN.count == rendered + 1
 
 
 @pytest.mark.asyncio
@@ -260,6 +283,7 @@ async def test_get_script_context(logic):
     """
     user_id = 123
     room_id = 321
+    thing_id = 456
     connection_id = str(uuid4())
     message_id = str(uuid4())
     context = {
@@ -285,13 +309,14 @@ async def test_get_script_context(logic):
         ],
         "things": [
             {
-                "id": 456,
+                "id": thing_id,
             }
         ],
     }
     logic.datastore.get_script_context = mock.AsyncMock(return_value=context)
     result = await logic.get_script_context(user_id, connection_id, message_id)
     assert result == context
+    assert result["index"]["ids"][thing_id] == [context["things"][0]]
 
 
 @pytest.mark.asyncio
@@ -533,48 +558,70 @@ def test_match_object_by_name_or_alias(logic):
     )
 
 
-def test_matches_name_by_name(logic):
+def test_index_context(logic):
     """
-    If the given name is the same as the object's constants.NAME then the
-    object is a match. Matching is case insensitive.
+    The index of a script context maps object ids and normalised names and
+    aliases to the objects they refer to, in context order, without
+    duplicates. The number of words in the longest name is also recorded.
     """
-    obj = {
-        "id": 123,
-        constants.NAME: "NAme",
-    }
-    assert logic.matches_name("naME", obj) is True
-
-
-def test_matches_name_by_alias(logic):
-    """
-    If the given name is in the object's constants.ALIAS list then the object
-    is a match. Matching is case insensitive.
-    """
-    obj = {
-        "id": 123,
-        constants.NAME: "name",
-        constants.ALIAS: [
-            "alias 1",
-            "ALias 2",
+    context = {
+        "user": {"id": 1, constants.NAME: "User"},
+        "room": {"id": 2},
+        "exits": [{"id": 3, constants.NAME: "Big  Red   Door"}],
+        "users": [],
+        "things": [
+            {
+                "id": 4,
+                constants.NAME: "Door",
+                constants.ALIAS: ["door", "big red door"],
+            },
         ],
     }
-    assert logic.matches_name("aliAS 2", obj) is True
+    index = logic.index_context(context)
+    assert index["ids"] == {
+        1: [context["user"]],
+        2: [context["room"]],
+        3: [context["exits"][0]],
+        4: [context["things"][0]],
+    }
+    assert index["names"] == {
+        "user": [context["user"]],
+        "big red door": [context["exits"][0], context["things"][0]],
+        "door": [context["things"][0]],
+    }
+    assert index["longest"] == 3
 
 
-def test_matches_name_no_match_is_false(logic):
+def test_match_object_uses_index(logic):
     """
-    If the given name is not the same as constants.NAME or in constants.ALIAS
-    then it is NOT a match.
+    If the context already contains an index (built by get_script_context)
+    it is used rather than building a new one. Names longer than the
+    longest indexed name are never looked up. The matches are a copy, so
+    changing them doesn't change the index.
     """
-    obj = {
-        "id": 123,
-        constants.NAME: "name",
-        constants.ALIAS: [
-            "alias 1",
-            "alias 2",
-        ],
+    context = {
+        "user": {"id": 1},
+        "room": {"id": 2},
+        "exits": [],
+        "users": [],
+        "things": [],
     }
-    assert logic.matches_name("not a match", obj) is False
+    thing = {"id": 4, constants.NAME: "a thing"}
+    context["index"] = {
+        "ids": {4: [thing]},
+        "names": {"a thing": [thing], "a thing and more": [thing]},
+        "longest": 2,
+    }
+    assert logic.match_object("#4 foo", context) == ([thing], "#4")
+    assert logic.match_object("A  Thing and more", context) == (
+        [thing],
+        "a thing",
+    )
+    assert logic.match_object("a", context) == ([], "")
+    matches, token = logic.match_object("#4", context)
+    assert matches is not context["index"]["ids"][4]
+    matches, token = logic.match_object("a thing", context)
+    assert matches is not context["index"]["names"]["a thing"]
 
 
 @pytest.mark.asyncio
@@ -0,0 +1,228 @@
+"""
+Tests for the in-process DataStore and PubSub replacements. These mirror the
+integration tests for the Redis backed versions.
+
+Copyright (C) 2020 Nicholas H.Tollervey
+"""
+import datetime
+import time
+import pytest  # type: ignore
+from uuid import uuid4
+from unittest import mock
+from textsmith.logic import Logic
+from textsmith.presence import Presence
+from textsmith.memory import MemoryDataStore, MemoryPubSub
+from textsmith import constants
+
+
+@pytest.fixture
+def pubsub():
+    return MemoryPubSub()
+
+
+@pytest.fixture
+def datastore(pubsub):
+    return MemoryDataStore(pubsub)
+
+
+@pytest.mark.asyncio
+async def test_add_get_delete_object(datastore):
+    """
+    Objects can be added, retrieved with values of the expected types, and
+    soft deleted.
+    """
+    object_id = await datastore.add_object(
+        name="test", number=123, list_stuff=(1, 2.345, "six", True)
+    )
+    objects = await datastore.get_objects([object_id])
+    assert objects[object_id] == {
+        "id": object_id,
+        "name": "test",
+        "number": 123,
+        "list_stuff": [1, 2.345, "six", True],
+    }
+    await datastore.delete_object(object_id)
+    assert await datastore.get_objects([object_id]) == {}
+
+
+@pytest.mark.asyncio
+async def test_add_objects(datastore):
+    """
+    Many objects can be added at once, with unique ids. Objects without
+    attributes still exist.
+    """
+    object_ids = await datastore.add_objects({"name": "a"}, {})
+    assert object_ids == [1, 2]
+    assert await datastore.add_object() == 3
+    objects = await datastore.get_objects(object_ids)
+    assert objects == {1: {"id": 1, "name": "a"}, 2: {"id": 2}}
+
+
+@pytest.mark.asyncio
+async def test_attributes(datastore):
+    """
+    Attributes can be annotated, read singly or in batches, and deleted.
+    Missing attributes raise a KeyError.
+    """
+    object_id = await datastore.add_object(name="test")
+    await datastore.annotate_object(object_id, size=3.141, flag=None)
+    assert await datastore.get_attribute(object_id, "size") == 3.141
+    assert await datastore.get_attribute(object_id, "flag") is None
+    with pytest.raises(KeyError):
+        await datastore.get_attribute(object_id, "foo")
+    assert await datastore.get_attributes(
+        [(object_id, "name"), (object_id, "foo")]
+    ) == {(object_id, "name"): "test"}
+    assert 2 == await datastore.delete_attributes(
+        object_id, ["size", "flag", "foo"]
+    )
+    with pytest.raises(KeyError):
+        await datastore.get_attribute(object_id, "size")
+
+
+@pytest.mark.asyncio
+async def test_user_lifecycle(datastore):
+    """
+    Users are created, confirmed with a single use token, verified, seen and
+    deleted.
+    """
+    email = "foo@bar.com"
+    token = str(uuid4())
+    assert await datastore.user_exists(email) is False
+    object_id = await datastore.create_user(email, token)
+    assert await datastore.user_exists(email) is True
+    assert await datastore.email_to_object_id(email) == object_id
+    assert await datastore.email_to_object_id("no@one.com") == 0
+    objects = await datastore.get_objects([object_id])
+    assert objects[object_id][constants.IS_USER] is True
+    # Inactive users can't set a password or log in.
+    assert await datastore.set_user_password(email, "password123") is False
+    assert await datastore.token_to_email(token) == email
+    assert await datastore.confirm_user(token, "password123") == email
+    assert await datastore.token_to_email(token) is None
+    with pytest.raises(ValueError):
+        await datastore.confirm_user(token, "password123")
+    assert await datastore.verify_user(email, "password123") is True
+    assert await datastore.verify_user(email, "wrong") is False
+    assert await datastore.verify_user("no@one.com", "password123") is False
+    # Last seen.
+    before = time.time()
+    await datastore.set_last_seen(email)
+    last_seen = await datastore.get_last_seen(object_id)
+    assert isinstance(last_seen, datetime.datetime)
+    assert await datastore.get_last_seen(-1) is None
+    assert object_id in await datastore.get_recently_seen(before)
+    assert await datastore.get_recently_seen(time.time() + 1) == {}
+    # Deleted users can't log in.
+    room_id = await datastore.add_object(name="room")
+    await datastore.set_container(object_id, room_id)
+    await datastore.delete_user(email)
+    assert await datastore.verify_user(email, "password123") is False
+    assert await datastore.get_location(object_id) is None
+
+
+@pytest.mark.asyncio
+async def test_presence(datastore):
+    """
+    Heartbeats are recorded and read, and expired heartbeats are removed, so
+    Presence works without Redis.
+    """
+    presence = Presence(datastore, 10, 100)
+    with mock.patch("textsmith.presence.time.time", return_value=100.0):
+        await presence.connect(1, "abc", mock.MagicMock())
+        assert await presence.online([1, 2]) == [1]
+    await datastore.set_presence({2: 150.0}, 120.0)
+    assert await datastore.get_presence([1, 2]) == {2: 150.0}
+    with mock.patch("textsmith.presence.time.time", return_value=160.0):
+        await presence.heartbeat()
+        assert await presence.online([1, 2]) == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_containers_and_contexts(datastore):
+    """
+    Objects can be moved between containers (the old container is
+    returned), and contexts for scripts are assembled from the contents of
+    the user's room.
+    """
+    room_id = await datastore.add_object(
+        name="room", **{constants.IS_ROOM: True}
+    )
+    user_id = await datastore.add_object(
+        name="user", **{constants.IS_USER: True}
+    )
+    other_id = await datastore.add_object(
+        name="other", **{constants.IS_USER: True}
+    )
+    exit_id = await datastore.add_object(
+        name="door", **{constants.IS_EXIT: True}
+    )
+    item_id = await datastore.add_object(name="item")
+    assert await datastore.set_container(item_id, user_id) is None
+    for object_id in (user_id, other_id, exit_id):
+        await datastore.set_container(object_id, room_id)
+    assert await datastore.set_container(item_id, room_id) == user_id
+    assert await datastore.get_contents(user_id) == {}
+    assert await datastore.get_location(item_id) == room_id
+    users = await datastore.get_users_in_room(room_id)
+    assert sorted(user["id"] for user in users) == [user_id, other_id]
+    context = await datastore.get_script_context(user_id)
+    assert context["user"]["id"] == user_id
+    assert context["room"]["id"] == room_id
+    assert [obj["id"] for obj in context["exits"]] == [exit_id]
+    assert [obj["id"] for obj in context["users"]] == [other_id]
+    assert [obj["id"] for obj in context["things"]] == [item_id]
+    assert await datastore.set_container(item_id, -1) == room_id
+    assert await datastore.get_location(item_id) is None
+    assert item_id not in await datastore.get_contents(room_id)
+
+
+@pytest.mark.asyncio
+async def test_pubsub(pubsub):
+    """
+    Messages published to connected users are queued in envelopes with
+    sequence numbers. Messages for other users are dropped.
+    """
+    await pubsub.subscribe(1, "abc")
+    assert await pubsub.publish("1", "hello") == 1
+    assert await pubsub.publish("2", "nobody") == 0
+    message = await pubsub.get_message(1)
+    assert message["body"] == "hello"
+    assert message["seq"] == 1
+    stats = pubsub.stats()
+    assert stats["state"] == "connected"
+    assert stats["connected_users"] == 1
+    assert stats["channels"] == 1
+    assert stats["messages"] == 2
+    await pubsub.unsubscribe(1, "abc")
+    assert await pubsub.get_message(1) == ""
+    await pubsub.stop()
+
+
+@pytest.mark.asyncio
+async def test_logic_emit_to_room(datastore, pubsub):
+    """
+    Logic works unchanged on top of the in-process backend: messages emitted
+    to a room reach the connected users who aren't excluded.
+    """
+    logic = Logic(datastore, "host", 25, "from@host", "password")
+    room_id = await datastore.add_object(name="room")
+    user_ids = await datastore.add_objects(
+        {constants.IS_USER: True}, {constants.IS_USER: True}
+    )
+    for user_id in user_ids:
+        await datastore.set_container(user_id, room_id)
+        await pubsub.subscribe(user_id, "abc")
+    await logic.emit_to_room(room_id, [user_ids[0]], "Hello")
+    message = await pubsub.get_message(user_ids[1])
+    assert message["body"] == "<p>Hello</p>"
+    assert pubsub.connected_users[user_ids[0]].empty()
+
+
+@pytest.mark.asyncio
+async def test_publish_without_pubsub():
+    """
+    Without a MemoryPubSub, published messages go nowhere.
+    """
+    datastore = MemoryDataStore()
+    assert await datastore.publish("1", "hello") == 0
@@ -0,0 +1,182 @@
+"""
+Tests for the in-process metrics.
+
+Copyright (C) 2020 Nicholas H.Tollervey
+"""
+import asyncio
+import json
+import os
+import pytest  # type: ignore
+from textsmith.metrics import (
+    Histogram,
+    Registry,
+    LoopMonitor,
+    Exporter,
+    instrument,
+)
+
+
+def test_histogram():
+    """
+    Observed values are counted in the correct buckets, and the snapshot
+    contains cumulative counts, the total count and the sum.
+    """
+    histogram = Histogram([1.0, 0.1, 0.5])
+    assert histogram.buckets == (0.1, 0.5, 1.0)
+    for value in [0.05, 0.1, 0.3, 0.7, 5.0]:
+        histogram.observe(value)
+    result = histogram.snapshot()
+    assert result["count"] == 5
+    assert result["sum"] == 6.15
+    assert result["buckets"] == {
+        "0.1": 2,
+        "0.5": 3,
+        "1.0": 4,
+        "+Inf": 5,
+    }
+
+
+@pytest.mark.asyncio
+async def test_instrument():
+    """
+    Public coroutine methods are timed, even if they fail. Other methods are
+    left alone.
+    """
+
+    class Thing:
+        async def work(self, value):
+            return value * 2
+
+        async def fail(self):
+            raise ValueError("Boom")
+
+        async def _private(self):
+            return 1
+
+        def sync(self):
+            return 2
+
+    thing = Thing()
+    family = Registry().histogram("thing_seconds", "Thing.", ["method"])
+    instrument(thing, family)
+    assert set(family.children) == {("work",), ("fail",)}
+    assert await thing.work(2) == 4
+    assert await thing.work(3) == 6
+    with pytest.raises(ValueError):
+        await thing.fail()
+    assert await thing._private() == 1
+    assert thing.sync() == 2
+    assert family.labels("work").count == 2
+    assert family.labels("fail").count == 1
+
+
+def test_labels():
+    """
+    Each combination of label values has its own child metric. The wrong
+    number of label values is an error. Registering an existing name returns
+    the existing family, unless it's a different kind of metric.
+    """
+    registry = Registry()
+    family = registry.counter("things_total", "Things.", ["kind"])
+    family.labels("a").inc()
+    family.labels("a").inc(2)
+    family.labels("b").inc()
+    assert family.labels("a").value == 3
+    assert family.labels("b").value == 1
+    with pytest.raises(ValueError):
+        family.labels("a", "b")
+    assert registry.counter("things_total", "Things.", ["kind"]) is family
+    with pytest.raises(ValueError):
+        registry.gauge("things_total", "Things.")
+
+
+@pytest.mark.asyncio
+async def test_render():
+    """
+    Metrics are rendered in the Prometheus text format. Gauges with a
+    function (or coroutine function) are read when rendered.
+    """
+    registry = Registry()
+    registry.counter("requests_total", "Requests.", ["path"]).labels(
+        '/a"b'
+    ).inc()
+    gauge = registry.gauge("open", "Open things.").labels()
+    gauge.inc(3)
+    gauge.dec()
+    registry.gauge("answer", "The answer.", function=lambda: 42)
+
+    async def depths():
+        return {("a",): 1, ("b",): 2}
+
+    registry.gauge("depth", "Depths.", ["queue"], function=depths)
+    registry.histogram(
+        "latency_seconds", "Latency.", buckets=[0.1, 1.0]
+    ).labels().observe(0.5)
+    result = await registry.render()
+    assert result.endswith("\n")
+    lines = result.splitlines()
+    assert "# HELP requests_total Requests." in lines
+    assert "# TYPE requests_total counter" in lines
+    assert 'requests_total{path="/a\\"b"} 1.0' in lines
+    assert "open 2.0" in lines
+    assert "answer 42.0" in lines
+    assert 'depth{queue="a"} 1.0' in lines
+    assert 'depth{queue="b"} 2.0' in lines
+    assert "# TYPE latency_seconds histogram" in lines
+    assert 'latency_seconds_bucket{le="0.1"} 0' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 1' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 1' in lines
+    assert "latency_seconds_sum 0.5" in lines
+    assert "latency_seconds_count 1" in lines
+
+
+@pytest.mark.asyncio
+async def test_loop_monitor():
+    """
+    The loop monitor records the lag of the event loop every interval until
+    it is stopped.
+    """
+    family = Registry().histogram("lag_seconds", "Lag.")
+    monitor = LoopMonitor(family, interval=0)
+    monitor.start()
+    for _ in range(3):
+        await asyncio.sleep(0)
+    assert family.labels().count >= 1
+    assert monitor.lag >= 0
+    await monitor.stop()
+    assert monitor.task is None
+
+
+@pytest.mark.asyncio
+async def test_exporter(tmp_path):
+    """
+    Each worker exports its samples, labelled with the worker's name, to a
+    shared directory. Rendering the metrics includes the current samples of
+    the worker and the exported samples of the other workers. Stopping the
+    exporter removes its file.
+    """
+    registries = [Registry(), Registry()]
+    exporters = [
+        Exporter(registry, str(tmp_path), str(worker), interval=0)
+        for worker, registry in enumerate(registries)
+    ]
+    for worker, registry in enumerate(registries):
+        registry.counter("things_total", "Things.").labels().inc(worker + 1)
+    registries[1].gauge("only_one", "Only one worker.").labels().set(5)
+    await exporters[1].export()
+    with open(exporters[1].path) as source:
+        exported = json.load(source)
+    assert exported["things_total"]["samples"] == [
+        ["things_total", {"worker": "1"}, 2.0]
+    ]
+    registries[0].counter("things_total", "Things.").labels().inc()
+    lines = (await exporters[0].render()).splitlines()
+    assert lines.count("# TYPE things_total counter") == 1
+    assert 'things_total{worker="0"} 2.0' in lines
+    assert 'things_total{worker="1"} 2.0' in lines
+    assert 'only_one{worker="1"} 5.0' in lines
+    exporters[1].start()
+    await asyncio.sleep(0)
+    await exporters[1].stop()
+    assert exporters[1].task is None
+    assert not os.path.exists(exporters[1].path)
@@ -0,0 +1,360 @@
+"""
+Tests for the email outbox.
+
+Copyright (C) 2020 Nicholas H.Tollervey
+"""
+import asyncio
+import json
+import aiosmtplib  # type: ignore
+import pytest  # type: ignore
+from email.message import EmailMessage
+from unittest import mock
+from textsmith.datastore import DataStore
+from textsmith.outbox import Outbox
+
+
+EMAIL_HOST = "email.host.com"
+EMAIL_PORT = 1234
+EMAIL_FROM = "hello@textsmith.com"
+EMAIL_PASSWORD = "secret123"
+
+
+@pytest.fixture
+def outbox(mocker):
+    return Outbox(
+        DataStore(mocker.MagicMock()),
+        EMAIL_HOST,
+        EMAIL_PORT,
+        EMAIL_FROM,
+        EMAIL_PASSWORD,
+        batch_size=3,
+        max_attempts=2,
+    )
+
+
+@pytest.fixture
+def message():
+    msg = EmailMessage()
+    msg["From"] = EMAIL_FROM
+    msg["To"] = "user@domain.com"
+    msg["Subject"] = "This is a test."
+    msg.set_content("Test content...")
+    return msg
+
+
+def test_init(mocker):
+    """
+    Ensure the Outbox object is initialised with the expected state.
+    """
+    datastore = DataStore(mocker.MagicMock())
+    outbox = Outbox(datastore, EMAIL_HOST, EMAIL_PORT, EMAIL_FROM, "secret")
+    assert outbox.datastore == datastore
+    assert outbox.email_host == EMAIL_HOST
+    assert outbox.email_port == EMAIL_PORT
+    assert outbox.email_from == EMAIL_FROM
+    assert outbox.email_password == "secret"
+    assert outbox.connections == 2
+    assert outbox.batch_size == 10
+    assert outbox.failures == 0
+    assert outbox.clients == []
+    assert outbox.in_flight == []
+    assert outbox.lease == 30.0
+    assert outbox.processing_key == "outbox:processing:" + outbox.instance
+    assert outbox.task is None
+    assert outbox.keepalive is None
+
+
+def test_init_instances(mocker):
+    """
+    Each instance has its own processing list.
+    """
+    datastore = DataStore(mocker.MagicMock())
+    first = Outbox(datastore, EMAIL_HOST, EMAIL_PORT, EMAIL_FROM, "secret")
+    second = Outbox(datastore, EMAIL_HOST, EMAIL_PORT, EMAIL_FROM, "secret")
+    assert first.instance != second.instance
+    assert first.processing_key != second.processing_key
+
+
+@pytest.mark.asyncio
+async def test_put(outbox, message):
+    """
+    Messages are serialised and pushed onto the outbox list.
+    """
+    outbox.datastore.redis.lpush = mock.AsyncMock()
+    await outbox.put(message, 1)
+    key, values = outbox.datastore.redis.lpush.call_args[0]
+    assert key == "outbox"
+    item = json.loads(values[0])
+    assert item["attempts"] == 1
+    assert item["message"] == message.as_string()
+
+
+@pytest.mark.asyncio
+async def test_size(outbox):
+    """
+    The size of the outbox is the length of the outbox list.
+    """
+    outbox.datastore.redis.llen = mock.AsyncMock(return_value=3)
+    assert await outbox.size() == 3
+    outbox.datastore.redis.llen.assert_called_once_with("outbox")
+
+
+@pytest.mark.asyncio
+async def test_take(outbox, message):
+    """
+    Up to batch_size messages are moved to the processing list in a single
+    transaction and deserialised. Empty pops are ignored. The messages are
+    in flight until they're done.
+    """
+    item = json.dumps({"attempts": 0, "message": message.as_string()})
+    raw = [item, None, None]
+
+    async def rpoplpush(source, destination):
+        assert source == "outbox"
+        assert destination == outbox.processing_key
+        result = asyncio.get_running_loop().create_future()
+        result.set_result(raw.pop(0))
+        return result
+
+    mock_transaction = mock.AsyncMock()
+    mock_transaction.rpoplpush.side_effect = rpoplpush
+    outbox.datastore.redis.multi = mock.AsyncMock(
+        return_value=mock_transaction
+    )
+    result = await outbox.take()
+    assert len(result) == 1
+    assert result[0]["attempts"] == 0
+    assert result[0]["message"]["To"] == message["To"]
+    assert result[0]["message"].get_content() == message.get_content()
+    assert result[0]["raw"] == item
+    assert outbox.in_flight == [item]
+    assert mock_transaction.rpoplpush.call_count == 3
+    mock_transaction.exec.assert_called_once_with()
+
+
+@pytest.mark.asyncio
+async def test_done(outbox):
+    """
+    A message that's done with is removed from the processing list, and is
+    no longer in flight.
+    """
+    outbox.datastore.redis.lrem = mock.AsyncMock()
+    outbox.in_flight = ["raw"]
+    await outbox.done({"raw": "raw"})
+    outbox.datastore.redis.lrem.assert_called_once_with(
+        outbox.processing_key, 1, "raw"
+    )
+    assert outbox.in_flight == []
+
+
+@pytest.mark.asyncio
+async def test_requeue(outbox):
+    """
+    Messages in flight are removed from the processing list and put back at
+    the front of the outbox, in a single transaction.
+    """
+    mock_transaction = mock.AsyncMock()
+    outbox.datastore.redis.multi = mock.AsyncMock(
+        return_value=mock_transaction
+    )
+    await outbox.requeue()
+    assert outbox.datastore.redis.multi.call_count == 0
+    outbox.in_flight = ["a", "b"]
+    await outbox.requeue()
+    assert mock_transaction.lrem.call_args_list == [
+        mock.call(outbox.processing_key, 1, "a"),
+        mock.call(outbox.processing_key, 1, "b"),
+    ]
+    mock_transaction.rpush.assert_called_once_with("outbox", ["a", "b"])
+    mock_transaction.exec.assert_called_once_with()
+    assert outbox.in_flight == []
+
+
+@pytest.mark.asyncio
+async def test_heartbeat(outbox):
+    """
+    A heartbeat records the current time against the instance's id.
+    """
+    outbox.datastore.redis.zadd = mock.AsyncMock()
+    with mock.patch("textsmith.outbox.time.time", return_value=100.0):
+        await outbox.heartbeat()
+    outbox.datastore.redis.zadd.assert_called_once_with(
+        "outbox:instances", {outbox.instance: 100.0}
+    )
+
+
+@pytest.mark.asyncio
+async def test_recover(outbox):
+    """
+    Only messages left in the processing lists of instances whose heartbeat
+    is older than the lease are moved back into the outbox, and those
+    instances are forgotten. Live instances (and this one) are left alone.
+    """
+    reply = mock.MagicMock()
+    reply.asdict = mock.AsyncMock(
+        return_value={"gone": 10.0, outbox.instance: 20.0}
+    )
+    outbox.datastore.redis.zrangebyscore = mock.AsyncMock(return_value=reply)
+    outbox.datastore.redis.rpoplpush = mock.AsyncMock(
+        side_effect=["a", "b", None]
+    )
+    outbox.datastore.redis.zrem = mock.AsyncMock()
+    with mock.patch("textsmith.outbox.time.time", return_value=100.0):
+        assert await outbox.recover() == 2
+    key, low, high = outbox.datastore.redis.zrangebyscore.call_args[0]
+    assert key == "outbox:instances"
+    assert high.value == 100.0 - outbox.lease
+    assert high.exclude_boundary is True
+    outbox.datastore.redis.rpoplpush.assert_called_with(
+        "outbox:processing:gone", "outbox"
+    )
+    outbox.datastore.redis.zrem.assert_called_once_with(
+        "outbox:instances", ["gone"]
+    )
+
+
+@pytest.mark.asyncio
+async def test_leave(outbox):
+    """
+    Leaving removes the instance's heartbeat.
+    """
+    outbox.datastore.redis.zrem = mock.AsyncMock()
+    await outbox.leave()
+    outbox.datastore.redis.zrem.assert_called_once_with(
+        "outbox:instances", [outbox.instance]
+    )
+
+
+@pytest.mark.asyncio
+async def test_keep_alive(outbox):
+    """
+    A heartbeat is recorded, and gone instances recovered, every third of
+    the lease.
+    """
+    outbox.heartbeat = mock.AsyncMock()
+    outbox.recover = mock.AsyncMock(return_value=0)
+    mock_sleep = mock.AsyncMock(side_effect=[None, asyncio.CancelledError])
+    with mock.patch("textsmith.outbox.asyncio.sleep", mock_sleep):
+        with pytest.raises(asyncio.CancelledError):
+            await outbox.keep_alive()
+    assert outbox.heartbeat.call_count == 2
+    assert outbox.recover.call_count == 2
+    mock_sleep.assert_called_with(outbox.lease / 3)
+
+
+@pytest.mark.asyncio
+async def test_deliver(outbox, message):
+    """
+    A message is sent over an idle connection, which is opened if needed and
+    returned to the pool afterwards. The sent message is done with.
+    """
+    client = mock.MagicMock()
+    client.is_connected = False
+    client.connect = mock.AsyncMock()
+    client.send_message = mock.AsyncMock()
+    outbox.idle.put_nowait(client)
+    outbox.done = mock.AsyncMock()
+    item = {"attempts": 0, "message": message, "raw": "raw"}
+    result = await outbox.deliver(item)
+    assert result is True
+    client.connect.assert_called_once_with()
+    client.send_message.assert_called_once_with(message)
+    outbox.done.assert_called_once_with(item)
+    assert outbox.idle.get_nowait() == client
+
+
+@pytest.mark.asyncio
+async def test_deliver_retry(outbox, message):
+    """
+    A message that fails to send is put back into the outbox with the number
+    of attempts incremented, and the failed connection is closed. Once
+    max_attempts is reached the message is dropped. Either way, the original
+    message is done with.
+    """
+    client = mock.MagicMock()
+    client.is_connected = True
+    client.send_message = mock.AsyncMock(
+        side_effect=aiosmtplib.SMTPServerDisconnected("Bang")
+    )
+    outbox.idle.put_nowait(client)
+    outbox.put = mock.AsyncMock()
+    outbox.done = mock.AsyncMock()
+    result = await outbox.deliver({"attempts": 0, "message": message})
+    assert result is False
+    client.close.assert_called_once_with()
+    outbox.put.assert_called_once_with(message, 1)
+    outbox.put.reset_mock()
+    result = await outbox.deliver({"attempts": 1, "message": message})
+    assert result is False
+    assert outbox.put.call_count == 0
+    assert outbox.done.call_count == 2
+    assert outbox.idle.qsize() == 1
+
+
+@pytest.mark.asyncio
+async def test_run(outbox, message):
+    """
+    Batches are delivered concurrently. A batch where every delivery fails
+    causes an exponentially increasing wait, and a success resets it. An
+    empty outbox is checked again after the interval. A heartbeat is
+    recorded first.
+    """
+    item = {"attempts": 0, "message": message}
+    outbox.heartbeat = mock.AsyncMock()
+    outbox.take = mock.AsyncMock(
+        side_effect=[[item, item], [item], [item], [], asyncio.CancelledError]
+    )
+    outbox.deliver = mock.AsyncMock(side_effect=[False, False, False, True])
+    mock_sleep = mock.AsyncMock()
+    with mock.patch("textsmith.outbox.asyncio.sleep", mock_sleep):
+        with pytest.raises(asyncio.CancelledError):
+            await outbox.run()
+    assert outbox.deliver.call_count == 4
+    assert mock_sleep.call_args_list == [
+        mock.call(1.0),
+        mock.call(2.0),
+        mock.call(outbox.interval),
+    ]
+    assert outbox.failures == 0
+    outbox.heartbeat.assert_called_once_with()
+
+
+@pytest.mark.asyncio
+async def test_start_stop(outbox):
+    """
+    Starting creates the pool of connections and schedules the delivery and
+    keep alive tasks. Stopping cancels the tasks, puts messages in flight
+    back into the outbox, forgets the instance and closes the open
+    connections.
+    """
+    outbox.heartbeat = mock.AsyncMock()
+    outbox.recover = mock.AsyncMock(return_value=0)
+    outbox.take = mock.AsyncMock(return_value=[])
+    outbox.requeue = mock.AsyncMock()
+    outbox.leave = mock.AsyncMock()
+    client = mock.MagicMock()
+    client.is_connected = True
+    client.quit = mock.AsyncMock()
+    with mock.patch(
+        "textsmith.outbox.aiosmtplib.SMTP", return_value=client
+    ) as mock_smtp:
+        outbox.start()
+    mock_smtp.assert_called_with(
+        hostname=EMAIL_HOST,
+        port=EMAIL_PORT,
+        username=EMAIL_FROM,
+        password=EMAIL_PASSWORD,
+        use_tls=True,
+    )
+    assert len(outbox.clients) == 2
+    assert outbox.idle.qsize() == 2
+    await asyncio.sleep(0)
+    outbox.take.assert_called_once_with()
+    await outbox.stop()
+    outbox.recover.assert_called_once_with()
+    outbox.requeue.assert_called_once_with()
+    outbox.leave.assert_called_once_with()
+    assert outbox.task is None
+    assert outbox.keepalive is None
+    assert outbox.clients == []
+    assert client.quit.call_count == 2
@@ -12,7 +12,7 @@ from textsmith.parser import Parser
 from textsmith.verbs import UnknownVerb
 from textsmith.logic import Logic
 from textsmith.datastore import DataStore
-from textsmith import constants
+from textsmith import constants, trace
 
 
 EMAIL_HOST = "email.host.com"
@@ -83,6 +83,30 @@ async def test_eval(parser, user_id, connection_id, message_id, message):
     )
 
 
+@pytest.mark.asyncio
+async def test_eval_traced(
+    parser, user_id, connection_id, message_id, message
+):
+    """
+    Evaluating the user's input is traced. The trace is finished, and no
+    longer current, once the input is evaluated.
+    """
+    parser.parse = mock.AsyncMock()
+    mock_finish = mock.MagicMock()
+    with mock.patch(
+        "textsmith.parser.uuid4", return_value=message_id
+    ), mock.patch("textsmith.trace.sample_rate", 1.0), mock.patch(
+        "textsmith.trace.logger.msg", mock_finish
+    ):
+        await parser.eval(user_id, connection_id, message)
+    summary = mock_finish.call_args.kwargs
+    assert summary["message_id"] == message_id
+    assert summary["user_id"] == user_id
+    assert summary["connection_id"] == connection_id
+    assert summary["spans"]["parse"]["count"] == 1
+    assert trace.current_trace.get() is None
+
+
 @pytest.mark.asyncio
 async def test_eval_escape(
     parser, user_id, connection_id, message_id, message
@@ -0,0 +1,207 @@
+"""
+Tests for the instrumented, resizable, Redis connection pool.
+
+Copyright (C) 2020 Nicholas H.Tollervey
+"""
+import asyncio
+import pytest  # type: ignore
+from unittest import mock
+from asyncio_redis.exceptions import (  # type: ignore
+    NoAvailableConnectionsInPoolError,
+)
+from textsmith.pool import InstrumentedPool
+
+
+def mock_connection(in_use=False, pending=()):
+    """
+    Return a mock connection that is (or isn't) busy, with the referenced
+    replies pending.
+    """
+    connection = mock.MagicMock()
+    connection.protocol.in_use = in_use
+    connection.protocol._queue = list(pending)
+    return connection
+
+
+@pytest.fixture
+def mock_pool():
+    pool = mock.MagicMock()
+    pool.poolsize = 2
+    pool._poolsize = 2
+    pool.connections_in_use = 0
+    pool.connections_connected = 2
+    pool._connections = [mock_connection(), mock_connection()]
+    return pool
+
+
+def test_init(mock_pool):
+    """
+    By default the pool keeps its size, and nothing has been measured.
+    """
+    pool = InstrumentedPool(mock_pool)
+    assert pool.pool == mock_pool
+    assert pool.connect is None
+    assert pool.min_size == 2
+    assert pool.max_size == 2
+    assert pool.wait_timeout == 5.0
+    assert pool.commands == {}
+    assert pool.wait.count == 0
+    assert pool.in_flight == 0
+    assert pool.task is None
+    assert pool.poolsize == 2
+    assert pool.close == mock_pool.close
+
+
+@pytest.mark.asyncio
+async def test_command(mock_pool):
+    """
+    Commands are passed to the pool, and their latency, wait and the number
+    in flight are recorded.
+    """
+    pool = InstrumentedPool(mock_pool)
+
+    async def get(key):
+        assert pool.in_flight == 1
+        return "value"
+
+    mock_pool.get = get
+    assert await pool.get("key") == "value"
+    assert await pool.get("key") == "value"
+    assert pool.in_flight == 0
+    assert pool.commands["get"].count == 2
+    assert pool.wait.count == 2
+    assert pool.waited == 0
+    mock_pool.set = mock.AsyncMock(side_effect=ValueError("Boom"))
+    with pytest.raises(ValueError):
+        await pool.set("key", "value")
+    assert pool.in_flight == 0
+    assert pool.commands["set"].count == 1
+    stats = pool.stats()
+    assert stats["poolsize"] == 2
+    assert stats["in_use"] == 0
+    assert stats["connected"] == 2
+    assert stats["in_flight"] == 0
+    assert stats["timeouts"] == 0
+    assert stats["wait"]["count"] == 3
+    assert stats["commands"]["get"]["count"] == 2
+
+
+@pytest.mark.asyncio
+async def test_register_script(mock_pool):
+    """
+    Registering a script loads it via the pool. Running the script sends
+    EVALSHA via the pool too, so it uses any free connection and is measured.
+    """
+    pool = InstrumentedPool(mock_pool)
+    mock_pool.script_load = mock.AsyncMock(return_value="sha")
+    mock_pool.evalsha = mock.AsyncMock(return_value="reply")
+    script = await pool.register_script("return 1")
+    mock_pool.script_load.assert_called_once_with("return 1")
+    assert script.sha == "sha"
+    assert await script.run(keys=["k"], args=["a"]) == "reply"
+    mock_pool.evalsha.assert_called_once_with("sha", ["k"], ["a"])
+    assert pool.commands["script_load"].count == 1
+    assert pool.commands["evalsha"].count == 1
+    assert mock_pool.register_script.call_count == 0
+
+
+@pytest.mark.asyncio
+async def test_wait_for_connection(mock_pool):
+    """
+    If every connection is busy, commands wait for a free one, and fail if
+    none becomes free within the wait timeout.
+    """
+    pool = InstrumentedPool(mock_pool, wait_timeout=1.0)
+    get = mock.AsyncMock(return_value="value")
+    busy = NoAvailableConnectionsInPoolError("Busy")
+    attribute = mock.PropertyMock(side_effect=[busy, busy, get])
+    type(mock_pool).get = attribute
+    assert await pool.get("key") == "value"
+    assert attribute.call_count == 3
+    assert pool.waited == 1
+    assert pool.wait.count == 1
+    pool.wait_timeout = 0
+    type(mock_pool).get = mock.PropertyMock(side_effect=busy)
+    with pytest.raises(NoAvailableConnectionsInPoolError):
+        await pool.get("key")
+    assert pool.timeouts == 1
+
+
+@pytest.mark.asyncio
+async def test_grow_and_shrink(mock_pool):
+    """
+    Growing adds new connections. Shrinking only closes connections that
+    aren't busy or waiting for replies. A pool can't grow without a way to
+    connect.
+    """
+    with pytest.raises(ValueError):
+        await InstrumentedPool(mock_pool).grow(1)
+    new = [mock_connection(), mock_connection(in_use=True)]
+    connect = mock.AsyncMock(side_effect=new)
+    pool = InstrumentedPool(mock_pool, connect, 2, 4)
+    await pool.grow(2)
+    assert mock_pool._poolsize == 4
+    assert mock_pool._connections[2:] == new
+    busy = mock_connection(pending=[mock.MagicMock()])
+    idle = mock_connection()
+    mock_pool._connections = [busy, new[1], idle]
+    mock_pool._poolsize = 3
+    assert pool.shrink(2) == 1
+    assert mock_pool._connections == [busy, new[1]]
+    assert mock_pool._poolsize == 2
+    idle.close.assert_called_once_with()
+    assert busy.close.call_count == 0
+
+
+@pytest.mark.asyncio
+async def test_resize(mock_pool):
+    """
+    The pool grows by half (within the maximum) after commands waited, and
+    shrinks by one connection (within the minimum) after enough idle
+    intervals.
+    """
+    pool = InstrumentedPool(
+        mock_pool, mock.AsyncMock(), 2, 3, idle_intervals=2
+    )
+    pool.grow = mock.AsyncMock()
+    pool.shrink = mock.MagicMock()
+    pool.waited = 5
+    await pool.resize()
+    pool.grow.assert_called_once_with(1)
+    assert pool.waited == 0
+    # Already at the maximum size.
+    mock_pool.poolsize = 3
+    pool.grow.reset_mock()
+    pool.waited = 5
+    await pool.resize()
+    assert pool.grow.call_count == 0
+    # Idle for two intervals in a row.
+    pool.peak_in_use = 1
+    await pool.resize()
+    assert pool.idle == 1
+    assert pool.shrink.call_count == 0
+    await pool.resize()
+    pool.shrink.assert_called_once_with(1)
+    assert pool.idle == 0
+    # Busy connections reset the count of idle intervals.
+    await pool.resize()
+    assert pool.idle == 1
+    pool.peak_in_use = 2
+    await pool.resize()
+    assert pool.idle == 0
+
+
+@pytest.mark.asyncio
+async def test_start_stop(mock_pool):
+    """
+    Starting schedules a task to resize the pool every interval, and
+    stopping cancels it.
+    """
+    pool = InstrumentedPool(mock_pool, interval=0)
+    pool.resize = mock.AsyncMock()
+    pool.start()
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert pool.resize.call_count >= 1
+    await pool.stop()
+    assert pool.task is None
@@ -0,0 +1,167 @@
+"""
+Tests for tracking the presence of users.
+
+Copyright (C) 2020 Nicholas H.Tollervey
+"""
+import asyncio
+import pytest  # type: ignore
+from unittest import mock
+from textsmith.datastore import DataStore
+from textsmith.presence import Presence
+
+
+@pytest.fixture
+def presence(mocker):
+    presence = Presence(DataStore(mocker.MagicMock()), 10, 100)
+    presence.datastore.set_presence = mock.AsyncMock()
+    return presence
+
+
+def test_init(mocker):
+    """
+    Ensure the Presence object is initialised with the expected state. Users
+    are online for three heartbeat intervals.
+    """
+    datastore = DataStore(mocker.MagicMock())
+    presence = Presence(datastore, 10, 100)
+    assert presence.datastore == datastore
+    assert presence.interval == 10
+    assert presence.idle_timeout == 100
+    assert presence.timeout == 30
+    assert presence.connections == {}
+    assert presence.task is None
+
+
+@pytest.mark.asyncio
+async def test_connect_touch(presence):
+    """
+    Connections are tracked, and the user's heartbeat is recorded straight
+    away. Activity on a connection updates the time it was last active.
+    """
+    task = mock.MagicMock()
+    with mock.patch(
+        "textsmith.presence.time.monotonic", return_value=1.0
+    ), mock.patch("textsmith.presence.time.time", return_value=100.0):
+        await presence.connect(1, "abc", task)
+    assert presence.connections["abc"] == {
+        "user_id": 1,
+        "last_active": 1.0,
+        "task": task,
+    }
+    presence.datastore.set_presence.assert_called_once_with({1: 100.0})
+    with mock.patch("textsmith.presence.time.monotonic", return_value=2.0):
+        presence.touch("abc")
+        presence.touch("unknown")
+    assert presence.connections["abc"]["last_active"] == 2.0
+
+
+@pytest.mark.asyncio
+async def test_disconnect(presence):
+    """
+    The connection is no longer tracked, so the user's heartbeat is only
+    refreshed while they have other connections to this instance. The user
+    isn't removed from the sorted set, since they may be connected to
+    another instance: their heartbeat expires instead.
+    """
+    await presence.connect(1, "abc", mock.MagicMock())
+    await presence.connect(1, "def", mock.MagicMock())
+    presence.disconnect(1, "abc")
+    assert presence.user_ids() == [1]
+    presence.disconnect(1, "def")
+    assert presence.user_ids() == []
+    assert presence.connections == {}
+    assert presence.datastore.set_presence.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_evict_idle(presence):
+    """
+    Connections idle for longer than the idle timeout have their task
+    cancelled and are no longer tracked.
+    """
+    idle_task = mock.MagicMock()
+    active_task = mock.MagicMock()
+    with mock.patch("textsmith.presence.time.monotonic", return_value=0.0):
+        await presence.connect(1, "idle", idle_task)
+    with mock.patch("textsmith.presence.time.monotonic", return_value=50.0):
+        await presence.connect(2, "active", active_task)
+    with mock.patch("textsmith.presence.time.monotonic", return_value=120.0):
+        result = presence.evict_idle()
+    assert result == ["idle"]
+    idle_task.cancel.assert_called_once_with()
+    assert active_task.cancel.call_count == 0
+    assert list(presence.connections) == ["active"]
+
+
+@pytest.mark.asyncio
+async def test_close_all(presence):
+    """
+    Closing all the connections cancels the task handling each of them.
+    """
+    tasks = [mock.MagicMock(), mock.MagicMock()]
+    await presence.connect(1, "a", tasks[0])
+    await presence.connect(2, "b", tasks[1])
+    assert presence.close_all() == 2
+    for task in tasks:
+        task.cancel.assert_called_once_with()
+
+
+@pytest.mark.asyncio
+async def test_heartbeat(presence):
+    """
+    The heartbeat of every connected user is refreshed, and users whose
+    heartbeat has expired are removed, together.
+    """
+    await presence.connect(1, "abc", mock.MagicMock())
+    await presence.connect(2, "def", mock.MagicMock())
+    await presence.connect(2, "ghi", mock.MagicMock())
+    with mock.patch("textsmith.presence.time.time", return_value=100.0):
+        await presence.heartbeat()
+    presence.datastore.set_presence.assert_called_with(
+        {1: 100.0, 2: 100.0}, 70.0
+    )
+
+
+@pytest.mark.asyncio
+async def test_online(presence):
+    """
+    Only users with a recent heartbeat are online.
+    """
+    presence.datastore.get_presence = mock.AsyncMock(
+        return_value={1: 99.0, 2: 10.0}
+    )
+    with mock.patch("textsmith.presence.time.time", return_value=100.0):
+        result = await presence.online([1, 2, 3])
+    assert result == [1]
+    presence.datastore.get_presence.assert_called_once_with([1, 2, 3])
+
+
+@pytest.mark.asyncio
+async def test_online_in_room(presence):
+    """
+    The contents of the room are checked for presence.
+    """
+    presence.datastore.redis.smembers_asset = mock.AsyncMock(
+        return_value={"3", "1", "2"}
+    )
+    presence.online = mock.AsyncMock(return_value=[1])
+    result = await presence.online_in_room(123)
+    assert result == [1]
+    presence.datastore.redis.smembers_asset.assert_called_once_with(
+        "inventory:123"
+    )
+    presence.online.assert_called_once_with([1, 2, 3])
+
+
+@pytest.mark.asyncio
+async def test_start_stop(presence):
+    """
+    Starting schedules a task to send regular heartbeats, and stopping
+    cancels it.
+    """
+    presence.heartbeat = mock.AsyncMock()
+    presence.start()
+    await asyncio.sleep(0)
+    presence.heartbeat.assert_called_once_with()
+    await presence.stop()
+    assert presence.task is None
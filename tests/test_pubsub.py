@@ -4,10 +4,12 @@ Tests for the pub/sub message passing methods and handlers.
 Copyright (C) 2020 Nicholas H.Tollervey
 """
 import asyncio
+import json
 import pytest  # type: ignore
 from uuid import uuid4
 from unittest import mock
-from textsmith.pubsub import PubSub
+from asyncio_redis.exceptions import ConnectionLostError  # type: ignore
+from textsmith.pubsub import PubSub, CONNECTED, RECONNECTING, DEGRADED
 
 
 @pytest.fixture
@@ -16,6 +18,22 @@ def subscriber():
     mock_subscriber.subscribe = mock.AsyncMock()
     mock_subscriber.next_published = mock.AsyncMock()
     mock_subscriber.unsubscribe = mock.AsyncMock()
+    mock_subscriber.protocol = mock.MagicMock()
+    return mock_subscriber
+
+
+def idle_subscriber():
+    """
+    Return a mock subscriber whose next_published method never returns, as
+    though no messages are ever published.
+    """
+    mock_subscriber = mock.AsyncMock()
+
+    async def next_published():
+        await asyncio.Event().wait()
+
+    mock_subscriber.next_published.side_effect = next_published
+    mock_subscriber.protocol = mock.MagicMock()
     return mock_subscriber
 
 
@@ -26,18 +44,61 @@ def test_init(subscriber):
     * There is an empty dictionary for tracking user's message queues assigned
       to connected_users.
     * The subscriber object (used to subscribe to the different Redis
-      channels) is assigned to subsciber.
-    * The async.create_task is called once with the coroutine created by the
-      object's listen method.
+      channels) is assigned to the only shard.
+    * The async.create_task is called with the coroutine created by the
+      object's listen method, and for the watchdog.
     """
     with mock.patch("textsmith.pubsub.asyncio") as mock_async, mock.patch(
         "textsmith.pubsub.PubSub.listen"
     ) as mock_listen:
         ps = PubSub(subscriber)
         assert ps.connected_users == {}
-        assert ps.subscriber == subscriber
-        assert mock_async.create_task.call_count == 1
+        assert len(ps.shards) == 1
+        assert ps.shards[0].subscriber == subscriber
+        assert mock_async.create_task.call_count == 2
         assert mock_listen.call_count == 1
+        mock_listen.assert_called_once_with(0)
+
+
+def test_init_sharded():
+    """
+    Ensure that given several subscriber objects, each is assigned to its own
+    shard and has its own listener task.
+    """
+    subscribers = [mock.AsyncMock(), mock.AsyncMock(), mock.AsyncMock()]
+    with mock.patch("textsmith.pubsub.asyncio") as mock_async, mock.patch(
+        "textsmith.pubsub.PubSub.listen"
+    ) as mock_listen:
+        ps = PubSub(*subscribers)
+        assert [shard.subscriber for shard in ps.shards] == subscribers
+        assert [shard.index for shard in ps.shards] == [0, 1, 2]
+        assert mock_async.create_task.call_count == 4
+        assert mock_listen.call_args_list == [
+            mock.call(0),
+            mock.call(1),
+            mock.call(2),
+        ]
+
+
+def test_init_no_subscribers():
+    """
+    A PubSub instance without a subscriber is an error.
+    """
+    with pytest.raises(ValueError):
+        PubSub()
+
+
+@pytest.mark.asyncio
+async def test_shard_for():
+    """
+    User channels are hashed across the available shards by user ID.
+    """
+    subscribers = [idle_subscriber(), idle_subscriber(), idle_subscriber()]
+    ps = PubSub(*subscribers)
+    assert ps.shard_for(3) == ps.shards[0]
+    assert ps.shard_for(4) == ps.shards[1]
+    assert ps.shard_for(5) == ps.shards[2]
+    await ps.stop()
 
 
 @pytest.mark.asyncio
@@ -59,17 +120,110 @@ async def test_subscribe(subscriber):
         await ps.subscribe(user_id, connection_id)
         assert user_id in ps.connected_users
         assert isinstance(ps.connected_users[user_id], asyncio.Queue)
-        ps.subscriber.subscribe.assert_called_once_with(
+        subscriber.subscribe.assert_called_once_with(
             [
                 str(user_id),
             ]
         )
+        assert ps.shards[0].channels == {str(user_id)}
         mock_logger.msg.assert_called_once_with(
             "Subscribe.", user_id=user_id, connection_id=connection_id
         )
         await ps.stop()
 
 
+@pytest.mark.asyncio
+async def test_subscribe_batched():
+    """
+    If a burst of subscriptions arrives while a request to Redis is in flight,
+    the waiting channels are sent to Redis together as a single batch once the
+    in flight request completes.
+    """
+    subscriber = idle_subscriber()
+    ps = PubSub(subscriber)
+    release = asyncio.Event()
+
+    async def slow_subscribe(channels):
+        await release.wait()
+
+    subscriber.subscribe.side_effect = slow_subscribe
+    first = asyncio.create_task(ps.subscribe(1, str(uuid4())))
+    await asyncio.sleep(0)
+    burst = [
+        asyncio.create_task(ps.subscribe(user_id, str(uuid4())))
+        for user_id in range(2, 6)
+    ]
+    await asyncio.sleep(0)
+    release.set()
+    await asyncio.gather(first, *burst)
+    assert subscriber.subscribe.call_args_list == [
+        mock.call(["1"]),
+        mock.call(["2", "3", "4", "5"]),
+    ]
+    assert ps.shards[0].channels == {"1", "2", "3", "4", "5"}
+    assert ps.shards[0].busy is False
+    await ps.stop()
+
+
+@pytest.mark.asyncio
+async def test_subscribe_unsubscribe_ordered():
+    """
+    Requests waiting for an in flight batch are sent to Redis in the order
+    they were made. A user who unsubscribes and then subscribes again while
+    an unsubscribe is in flight ends up subscribed.
+    """
+    subscriber = idle_subscriber()
+    ps = PubSub(subscriber)
+    release = asyncio.Event()
+    calls = []
+
+    async def slow_unsubscribe(channels):
+        calls.append(("unsubscribe", channels))
+        await release.wait()
+
+    async def record_subscribe(channels):
+        calls.append(("subscribe", channels))
+
+    subscriber.unsubscribe.side_effect = slow_unsubscribe
+    subscriber.subscribe.side_effect = record_subscribe
+    await ps.subscribe(1, str(uuid4()))
+    await ps.subscribe(2, str(uuid4()))
+    in_flight = asyncio.create_task(ps.unsubscribe(2, str(uuid4())))
+    await asyncio.sleep(0)
+    again = asyncio.create_task(ps.unsubscribe(1, str(uuid4())))
+    await asyncio.sleep(0)
+    connection_id = str(uuid4())
+    queue = asyncio.create_task(ps.subscribe(1, connection_id))
+    await asyncio.sleep(0)
+    release.set()
+    await asyncio.gather(in_flight, again, queue)
+    assert calls == [
+        ("subscribe", ["1"]),
+        ("subscribe", ["2"]),
+        ("unsubscribe", ["2"]),
+        ("unsubscribe", ["1"]),
+        ("subscribe", ["1"]),
+    ]
+    assert ps.shards[0].channels == {"1"}
+    assert ps.shards[0].busy is False
+    await ps.stop()
+
+
+@pytest.mark.asyncio
+async def test_subscribe_batch_error(subscriber):
+    """
+    If the batched request to Redis fails, every caller waiting on the batch
+    receives the exception.
+    """
+    ps = PubSub(subscriber)
+    subscriber.subscribe.side_effect = ValueError("Boom")
+    with pytest.raises(ValueError):
+        await ps.subscribe(1, str(uuid4()))
+    assert ps.shards[0].channels == set()
+    assert ps.shards[0].busy is False
+    await ps.stop()
+
+
 @pytest.mark.asyncio
 async def test_unsubscribe(subscriber):
     """
@@ -90,7 +244,7 @@ async def test_unsubscribe(subscriber):
         ps.connected_users[user_id] = message_queue
         await ps.unsubscribe(user_id, connection_id)
         assert user_id not in ps.connected_users
-        ps.subscriber.unsubscribe.assert_called_once_with(
+        subscriber.unsubscribe.assert_called_once_with(
             [
                 str(user_id),
             ]
@@ -122,6 +276,10 @@ async def test_listen(subscriber):
         with pytest.raises(StopAsyncIteration):
             await ps.listen()
         assert ps.connected_users[user_id].qsize() == 1
+        queued = ps.connected_users[user_id].get_nowait()
+        assert queued["body"] == mock_message.value
+        assert queued["seq"] == 1
+        assert "receive" in queued["t"]
         assert mock_logger.msg.call_args_list[0] == mock.call(
             "Message.", user_id=user_id, value=mock_message.value
         )
@@ -166,7 +324,7 @@ async def test_get_message_that_exists(subscriber):
     await message_queue.put("Third message")
     ps = PubSub(subscriber)
     ps.connected_users[user_id] = message_queue
-    ps.listening = True
+    ps.shards[0].listening = True
     result = await ps.get_message(user_id)
     assert result == "First message"
     assert ps.connected_users[user_id].qsize() == 2
@@ -181,7 +339,7 @@ async def test_get_message_no_messages(subscriber):
     """
     user_id = 1
     ps = PubSub(subscriber)
-    ps.listening = True
+    ps.shards[0].listening = True
     result = await ps.get_message(user_id)
     assert result == ""
     await ps.stop()
@@ -195,7 +353,7 @@ async def test_get_message_no_such_queue(subscriber):
     """
     user_id = 1
     ps = PubSub(subscriber)
-    ps.listening = True
+    ps.shards[0].listening = True
     result = await ps.get_message(user_id)
     assert result == ""
     await ps.stop()
@@ -210,7 +368,309 @@ async def test_get_message_not_listening(subscriber):
     """
     user_id = 1
     ps = PubSub(subscriber)
-    ps.listening = False
+    ps.shards[0].listening = False
     with pytest.raises(ValueError):
         await ps.get_message(user_id)
     await ps.stop()
+
+
+@pytest.mark.asyncio
+async def test_get_message_shard_not_listening():
+    """
+    Listening is tracked per shard: if one shard stops listening, users of
+    the other shards still get their messages.
+    """
+    ps = PubSub(idle_subscriber(), idle_subscriber())
+    await asyncio.sleep(0)
+    assert ps.listening is True
+    broken = ps.shard_for(1)
+    healthy = next(shard for shard in ps.shards if shard is not broken)
+    user_id = next(i for i in range(2, 100) if ps.shard_for(i) is healthy)
+    broken.listening = False
+    assert ps.listening is False
+    assert ps.stats()["shards"][broken.index]["listening"] is False
+    with pytest.raises(ValueError):
+        await ps.get_message(1)
+    ps.connected_users[user_id] = asyncio.Queue()
+    await ps.connected_users[user_id].put({"body": "Hello"})
+    assert await ps.get_message(user_id) == {"body": "Hello"}
+    await ps.stop()
+
+
+@pytest.mark.asyncio
+async def test_stats():
+    """
+    Ensure the statistics are aggregated across the shards, with the details
+    for each shard also included.
+    """
+    subscribers = [idle_subscriber(), idle_subscriber()]
+    ps = PubSub(*subscribers)
+    await ps.subscribe(1, str(uuid4()))
+    await ps.subscribe(2, str(uuid4()))
+    await ps.subscribe(4, str(uuid4()))
+    await ps.connected_users[1].put({"body": "A message"})
+    ps.shards[0].messages = 3
+    ps.shards[1].messages = 1
+    result = ps.stats()
+    assert result["connected_users"] == 3
+    assert result["queued_messages"] == 1
+    assert result["channels"] == 3
+    assert result["messages"] == 4
+    assert result["shards"][0]["channels"] == 2
+    assert result["shards"][1]["channels"] == 1
+    assert result["shards"][1]["messages"] == 1
+    await ps.stop()
+
+
+@pytest.mark.asyncio
+async def test_listen_reconnects():
+    """
+    If the subscriber connection breaks and there's a way to reconnect, the
+    shard is given a new subscriber which is subscribed to the channels of the
+    shard's connected users. Listening continues via the new subscriber. The
+    broken connection is closed.
+    """
+    broken = mock.AsyncMock()
+    broken.protocol = mock.MagicMock()
+    broken.next_published.side_effect = ConnectionLostError(None)
+    replacement = idle_subscriber()
+    connect = mock.AsyncMock(return_value=replacement)
+    ps = PubSub(broken, connect=connect, backoff=0)
+    ps.connected_users[1] = asyncio.Queue()
+    ps.connected_users[2] = asyncio.Queue()
+    await asyncio.sleep(0.01)
+    assert ps.shards[0].subscriber == replacement
+    assert ps.shards[0].state == CONNECTED
+    assert ps.shards[0].reconnections == 1
+    assert ps.shards[0].channels == {"1", "2"}
+    replacement.subscribe.assert_called_once_with(["1", "2"])
+    broken.protocol.transport.close.assert_called_once_with()
+    assert ps.listening is True
+    await ps.stop()
+
+
+@pytest.mark.asyncio
+async def test_watch_reconnects():
+    """
+    A subscriber doesn't raise when its connection is lost, so the watchdog
+    checks the connection. A shard whose connection was lost has its broken
+    connection closed and is reconnected, and listening continues via the
+    new subscriber.
+    """
+    broken = idle_subscriber()
+    broken.protocol = mock.MagicMock()
+    broken.protocol.is_connected = True
+    replacement = idle_subscriber()
+    connect = mock.AsyncMock(return_value=replacement)
+    ps = PubSub(broken, connect=connect, backoff=0, check_interval=0)
+    ps.connected_users[1] = asyncio.Queue()
+    listener = ps.listeners[0]
+    await asyncio.sleep(0.01)
+    assert ps.shards[0].subscriber == broken
+    broken.protocol.is_connected = False
+    with mock.patch("textsmith.pubsub.logger"):
+        await asyncio.sleep(0.01)
+    assert listener.cancelled()
+    broken.protocol.transport.close.assert_called_once_with()
+    assert ps.shards[0].subscriber == replacement
+    assert ps.shards[0].state == CONNECTED
+    replacement.subscribe.assert_called_once_with(["1"])
+    assert not ps.listeners[0].done()
+    await ps.stop()
+
+
+@pytest.mark.asyncio
+async def test_watch_degraded():
+    """
+    A shard whose connection was lost, with no way to reconnect, is marked
+    as degraded.
+    """
+    broken = idle_subscriber()
+    broken.protocol = mock.MagicMock()
+    broken.protocol.is_connected = False
+    ps = PubSub(broken, check_interval=0)
+    with mock.patch("textsmith.pubsub.logger"):
+        await asyncio.sleep(0.01)
+    assert ps.state == DEGRADED
+    assert ps.listeners[0].cancelled()
+    assert ps.shards[0].listening is False
+    ps.connected_users[1] = asyncio.Queue()
+    with pytest.raises(ValueError):
+        await ps.get_message(1)
+    await ps.stop()
+
+
+@pytest.mark.asyncio
+async def test_reconnect_degraded():
+    """
+    Failed attempts to reconnect are retried. After enough consecutive failures
+    the shard is marked as degraded, and this is reflected in the overall state
+    of the PubSub instance until a reconnection succeeds.
+    """
+    replacement = idle_subscriber()
+    attempts = [
+        ConnectionLostError(None),
+        ConnectionLostError(None),
+        replacement,
+    ]
+    states = []
+
+    async def connect():
+        states.append(ps.state)
+        result = attempts.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    ps = PubSub(
+        idle_subscriber(), connect=connect, backoff=0, degraded_after=2
+    )
+    with mock.patch("textsmith.pubsub.logger"):
+        await ps.reconnect(ps.shards[0])
+    assert states == [RECONNECTING, RECONNECTING, DEGRADED]
+    assert ps.state == CONNECTED
+    assert ps.shards[0].subscriber == replacement
+    await ps.stop()
+
+
+@pytest.mark.asyncio
+async def test_reconnect_unsubscribes_leftovers():
+    """
+    Users who leave while the shard is resubscribing aren't unsubscribed via
+    Redis at the time, so their channels are unsubscribed before the shard
+    is CONNECTED again.
+    """
+    replacement = idle_subscriber()
+
+    async def subscribe(channels):
+        # User 2 leaves while the shard is resubscribing.
+        await ps.unsubscribe(2, str(uuid4()))
+
+    replacement.subscribe.side_effect = subscribe
+    ps = PubSub(
+        idle_subscriber(),
+        connect=mock.AsyncMock(return_value=replacement),
+        backoff=0,
+    )
+    ps.connected_users[1] = asyncio.Queue()
+    ps.connected_users[2] = asyncio.Queue()
+    with mock.patch("textsmith.pubsub.logger"):
+        await ps.reconnect(ps.shards[0])
+    replacement.subscribe.assert_called_once_with(["1", "2"])
+    replacement.unsubscribe.assert_called_once_with(["2"])
+    assert ps.shards[0].channels == {"1"}
+    assert ps.state == CONNECTED
+    await ps.stop()
+
+
+@pytest.mark.asyncio
+async def test_subscribe_while_reconnecting():
+    """
+    Subscriptions for a shard that is reconnecting are not sent to the broken
+    subscriber: they're picked up upon reconnection.
+    """
+    subscriber = idle_subscriber()
+    ps = PubSub(subscriber)
+    ps.shards[0].state = RECONNECTING
+    await ps.subscribe(1, str(uuid4()))
+    assert 1 in ps.connected_users
+    assert subscriber.subscribe.call_count == 0
+    await ps.stop()
+
+
+@pytest.mark.asyncio
+async def test_state():
+    """
+    The overall state is the worst state of any of the shards.
+    """
+    ps = PubSub(idle_subscriber(), idle_subscriber())
+    assert ps.state == CONNECTED
+    ps.shards[1].state = RECONNECTING
+    assert ps.state == RECONNECTING
+    ps.shards[0].state = DEGRADED
+    assert ps.state == DEGRADED
+    assert ps.stats()["state"] == DEGRADED
+    await ps.stop()
+
+
+@pytest.mark.asyncio
+async def test_get_messages_drains_queue():
+    """
+    All the messages currently queued for the user are returned together,
+    as they're sent.
+    """
+    ps = PubSub(idle_subscriber())
+    ps.shards[0].listening = True
+    message_queue = asyncio.Queue()
+    for i in range(3):
+        await message_queue.put({"body": f"Message {i}", "t": {}})
+    ps.connected_users[1] = message_queue
+    result = await ps.get_messages(1)
+    envelopes = [json.loads(m) for m in result]
+    assert all("send" in m["t"] for m in envelopes)
+    assert [m["body"] for m in envelopes] == [
+        "Message 0",
+        "Message 1",
+        "Message 2",
+    ]
+    assert message_queue.empty()
+    await ps.stop()
+
+
+@pytest.mark.asyncio
+async def test_get_messages_limits():
+    """
+    No more than max_count messages are returned, and no further messages are
+    returned once the size in bytes of the frame containing them (including
+    the delimiters) reaches max_size.
+    """
+    ps = PubSub(idle_subscriber())
+    ps.shards[0].listening = True
+    message_queue = asyncio.Queue()
+    for i in range(6):
+        await message_queue.put({"body": "12345", "t": {}})
+    ps.connected_users[1] = message_queue
+    with mock.patch("textsmith.envelope.time.time", return_value=1.5):
+        result = await ps.get_messages(1, max_count=2)
+        assert len(result) == 2
+        size = len(result[0].encode("utf-8"))
+        result = await ps.get_messages(1, max_size=size * 2 + 1)
+        assert len(result) == 2
+        result = await ps.get_messages(1, max_size=size)
+        assert len(result) == 1
+    assert message_queue.qsize() == 1
+    await ps.stop()
+
+
+@pytest.mark.asyncio
+async def test_get_messages_linger():
+    """
+    With a linger, messages arriving shortly after the first are included in
+    the result.
+    """
+    ps = PubSub(idle_subscriber())
+    ps.shards[0].listening = True
+    message_queue = asyncio.Queue()
+    await message_queue.put({"body": "First", "t": {}})
+    ps.connected_users[1] = message_queue
+
+    async def later():
+        await asyncio.sleep(0.01)
+        await message_queue.put({"body": "Second", "t": {}})
+
+    task = asyncio.create_task(later())
+    result = await ps.get_messages(1, linger=0.2)
+    await task
+    assert [json.loads(m)["body"] for m in result] == ["First", "Second"]
+    await ps.stop()
+
+
+@pytest.mark.asyncio
+async def test_get_messages_no_queue():
+    """
+    An empty list is returned if there is no message queue for the user.
+    """
+    ps = PubSub(idle_subscriber())
+    ps.shards[0].listening = True
+    assert await ps.get_messages(1) == []
+    await ps.stop()
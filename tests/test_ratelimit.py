@@ -0,0 +1,127 @@
+"""
+Tests for token bucket rate limiting.
+
+Copyright (C) 2020 Nicholas H.Tollervey
+"""
+import pytest  # type: ignore
+from unittest import mock
+from asyncio_redis.exceptions import ScriptKilledError  # type: ignore
+from textsmith.ratelimit import RateLimiter, parse_limit, TOKEN_BUCKET
+
+
+def test_parse_limit():
+    """
+    Limits are expressed as "rate:burst".
+    """
+    assert parse_limit("0.5:10") == (0.5, 10.0)
+
+
+def test_parse_limit_not_positive():
+    """
+    A rate or burst that isn't positive is rejected.
+    """
+    for value in ("0:10", "-1:10", "1:0"):
+        with pytest.raises(ValueError):
+            parse_limit(value)
+
+
+def test_bucket_key():
+    """
+    The key for a bucket matches a certain pattern: "ratelimit:name:id".
+    """
+    limiter = RateLimiter({})
+    assert limiter.bucket_key("command", 123) == "ratelimit:command:123"
+
+
+@pytest.mark.asyncio
+async def test_allow_unknown_limit():
+    """
+    Requests checked against an unknown limit are always allowed.
+    """
+    limiter = RateLimiter({})
+    assert await limiter.allow("foo", 1) is True
+
+
+@pytest.mark.asyncio
+async def test_allow_local():
+    """
+    In memory buckets allow a burst, then refill at the given rate.
+    """
+    limiter = RateLimiter({"command": (1.0, 2.0)})
+    with mock.patch("textsmith.ratelimit.time.monotonic", return_value=0.0):
+        assert await limiter.allow("command", 1) is True
+        assert await limiter.allow("command", 1) is True
+        assert await limiter.allow("command", 1) is False
+        # Other identities have their own bucket.
+        assert await limiter.allow("command", 2) is True
+    with mock.patch("textsmith.ratelimit.time.monotonic", return_value=1.5):
+        assert await limiter.allow("command", 1) is True
+        assert await limiter.allow("command", 1) is False
+
+
+@pytest.mark.asyncio
+async def test_allow_local_sweep():
+    """
+    In memory buckets that have refilled are removed every sweep_interval
+    seconds, while those still refilling are kept.
+    """
+    with mock.patch("textsmith.ratelimit.time.monotonic", return_value=0.0):
+        limiter = RateLimiter({"command": (1.0, 2.0)}, sweep_interval=10.0)
+        assert await limiter.allow("command", 1) is True
+    with mock.patch("textsmith.ratelimit.time.monotonic", return_value=9.0):
+        assert await limiter.allow("command", 2) is True
+        assert await limiter.allow("command", 2) is True
+    assert len(limiter.buckets) == 2
+    with mock.patch("textsmith.ratelimit.time.monotonic", return_value=10.0):
+        assert limiter.sweep(10.0) == 1
+        assert list(limiter.buckets) == ["ratelimit:command:2"]
+        # Bucket 2 is refilling, so it's still empty.
+        assert await limiter.allow("command", 2) is True
+        assert await limiter.allow("command", 2) is False
+    with mock.patch("textsmith.ratelimit.time.monotonic", return_value=20.0):
+        assert await limiter.allow("command", 3) is True
+    assert list(limiter.buckets) == ["ratelimit:command:3"]
+    assert limiter.swept == 20.0
+
+
+@pytest.mark.asyncio
+async def test_allow_redis():
+    """
+    With a Redis pool, the token bucket script is registered once and run
+    with the bucket's key, rate and burst.
+    """
+    mock_reply = mock.MagicMock()
+    mock_reply.return_value = mock.AsyncMock(side_effect=[1, 0])
+    mock_script = mock.MagicMock()
+    mock_script.run = mock.AsyncMock(return_value=mock_reply)
+    mock_redis = mock.MagicMock()
+    mock_redis.register_script = mock.AsyncMock(return_value=mock_script)
+    limiter = RateLimiter({"login_ip": (0.2, 5.0)}, mock_redis)
+    assert await limiter.allow("login_ip", "1.2.3.4") is True
+    assert await limiter.allow("login_ip", "1.2.3.4") is False
+    mock_redis.register_script.assert_called_once_with(TOKEN_BUCKET)
+    mock_script.run.assert_called_with(
+        keys=["ratelimit:login_ip:1.2.3.4"], args=["0.2", "5.0"]
+    )
+
+
+@pytest.mark.asyncio
+async def test_allow_redis_reload_script():
+    """
+    If the token bucket script is no longer cached by Redis (e.g. Redis was
+    restarted), it's registered again and run once more, rather than the
+    limit failing open.
+    """
+    mock_reply = mock.MagicMock()
+    mock_reply.return_value = mock.AsyncMock(return_value=0)
+    stale_script = mock.MagicMock()
+    stale_script.run = mock.AsyncMock(side_effect=ScriptKilledError())
+    mock_script = mock.MagicMock()
+    mock_script.run = mock.AsyncMock(return_value=mock_reply)
+    mock_redis = mock.MagicMock()
+    mock_redis.register_script = mock.AsyncMock(return_value=mock_script)
+    limiter = RateLimiter({"login_ip": (0.2, 5.0)}, mock_redis)
+    limiter.script = stale_script
+    assert await limiter.allow("login_ip", "1.2.3.4") is False
+    mock_redis.register_script.assert_called_once_with(TOKEN_BUCKET)
+    assert limiter.script == mock_script
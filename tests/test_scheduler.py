@@ -0,0 +1,121 @@
+"""
+Tests for the scheduling of commands sent by users.
+
+Copyright (C) 2020 Nicholas H.Tollervey
+"""
+import asyncio
+import pytest  # type: ignore
+import quart.flask_patch  # type: ignore # noqa
+from unittest import mock
+from textsmith.scheduler import Scheduler
+
+
+@pytest.fixture
+def parser():
+    mock_parser = mock.MagicMock()
+    mock_parser.eval = mock.AsyncMock()
+    return mock_parser
+
+
+@pytest.fixture
+def logic():
+    mock_logic = mock.MagicMock()
+    mock_logic.emit_to_user = mock.AsyncMock()
+    return mock_logic
+
+
+def test_init(parser, logic):
+    """
+    Ensure the scheduler is initialised with the expected state.
+    """
+    scheduler = Scheduler(parser, logic, 10, 5)
+    assert scheduler.parser == parser
+    assert scheduler.logic == logic
+    assert scheduler.concurrency == 10
+    assert scheduler.queue_limit == 5
+    assert scheduler.running == 0
+    assert scheduler.queues == {}
+    assert scheduler.workers == {}
+
+
+@pytest.mark.asyncio
+async def test_submit_in_order(parser, logic):
+    """
+    Commands from a user are evaluated in the order they were submitted, and
+    the user's worker stops once there are no more commands.
+    """
+    scheduler = Scheduler(parser, logic)
+    for i in range(3):
+        assert await scheduler.submit(1, "abc", f"command {i}") is True
+    worker = scheduler.workers[1]
+    await worker
+    assert parser.eval.call_args_list == [
+        mock.call(1, "abc", "command 0"),
+        mock.call(1, "abc", "command 1"),
+        mock.call(1, "abc", "command 2"),
+    ]
+    assert scheduler.queues == {}
+    assert scheduler.workers == {}
+
+
+@pytest.mark.asyncio
+async def test_users_in_parallel_with_limit(parser, logic):
+    """
+    Commands from different users are evaluated concurrently, up to the
+    concurrency limit.
+    """
+    release = asyncio.Event()
+    running = []
+
+    async def slow_eval(user_id, connection_id, message):
+        running.append(user_id)
+        await release.wait()
+
+    parser.eval.side_effect = slow_eval
+    scheduler = Scheduler(parser, logic, concurrency=2)
+    for user_id in range(3):
+        await scheduler.submit(user_id, "abc", "command")
+    await asyncio.sleep(0.01)
+    assert running == [0, 1]
+    assert scheduler.running == 2
+    assert scheduler.stats() == {"running": 2, "users": 3, "queued": 0}
+    release.set()
+    await asyncio.gather(*scheduler.workers.values())
+    assert running == [0, 1, 2]
+    assert scheduler.running == 0
+
+
+@pytest.mark.asyncio
+async def test_submit_queue_full(parser, logic):
+    """
+    If the user has too many commands waiting, the command is rejected and the
+    user is sent a polite system message.
+    """
+    scheduler = Scheduler(parser, logic, queue_limit=2)
+    assert await scheduler.submit(1, "abc", "one") is True
+    assert await scheduler.submit(1, "abc", "two") is True
+    assert await scheduler.submit(1, "abc", "three") is False
+    assert logic.emit_to_user.call_count == 1
+    user_id, message = logic.emit_to_user.call_args[0]
+    assert user_id == 1
+    assert message.startswith("<pre><code>Slow down!")
+    await scheduler.stop()
+
+
+@pytest.mark.asyncio
+async def test_stop(parser, logic):
+    """
+    Stopping cancels the workers.
+    """
+    release = asyncio.Event()
+
+    async def slow_eval(user_id, connection_id, message):
+        await release.wait()
+
+    parser.eval.side_effect = slow_eval
+    scheduler = Scheduler(parser, logic)
+    await scheduler.submit(1, "abc", "command")
+    await asyncio.sleep(0)
+    await scheduler.stop()
+    assert scheduler.workers == {}
+    assert scheduler.running == 0
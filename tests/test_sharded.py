@@ -0,0 +1,306 @@
+"""
+Tests for the DataStore that shards the world across several Redis nodes.
+
+Copyright (C) 2020 Nicholas H.Tollervey
+"""
+import asyncio
+import json
+import pytest  # type: ignore
+from unittest import mock
+from textsmith.sharded import ShardedDataStore, HashRing, hash_tag
+from textsmith import constants
+
+
+def resolved(value):
+    """
+    Return a future that has already resolved to the referenced value.
+    """
+    result = asyncio.get_running_loop().create_future()
+    result.set_result(value)
+    return result
+
+
+def transaction(hashes=None, strings=None):
+    """
+    Return a mock transaction whose reads return futures resolving to the
+    values in the referenced hashes and strings.
+    """
+    hashes = hashes or {}
+    strings = strings or {}
+    result = mock.AsyncMock()
+    result.hgetall_asdict.side_effect = lambda key: resolved(
+        hashes.get(key, {})
+    )
+    result.hget.side_effect = lambda key, attribute: resolved(
+        hashes.get(key, {}).get(attribute)
+    )
+    result.get.side_effect = lambda key: resolved(strings.get(key))
+    return result
+
+
+@pytest.fixture
+def datastore():
+    return ShardedDataStore({"a": mock.MagicMock(), "b": mock.MagicMock()})
+
+
+def ids_by_shard(datastore, count=2):
+    """
+    Return a dictionary of node names and count object ids stored on each.
+    """
+    result = {name: [] for name in datastore.nodes}
+    object_id = 0
+    while any(len(ids) < count for ids in result.values()):
+        object_id += 1
+        ids = result[datastore.shard(object_id)]
+        if len(ids) < count:
+            ids.append(object_id)
+    return result
+
+
+def test_hash_tag():
+    """
+    The hash tag is the text in the first pair of braces, or the whole key.
+    """
+    assert hash_tag("{123}") == "123"
+    assert hash_tag("inventory:{123}") == "123"
+    assert hash_tag("location:{1}:{2}") == "1"
+    assert hash_tag("user:foo@bar.com") == "user:foo@bar.com"
+    assert hash_tag("a{}b") == "a{}b"
+    assert hash_tag("a{b") == "a{b"
+
+
+def test_hash_ring():
+    """
+    Tags are spread across all the nodes, always to the same node. Adding a
+    node only moves tags to the new node. A ring needs nodes.
+    """
+    ring = HashRing(["a", "b"])
+    tags = [str(i) for i in range(1000)]
+    placed = {tag: ring.get(tag) for tag in tags}
+    assert placed == {tag: HashRing(["b", "a"]).get(tag) for tag in tags}
+    assert 300 < list(placed.values()).count("a") < 700
+    bigger = HashRing(["a", "b", "c"])
+    moved = [tag for tag in tags if bigger.get(tag) != placed[tag]]
+    assert moved
+    assert all(bigger.get(tag) == "c" for tag in moved)
+    with pytest.raises(ValueError):
+        HashRing([])
+
+
+def test_init(datastore):
+    """
+    The first node is the home node. Every key for an object contains the
+    object's id as a hash tag, so they're all stored on the same node.
+    """
+    assert datastore.redis == datastore.nodes["a"]
+    assert datastore.ids.redis == datastore.nodes["a"]
+    assert datastore.object_key(123) == "{123}"
+    assert datastore.inventory_key(123) == "inventory:{123}"
+    assert datastore.location_key(123) == "location:{123}"
+    assert datastore.user_key("foo@bar.com") == "user:foo@bar.com"
+    for object_id in range(100):
+        assert datastore.shard(object_id) == datastore.ring.get(
+            str(object_id)
+        )
+        assert datastore.node(object_id) == datastore.nodes[
+            datastore.shard(object_id)
+        ]
+    with pytest.raises(ValueError):
+        ShardedDataStore({})
+
+
+@pytest.mark.asyncio
+async def test_add_objects(datastore):
+    """
+    New objects are written with one transaction on each node. Objects
+    without attributes aren't written.
+    """
+    placed = ids_by_shard(datastore, 1)
+    object_ids = [placed["a"][0], placed["b"][0]]
+    datastore.ids.allocate = mock.AsyncMock(return_value=object_ids)
+    transactions = {name: mock.AsyncMock() for name in datastore.nodes}
+    for name, node in datastore.nodes.items():
+        node.multi = mock.AsyncMock(return_value=transactions[name])
+    result = await datastore.add_objects({"name": "a"}, {"name": "b"})
+    assert result == object_ids
+    transactions["a"].hmset.assert_called_once_with(
+        datastore.object_key(object_ids[0]), {"name": '"a"'}
+    )
+    transactions["b"].hmset.assert_called_once_with(
+        datastore.object_key(object_ids[1]), {"name": '"b"'}
+    )
+    assert await datastore.add_objects() == []
+    datastore.ids.allocate = mock.AsyncMock(return_value=[object_ids[0]])
+    transactions["a"].reset_mock()
+    await datastore.add_objects({})
+    assert transactions["a"].hmset.call_count == 0
+
+
+@pytest.mark.asyncio
+async def test_get_objects(datastore):
+    """
+    Objects are read from every node in parallel and merged in the order
+    requested. Deleted objects are ignored.
+    """
+    placed = ids_by_shard(datastore)
+    a1, a2 = placed["a"]
+    b1, b2 = placed["b"]
+    datastore.nodes["a"].multi = mock.AsyncMock(
+        return_value=transaction(
+            hashes={
+                datastore.object_key(a1): {"name": '"a1"'},
+                datastore.object_key(a2): {constants.IS_DELETED: "true"},
+            }
+        )
+    )
+    datastore.nodes["b"].multi = mock.AsyncMock(
+        return_value=transaction(
+            hashes={datastore.object_key(b1): {"name": '"b1"'}}
+        )
+    )
+    result = await datastore.get_objects([b1, a2, a1, b2])
+    assert list(result) == [b1, a1, b2]
+    assert result[a1] == {"id": a1, "name": "a1"}
+    assert result[b1] == {"id": b1, "name": "b1"}
+    assert result[b2] == {"id": b2}
+
+
+@pytest.mark.asyncio
+async def test_attributes(datastore):
+    """
+    Single attributes are read from, and deleted on, the object's node.
+    Batches of attributes are read from every node in parallel.
+    """
+    placed = ids_by_shard(datastore, 1)
+    a, b = placed["a"][0], placed["b"][0]
+    node_a, node_b = datastore.nodes["a"], datastore.nodes["b"]
+    node_a.hget = mock.AsyncMock(return_value='"value"')
+    assert await datastore.get_attribute(a, "attr") == "value"
+    node_a.hget.assert_called_once_with(datastore.object_key(a), "attr")
+    node_b.hget = mock.AsyncMock(return_value=None)
+    with pytest.raises(KeyError):
+        await datastore.get_attribute(b, "attr")
+    node_a.multi = mock.AsyncMock(
+        return_value=transaction(
+            hashes={datastore.object_key(a): {"x": "1"}}
+        )
+    )
+    node_b.multi = mock.AsyncMock(
+        return_value=transaction(
+            hashes={datastore.object_key(b): {"y": "2"}}
+        )
+    )
+    result = await datastore.get_attributes([(a, "x"), (b, "y"), (b, "z")])
+    assert result == {(a, "x"): 1, (b, "y"): 2}
+    node_b.hdel = mock.AsyncMock(return_value=1)
+    assert await datastore.delete_attributes(b, ["y"]) == 1
+    node_b.hdel.assert_called_once_with(datastore.object_key(b), ["y"])
+    node_b.hmset = mock.AsyncMock()
+    await datastore.annotate_object(b, y=3)
+    node_b.hmset.assert_called_once_with(datastore.object_key(b), {"y": "3"})
+
+
+@pytest.mark.asyncio
+async def test_set_container(datastore):
+    """
+    Moving an object adds it to the new container's inventory, swaps its
+    location and then removes it from the old container's inventory, each on
+    the right node. The old container is returned.
+    """
+    placed = ids_by_shard(datastore, 1)
+    object_id, container_id = placed["a"][0], placed["b"][0]
+    old_id = placed["a"][0] + 1000
+    calls = []
+    for name, node in datastore.nodes.items():
+        node.sadd = mock.AsyncMock(
+            side_effect=lambda *args, name=name: calls.append(
+                (name, "sadd") + args
+            )
+        )
+        node.srem = mock.AsyncMock(
+            side_effect=lambda *args, name=name: calls.append(
+                (name, "srem") + args
+            )
+        )
+    location_key = datastore.location_key(object_id)
+    mock_transaction = transaction(strings={location_key: str(old_id)})
+    mock_transaction.exec.side_effect = lambda: calls.append(("a", "move"))
+    datastore.nodes["a"].multi = mock.AsyncMock(return_value=mock_transaction)
+    result = await datastore.set_container(object_id, container_id)
+    assert result == old_id
+    assert calls == [
+        (
+            "b",
+            "sadd",
+            datastore.inventory_key(container_id),
+            [str(object_id)],
+        ),
+        ("a", "move"),
+        (
+            datastore.shard(old_id),
+            "srem",
+            datastore.inventory_key(old_id),
+            [str(object_id)],
+        ),
+    ]
+    mock_transaction.set.assert_called_once_with(
+        location_key, json.dumps(container_id)
+    )
+    # Taking the object out of any container.
+    calls.clear()
+    mock_transaction = transaction()
+    datastore.nodes["a"].multi = mock.AsyncMock(return_value=mock_transaction)
+    assert await datastore.set_container(object_id, -1) is None
+    mock_transaction.delete.assert_called_once_with([location_key])
+    assert calls == []
+
+
+@pytest.mark.asyncio
+async def test_get_contents(datastore):
+    """
+    The contents of an object are read from every node, ignoring inventory
+    entries for objects that have moved elsewhere.
+    """
+    placed = ids_by_shard(datastore)
+    room_id, here_id = placed["a"]
+    gone_id, other_id = placed["b"]
+    datastore.nodes["a"].smembers_asset = mock.AsyncMock(
+        return_value={str(here_id), str(gone_id), str(other_id)}
+    )
+    datastore.nodes["a"].multi = mock.AsyncMock(
+        return_value=transaction(
+            hashes={datastore.object_key(here_id): {"name": '"here"'}},
+            strings={datastore.location_key(here_id): str(room_id)},
+        )
+    )
+    datastore.nodes["b"].multi = mock.AsyncMock(
+        return_value=transaction(
+            hashes={datastore.object_key(other_id): {"name": '"other"'}},
+            strings={
+                datastore.location_key(gone_id): "999",
+                datastore.location_key(other_id): str(room_id),
+            },
+        )
+    )
+    result = await datastore.get_contents(room_id)
+    assert result == {
+        here_id: {"id": here_id, "name": "here"},
+        other_id: {"id": other_id, "name": "other"},
+    }
+    datastore.nodes["a"].smembers_asset.assert_called_once_with(
+        datastore.inventory_key(room_id)
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_location(datastore):
+    """
+    An object's location is read from the object's node.
+    """
+    object_id = ids_by_shard(datastore, 1)["b"][0]
+    datastore.nodes["b"].get = mock.AsyncMock(side_effect=["12", None])
+    assert await datastore.get_location(object_id) == 12
+    assert await datastore.get_location(object_id) is None
+    datastore.nodes["b"].get.assert_called_with(
+        datastore.location_key(object_id)
+    )
@@ -0,0 +1,123 @@
+"""
+Tests for tracing the stages of evaluating commands.
+
+Copyright (C) 2020 Nicholas H.Tollervey
+"""
+import asyncio
+import pytest  # type: ignore
+from unittest import mock
+from textsmith import trace
+
+
+@pytest.fixture(autouse=True)
+def settings():
+    """
+    Restore the default settings, and make sure no trace is left in the
+    context, after each test.
+    """
+    token = trace.current_trace.set(None)
+    yield
+    trace.current_trace.reset(token)
+    trace.sample_rate = 0.0
+    trace.slow_threshold = 0.0
+
+
+def test_configure():
+    """
+    The sample rate and slow threshold are set.
+    """
+    trace.configure(0.5, 2.0)
+    assert trace.sample_rate == 0.5
+    assert trace.slow_threshold == 2.0
+
+
+def test_start_not_traced():
+    """
+    Commands that aren't sampled aren't traced if slow commands aren't being
+    traced. Spans and finishing do nothing.
+    """
+    trace.configure(0.0, 0.0)
+    assert trace.start("abc") is None
+    assert trace.current_trace.get() is None
+    with trace.span("nothing"):
+        pass
+    with mock.patch("textsmith.trace.logger.msg") as mock_msg:
+        trace.finish()
+    assert mock_msg.call_count == 0
+
+
+def test_sampled_trace():
+    """
+    A sampled command's spans are added together by name, and the summary
+    is logged when the command finishes, along with the given fields.
+    """
+    trace.configure(1.0, 0.0)
+    result = trace.start("abc", user_id=1)
+    assert result.sampled is True
+    assert trace.current_trace.get() == result
+    with mock.patch("textsmith.trace.time.monotonic", side_effect=[1, 2]):
+        with trace.span("datastore.get_objects"):
+            pass
+    with mock.patch("textsmith.trace.time.monotonic", side_effect=[3, 3.5]):
+        with trace.span("datastore.get_objects"):
+            pass
+    with pytest.raises(ValueError):
+        with trace.span("verb.look"):
+            raise ValueError("Boom")
+    with mock.patch("textsmith.trace.logger.msg") as mock_msg:
+        trace.finish()
+    assert trace.current_trace.get() is None
+    summary = mock_msg.call_args.kwargs
+    assert mock_msg.call_args.args == ("Trace.",)
+    assert summary["message_id"] == "abc"
+    assert summary["user_id"] == 1
+    assert summary["slow"] is False
+    assert summary["spans"]["datastore.get_objects"] == {
+        "count": 2,
+        "duration": 1.5,
+    }
+    assert summary["spans"]["verb.look"]["count"] == 1
+
+
+def test_slow_trace():
+    """
+    If slow commands are traced, every command is traced, but only those
+    that take longer than the threshold are logged.
+    """
+    trace.configure(0.0, 1.0)
+    result = trace.start("abc")
+    assert result.sampled is False
+    with mock.patch("textsmith.trace.logger.msg") as mock_msg:
+        trace.finish()
+    assert mock_msg.call_count == 0
+    result = trace.start("def")
+    result.started -= 2
+    with mock.patch("textsmith.trace.logger.msg") as mock_msg:
+        trace.finish()
+    assert mock_msg.call_args.kwargs["slow"] is True
+    assert mock_msg.call_args.kwargs["message_id"] == "def"
+
+
+@pytest.mark.asyncio
+async def test_instrument():
+    """
+    Public coroutine methods of an instrumented object are recorded as spans,
+    including those run in tasks started within the traced context.
+    """
+
+    class Thing:
+        async def work(self):
+            return 1
+
+        async def _private(self):
+            return 2
+
+    thing = Thing()
+    trace.instrument(thing, "thing")
+    trace.configure(1.0, 0.0)
+    result = trace.start("abc")
+    assert await thing.work() == 1
+    await asyncio.gather(thing.work(), thing.work())
+    assert await thing._private() == 2
+    assert result.spans["thing.work"][0] == 3
+    assert list(result.spans) == ["thing.work"]
@@ -8,10 +8,10 @@ import pytest  # type: ignore
 import quart.flask_patch  # type: ignore # noqa
 from unittest import mock
 from uuid import uuid4
-from textsmith.verbs import Verbs, UnknownVerb
+from textsmith.verbs import Verbs, UnknownVerb, COMMANDS
 from textsmith.logic import Logic
 from textsmith.datastore import DataStore
-from textsmith import constants
+from textsmith import constants, trace
 
 
 EMAIL_HOST = "email.host.com"
@@ -68,6 +68,7 @@ def test_init(logic):
     assert verbs.logic == logic
     assert isinstance(verbs.languages, list)
     assert isinstance(verbs._VERBS, dict)
+    assert verbs._dispatch["en"]["scream"] == verbs._shout
 
 
 @pytest.mark.asyncio
@@ -94,6 +95,100 @@ async def test_call(user_id, connection_id, message_id, message):
             await verbs(user_id, connection_id, message_id, "fooooo", message)
 
 
+@pytest.mark.asyncio
+async def test_call_traced(verbs, user_id, connection_id, message_id, message):
+    """
+    Calls to verbs are recorded as spans of the current trace, and counted,
+    named after the verb's handler.
+    """
+    handler = mock.AsyncMock()
+    handler.__name__ = "_say"
+    verbs._dispatch["en"]["say"] = handler
+    counted = COMMANDS.labels("say").value
+    current = trace.Trace(message_id, True)
+    token = trace.current_trace.set(current)
+    try:
+        await verbs(user_id, connection_id, message_id, "say", message)
+    finally:
+        trace.current_trace.reset(token)
+    assert current.spans["verb.say"][0] == 1
+    assert COMMANDS.labels("say").value == counted + 1
+
+
+@pytest.mark.asyncio
+async def test_call_abbreviation(
+    logic, user_id, connection_id, message_id, message
+):
+    """
+    A verb may be abbreviated to any prefix that refers to only one handler.
+    Ambiguous prefixes are unknown verbs.
+    """
+    mock_shout = mock.AsyncMock()
+    with mock.patch("textsmith.verbs.Verbs._shout", mock_shout):
+        verbs = Verbs(logic)
+        await verbs(user_id, connection_id, message_id, "SH", message)
+        verbs._shout.assert_called_once_with(
+            user_id, connection_id, message_id, message
+        )
+        with pytest.raises(UnknownVerb):
+            await verbs(user_id, connection_id, message_id, "s", message)
+
+
+def test_prefix_table(verbs):
+    """
+    The unique-prefix table contains only those prefixes that identify a
+    single handler. Different spellings of the same verb don't make a prefix
+    ambiguous.
+    """
+    prefixes = verbs._prefixes["en"]
+    assert prefixes["sh"] == verbs._shout
+    assert prefixes["sc"] == verbs._shout
+    assert prefixes["sa"] == verbs._say
+    assert prefixes["t"] == verbs._tell
+    assert prefixes["e"] == verbs._emote
+    assert "s" not in prefixes
+    # Full spellings live in the dispatch table.
+    assert "say" not in prefixes
+    assert verbs._dispatch["en"]["holler"] == verbs._shout
+
+
+@pytest.mark.asyncio
+async def test_register(verbs, user_id, connection_id, message_id, message):
+    """
+    A new verb may be registered and is immediately available by its
+    spellings and by its unique abbreviations. Prefixes it shares with
+    existing verbs become ambiguous.
+    """
+    handler = mock.AsyncMock()
+    verbs.register(["Look", "examine"], handler)
+    assert verbs._VERBS["en"][("look", "examine")] == handler
+    await verbs(user_id, connection_id, message_id, "look", message)
+    handler.assert_called_once_with(
+        user_id, connection_id, message_id, message
+    )
+    handler.reset_mock()
+    await verbs(user_id, connection_id, message_id, "ex", message)
+    handler.assert_called_once_with(
+        user_id, connection_id, message_id, message
+    )
+    # "e" used to mean emote.
+    assert "e" not in verbs._prefixes["en"]
+
+
+def test_register_conflict(verbs):
+    """
+    A spelling already used by a different verb cannot be registered again.
+    Neither can a verb without any spellings.
+    """
+    with pytest.raises(ValueError):
+        verbs.register(["say"], mock.AsyncMock())
+    with pytest.raises(ValueError):
+        verbs.register([], mock.AsyncMock())
+    # Re-registering the same handler is fine.
+    verbs.register(["say", "speak"], verbs._say)
+    assert verbs._dispatch["en"]["speak"] == verbs._say
+
+
 @pytest.mark.asyncio
 async def test_say(
     verbs, user_id, room_id, connection_id, message_id, message
@@ -0,0 +1,58 @@
+"""
+Tests for the detection of code that blocks the event loop.
+
+Copyright (C) 2020 Nicholas H.Tollervey
+"""
+import asyncio
+import threading
+import time
+import pytest  # type: ignore
+from unittest import mock
+from textsmith.metrics import LoopMonitor, Registry
+from textsmith.watchdog import Watchdog, STALLS
+
+
+@pytest.fixture
+def monitor():
+    return LoopMonitor(Registry().histogram("lag_seconds", "Lag."), 0.01)
+
+
+def test_check(monitor):
+    """
+    A stall is logged, once, with a stack sample of the event loop's thread.
+    A monitor that woke up recently isn't stalled.
+    """
+    watchdog = Watchdog(monitor, threshold=0.1)
+    watchdog.thread_id = threading.get_ident()
+    assert watchdog.check() is None
+    monitor.beat = time.monotonic() - 1
+    stalls = STALLS.value
+    with mock.patch("textsmith.watchdog.logger.msg") as mock_log:
+        assert watchdog.check() >= 0.9
+        assert watchdog.check() is None
+    assert STALLS.value == stalls + 1
+    mock_log.assert_called_once()
+    assert mock_log.call_args[0][0] == "Event loop stalled."
+    assert "test_check" in mock_log.call_args[1]["stack"]
+
+
+@pytest.mark.asyncio
+async def test_stall(monitor):
+    """
+    A watchdog started on the event loop reports code that blocks the loop,
+    along with the task that was running, until it's stopped.
+    """
+    watchdog = Watchdog(monitor, threshold=0.05)
+    monitor.start()
+    await asyncio.sleep(0.02)
+    with mock.patch("textsmith.watchdog.logger.msg") as mock_log:
+        watchdog.start()
+        time.sleep(0.2)  # Block the event loop.
+        await asyncio.sleep(0.02)
+        watchdog.stop()
+    await monitor.stop()
+    assert watchdog.thread is None
+    assert mock_log.call_count == 1
+    details = mock_log.call_args[1]
+    assert "test_stall" in details["stack"]
+    assert "test_stall" in details["task"]
@@ -0,0 +1,132 @@
+"""
+Tests for the launcher of several worker processes.
+
+Copyright (C) 2020 Nicholas H.Tollervey
+"""
+import os
+import socket
+from unittest import mock
+from textsmith.workers import Supervisor, bind_socket, run_worker
+
+
+def test_bind_socket():
+    """
+    Several sockets may be bound to the same address, so each worker can
+    listen on its own socket.
+    """
+    first = bind_socket("127.0.0.1:0")
+    try:
+        port = first.getsockname()[1]
+        second = bind_socket(f"127.0.0.1:{port}")
+        assert second.getsockname() == first.getsockname()
+        assert second.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT)
+        second.close()
+    finally:
+        first.close()
+
+
+def test_supervisor():
+    """
+    The supervisor starts each worker, restarts workers that have exited
+    and, when stopped, terminates the workers and removes the directory of
+    shared metrics.
+    """
+    context = mock.MagicMock()
+    context.Process.side_effect = lambda **kwargs: mock.MagicMock()
+    supervisor = Supervisor(2, "127.0.0.1:0", grace=1.0, context=context)
+    assert os.path.isdir(supervisor.metrics_dir)
+    supervisor.start()
+    assert context.Process.call_count == 2
+    kwargs = context.Process.call_args[1]
+    assert kwargs["target"] == run_worker
+    assert kwargs["args"] == (1, "127.0.0.1:0", supervisor.metrics_dir, 1.0)
+    supervisor.processes[0].is_alive.return_value = True
+    supervisor.processes[1].is_alive.return_value = False
+    assert supervisor.check() == []
+    assert supervisor.check() == []
+    assert 1 in supervisor.restarts
+    supervisor.restarts[1] = 0.0
+    assert supervisor.check() == [1]
+    assert context.Process.call_count == 3
+    process = supervisor.processes[0]
+    process.is_alive.side_effect = [True, False]
+    supervisor.stop()
+    process.terminate.assert_called_once_with()
+    process.join.assert_called_once_with(11.0)
+    assert supervisor.stopped.is_set()
+    assert supervisor.processes == {}
+    assert not os.path.exists(supervisor.metrics_dir)
+
+
+def test_run():
+    """
+    Workers are checked every interval until the supervisor is stopped.
+    """
+    supervisor = Supervisor(1, "127.0.0.1:0", context=mock.MagicMock())
+    supervisor.stopped = mock.MagicMock()
+    supervisor.stopped.wait.side_effect = [False, False, True]
+    supervisor.check = mock.MagicMock()
+    supervisor.run(0.5)
+    assert supervisor.check.call_count == 2
+    supervisor.stopped.wait.assert_called_with(0.5)
+    os.rmdir(supervisor.metrics_dir)
+
+
+def test_check_backoff():
+    """
+    A worker that keeps exiting soon after it starts is restarted after an
+    exponentially increasing delay. A worker that ran for a while before
+    exiting starts again with the shortest delay.
+    """
+    context = mock.MagicMock()
+    context.Process.side_effect = lambda **kwargs: mock.MagicMock()
+    supervisor = Supervisor(
+        1,
+        "127.0.0.1:0",
+        context=context,
+        backoff=1.0,
+        max_backoff=3.0,
+        stable=10.0,
+    )
+    clock = mock.MagicMock(return_value=0.0)
+    with mock.patch("textsmith.workers.time.monotonic", clock):
+        supervisor.start_worker(0)
+        delays = []
+        for _ in range(3):
+            supervisor.processes[0].is_alive.return_value = False
+            assert supervisor.check() == []
+            delays.append(supervisor.restarts[0] - clock.return_value)
+            clock.return_value = supervisor.restarts[0]
+            assert supervisor.check() == [0]
+        assert delays == [1.0, 2.0, 3.0]
+        clock.return_value += 10.0
+        supervisor.processes[0].is_alive.return_value = False
+        supervisor.check()
+        assert supervisor.failures[0] == 1
+        assert supervisor.restarts[0] == clock.return_value + 1.0
+    os.rmdir(supervisor.metrics_dir)
+
+
+def test_check_gives_up():
+    """
+    After max_failures consecutive failures of a worker, the supervisor
+    gives up and is stopped.
+    """
+    context = mock.MagicMock()
+    context.Process.side_effect = lambda **kwargs: mock.MagicMock()
+    supervisor = Supervisor(
+        1, "127.0.0.1:0", context=context, backoff=0.0, max_failures=2
+    )
+    supervisor.start_worker(0)
+    for _ in range(2):
+        supervisor.processes[0].is_alive.return_value = False
+        supervisor.check()
+        assert supervisor.check() == [0]
+        assert supervisor.failed is False
+    supervisor.processes[0].is_alive.return_value = False
+    with mock.patch("textsmith.workers.logger") as mock_logger:
+        assert supervisor.check() == []
+    mock_logger.msg.assert_called_with("Worker keeps failing.", worker=0)
+    assert supervisor.failed is True
+    assert supervisor.stopped.is_set()
+    supervisor.stop()
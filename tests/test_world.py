@@ -0,0 +1,261 @@
+"""
+Tests for exporting and importing worlds.
+
+Copyright (C) 2020 Nicholas H.Tollervey
+"""
+import asyncio
+import io
+import json
+import pytest  # type: ignore
+from unittest import mock
+from textsmith.datastore import DataStore
+from textsmith import world
+
+
+@pytest.fixture
+def datastore(mocker):
+    return DataStore(mocker.MagicMock())
+
+
+def cursor(*items):
+    """
+    Return a mock cursor that yields the referenced items then None.
+    """
+    result = mock.MagicMock()
+    result.fetchone = mock.AsyncMock(side_effect=list(items) + [None])
+    return result
+
+
+def transaction_returning(values):
+    """
+    Return a mock transaction whose get method returns futures resolving to
+    the value associated with each key.
+    """
+
+    async def get(key):
+        result = asyncio.get_running_loop().create_future()
+        result.set_result(values[key])
+        return result
+
+    mock_transaction = mock.AsyncMock()
+    mock_transaction.get.side_effect = get
+    return mock_transaction
+
+
+def test_key_type(datastore):
+    """
+    Keys are exported as the expected type of record, and keys that aren't
+    part of the world are ignored.
+    """
+    assert world.key_type(datastore, "123") == "hash"
+    assert world.key_type(datastore, "user:foo@bar.com") == "hash"
+    assert world.key_type(datastore, "inventory:123") == "set"
+    assert world.key_type(datastore, "lastseen") == "zset"
+    assert world.key_type(datastore, "location:123") == "string"
+    assert world.key_type(datastore, "token:abc") == "string"
+    assert world.key_type(datastore, "lastseen:123") == "string"
+    assert world.key_type(datastore, "object_counter") == "string"
+    assert world.key_type(datastore, "presence") is None
+    assert world.key_type(datastore, "outbox") is None
+    assert world.key_type(datastore, "ratelimit:command:1") is None
+
+
+def test_progress():
+    """
+    Records are counted and the throughput is logged every interval.
+    """
+    progress = world.Progress("Test", 10)
+    progress.log = mock.MagicMock()
+    with mock.patch("textsmith.world.time.monotonic", return_value=5.0):
+        progress.start = progress.logged = 0.0
+        progress.add(3)
+    assert progress.records == 3
+    assert progress.log.call_count == 0
+    with mock.patch("textsmith.world.time.monotonic", return_value=11.0):
+        progress.add(2)
+    assert progress.records == 5
+    progress.log.assert_called_once_with("progress")
+
+
+@pytest.mark.asyncio
+async def test_export_collection(datastore):
+    """
+    Hashes, sets and sorted sets are scanned and written in chunks.
+    """
+    output = io.StringIO()
+    datastore.redis.hscan = mock.AsyncMock(
+        return_value=cursor({"a": "1"}, {"b": "2"}, {"c": "3"})
+    )
+    datastore.redis.sscan = mock.AsyncMock(return_value=cursor("1", "2"))
+    result = await world.export_collection(datastore, "hash", "1", output, 2)
+    assert result == 2
+    assert await world.export_collection(datastore, "set", "s", output, 2) == 1
+    datastore.redis.hscan.assert_called_once_with("1")
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert records == [
+        {"type": "hash", "key": "1", "value": {"a": "1", "b": "2"}},
+        {"type": "hash", "key": "1", "value": {"c": "3"}},
+        {"type": "set", "key": "s", "value": ["1", "2"]},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_export_world(datastore):
+    """
+    Every key in the world is found with SCAN and written as a record.
+    String values are fetched in batches. Keys that aren't part of the world,
+    or have been deleted since they were found, are skipped. The object
+    counter is written last, once the scan is complete.
+    """
+    output = io.StringIO()
+    datastore.redis.scan = mock.AsyncMock(
+        return_value=cursor(
+            "location:1",
+            "presence",
+            "object_counter",
+            "1",
+            "token:abc",
+            "location:2",
+        )
+    )
+    datastore.redis.multi = mock.AsyncMock(
+        side_effect=[
+            transaction_returning({"location:1": "2", "token:abc": "x"}),
+            transaction_returning({"location:2": None}),
+            transaction_returning({"object_counter": "7"}),
+        ]
+    )
+    datastore.redis.hscan = mock.AsyncMock(
+        return_value=cursor({"name": '"room"'})
+    )
+    result = await world.export_world(datastore, output, 2)
+    assert result == 4
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert records == [
+        {"type": "hash", "key": "1", "value": {"name": '"room"'}},
+        {"type": "string", "key": "location:1", "value": "2"},
+        {"type": "string", "key": "token:abc", "value": "x"},
+        {"type": "string", "key": "object_counter", "value": "7"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_import_batch(datastore):
+    """
+    Each type of record is written with the expected command, in a single
+    transaction.
+    """
+    mock_transaction = mock.AsyncMock()
+    datastore.redis.multi = mock.AsyncMock(return_value=mock_transaction)
+    await world.import_batch(
+        datastore,
+        [
+            {"type": "hash", "key": "1", "value": {"a": "1"}},
+            {"type": "set", "key": "s", "value": ["1"]},
+            {"type": "zset", "key": "z", "value": {"1": 2.0}},
+            {"type": "string", "key": "k", "value": "v"},
+        ],
+    )
+    mock_transaction.hmset.assert_called_once_with("1", {"a": "1"})
+    mock_transaction.sadd.assert_called_once_with("s", ["1"])
+    mock_transaction.zadd.assert_called_once_with("z", {"1": 2.0})
+    mock_transaction.set.assert_called_once_with("k", "v")
+    mock_transaction.exec.assert_called_once_with()
+
+
+@pytest.mark.asyncio
+async def test_import_batch_counter(datastore):
+    """
+    The object counter isn't simply overwritten: a script on the Redis
+    server only ever increases it, after the rest of the batch is written.
+    The script is registered if it wasn't given.
+    """
+    mock_transaction = mock.AsyncMock()
+    datastore.redis.multi = mock.AsyncMock(return_value=mock_transaction)
+    mock_script = mock.MagicMock()
+    mock_script.run = mock.AsyncMock()
+    datastore.redis.register_script = mock.AsyncMock(return_value=mock_script)
+    await world.import_batch(
+        datastore,
+        [
+            {"type": "string", "key": "k", "value": "v"},
+            {"type": "string", "key": "object_counter", "value": "7"},
+        ],
+    )
+    mock_transaction.set.assert_called_once_with("k", "v")
+    datastore.redis.register_script.assert_called_once_with(world.SET_MAX)
+    mock_script.run.assert_called_once_with(
+        keys=["object_counter"], args=["7"]
+    )
+
+
+@pytest.mark.asyncio
+async def test_import_batch_counter_registered(datastore):
+    """
+    A SET_MAX script that was already registered is used, rather than
+    registering it again for every batch.
+    """
+    datastore.redis.multi = mock.AsyncMock(return_value=mock.AsyncMock())
+    datastore.redis.register_script = mock.AsyncMock()
+    mock_script = mock.MagicMock()
+    mock_script.run = mock.AsyncMock()
+    for value in ("7", "9"):
+        await world.import_batch(
+            datastore,
+            [{"type": "string", "key": "object_counter", "value": value}],
+            mock_script,
+        )
+    assert datastore.redis.register_script.call_count == 0
+    assert mock_script.run.call_args_list == [
+        mock.call(keys=["object_counter"], args=["7"]),
+        mock.call(keys=["object_counter"], args=["9"]),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_import_world(datastore, tmp_path):
+    """
+    Records are imported in batches by several workers and the checkpoint
+    records the lines imported. Resuming skips lines already imported. The
+    SET_MAX script is registered once per import and shared by the batches.
+    """
+    lines = [
+        json.dumps({"type": "string", "key": f"k{i}", "value": str(i)})
+        for i in range(5)
+    ]
+    source = io.StringIO("\n".join(lines[:2] + [""] + lines[2:]) + "\n")
+    checkpoint = str(tmp_path / "checkpoint")
+    batches = []
+    mock_script = mock.MagicMock()
+    datastore.redis.register_script = mock.AsyncMock(return_value=mock_script)
+
+    async def import_batch(datastore, records, set_max):
+        assert set_max is mock_script
+        batches.append([record["key"] for record in records])
+
+    with mock.patch("textsmith.world.import_batch", import_batch):
+        result = await world.import_world(
+            datastore, source, workers=2, batch_size=2, checkpoint=checkpoint
+        )
+    assert result == 5
+    assert sorted(batches) == [["k0", "k1"], ["k2", "k3"], ["k4"]]
+    assert world.read_checkpoint(checkpoint) == 6
+    datastore.redis.register_script.assert_called_once_with(world.SET_MAX)
+    # Resume part way through.
+    world.write_checkpoint(checkpoint, 4)
+    source.seek(0)
+    batches = []
+    with mock.patch("textsmith.world.import_batch", import_batch):
+        result = await world.import_world(
+            datastore, source, batch_size=2, checkpoint=checkpoint
+        )
+    assert result == 2
+    assert batches == [["k3", "k4"]]
+
+
+def test_read_checkpoint_missing(tmp_path):
+    """
+    Without a checkpoint file nothing has been imported.
+    """
+    assert world.read_checkpoint(None) == 0
+    assert world.read_checkpoint(str(tmp_path / "missing")) == 0
@@ -24,7 +24,7 @@ import quart.flask_patch  # type: ignore # noqa
 import uuid
 import asyncio_redis  # type: ignore
 import textsmith.log  # noqa
-from typing import Tuple, Callable, Union
+from typing import Tuple, Callable, Union, Sequence, Dict, List
 from logging import getLogger
 from quart import (
     Quart,
@@ -37,6 +37,7 @@ from quart import (
     abort,
     current_app,
     Response,
+    jsonify,
 )
 from quart.logging import default_handler
 from flask_babel import Babel  # type: ignore
@@ -45,11 +46,20 @@ from flask_wtf import FlaskForm, RecaptchaField  # type: ignore
 from wtforms import validators  # type: ignore
 from wtforms.fields import PasswordField, BooleanField  # type: ignore
 from wtforms.fields.html5 import EmailField  # type: ignore
-from functools import wraps
+from functools import wraps, partial
 from textsmith.pubsub import PubSub
-from textsmith.datastore import DataStore
+from textsmith.pool import InstrumentedPool
+from textsmith.datastore import DataStore, LATENCY
+from textsmith.sharded import ShardedDataStore
 from textsmith.logic import Logic
+from textsmith.outbox import Outbox
 from textsmith.parser import Parser
+from textsmith.presence import Presence
+from textsmith.lastseen import LastSeen
+from textsmith.scheduler import Scheduler
+from textsmith.ratelimit import RateLimiter, parse_limit
+from textsmith.watchdog import Watchdog
+from textsmith import constants, envelope, metrics, trace
 
 
 __all__ = ["app"]
@@ -59,6 +69,16 @@ logger = structlog.get_logger()
 logger.msg("Starting application.")
 
 
+#: The number of open websocket connections.
+WEBSOCKETS = metrics.REGISTRY.gauge(
+    "textsmith_websockets", "Open websocket connections."
+).labels()
+#: How late the event loop runs a task that sleeps for a fixed interval.
+LOOP_LAG = metrics.REGISTRY.histogram(
+    "textsmith_loop_lag_seconds", "Scheduling lag of the event loop."
+)
+
+
 # Remove built-in logging.
 getLogger("quart.app").removeHandler(default_handler)
 
@@ -93,6 +113,97 @@ app.config.update(
         ),
         "EMAIL_HOST": os.environ.get("TEXTSMITH_EMAIL_HOST", "CHANGEME"),
         "EMAIL_PORT": int(os.environ.get("TEXTSMITH_EMAIL_PORT", "CHANGEME")),
+        # Number of connections to the mail relay used to deliver the outbox.
+        "EMAIL_CONNECTIONS": int(
+            os.environ.get("TEXTSMITH_EMAIL_CONNECTIONS", 2)
+        ),
+    }
+)
+# Websocket settings. If batching is enabled, messages queued for a
+# connection are coalesced into a single frame (separated by
+# constants.MESSAGE_DELIMITER). The linger is in milliseconds.
+app.config.update(
+    {
+        "WS_BATCH": os.environ.get("TEXTSMITH_WS_BATCH") is not None,
+        "WS_BATCH_COUNT": int(os.environ.get("TEXTSMITH_WS_BATCH_COUNT", 100)),
+        "WS_BATCH_SIZE": int(os.environ.get("TEXTSMITH_WS_BATCH_SIZE", 65536)),
+        "WS_BATCH_LINGER": int(os.environ.get("TEXTSMITH_WS_BATCH_LINGER", 0)),
+    }
+)
+# Presence settings (in seconds). Heartbeats for connected users are sent
+# every interval, and websockets idle for longer than the timeout are closed.
+app.config.update(
+    {
+        "PRESENCE_INTERVAL": float(
+            os.environ.get("TEXTSMITH_PRESENCE_INTERVAL", 30)
+        ),
+        "IDLE_TIMEOUT": float(os.environ.get("TEXTSMITH_IDLE_TIMEOUT", 1800)),
+        # Seconds between writes of buffered last-seen timestamps.
+        "LAST_SEEN_INTERVAL": float(
+            os.environ.get("TEXTSMITH_LAST_SEEN_INTERVAL", 10)
+        ),
+    }
+)
+# Command scheduling settings. The maximum number of commands evaluated at
+# once on this instance, and the maximum number waiting for each user.
+app.config.update(
+    {
+        "COMMAND_CONCURRENCY": int(
+            os.environ.get("TEXTSMITH_COMMAND_CONCURRENCY", 100)
+        ),
+        "COMMAND_QUEUE_LIMIT": int(
+            os.environ.get("TEXTSMITH_COMMAND_QUEUE_LIMIT", 20)
+        ),
+    }
+)
+# Rate limits, expressed as "rate:burst" (tokens per second : bucket size).
+# Commands are limited per user, log in attempts per IP address and for the
+# whole endpoint. Buckets are in Redis unless the backend is "local".
+app.config.update(
+    {
+        "RATE_LIMIT_BACKEND": os.environ.get(
+            "TEXTSMITH_RATE_LIMIT_BACKEND", "redis"
+        ),
+        "RATE_LIMITS": {
+            "command": parse_limit(
+                os.environ.get("TEXTSMITH_RATE_LIMIT_COMMAND", "5:20")
+            ),
+            "login_ip": parse_limit(
+                os.environ.get("TEXTSMITH_RATE_LIMIT_LOGIN_IP", "0.2:5")
+            ),
+            "login": parse_limit(
+                os.environ.get("TEXTSMITH_RATE_LIMIT_LOGIN", "20:50")
+            ),
+        },
+    }
+)
+# Tracing of commands. The fraction of commands whose traces are logged, and
+# the number of seconds after which a command's trace is always logged (0 to
+# only log sampled commands).
+app.config.update(
+    {
+        "TRACE_SAMPLE": float(os.environ.get("TEXTSMITH_TRACE_SAMPLE", 0.01)),
+        "TRACE_SLOW": float(os.environ.get("TEXTSMITH_TRACE_SLOW", 0.5)),
+    }
+)
+# Worker settings, set by the textsmith.workers launcher when several worker
+# processes serve the application. The name of this worker, and the
+# directory in which the workers share their metrics.
+app.config.update(
+    {
+        "WORKER": os.environ.get("TEXTSMITH_WORKER"),
+        "METRICS_DIR": os.environ.get("TEXTSMITH_METRICS_DIR"),
+    }
+)
+# Event loop monitoring. The lag of the event loop is measured every
+# interval, and a stack sample is logged whenever the loop is stalled for
+# longer than the threshold (0 to disable), both in seconds.
+app.config.update(
+    {
+        "LOOP_INTERVAL": float(
+            os.environ.get("TEXTSMITH_LOOP_INTERVAL", 0.1)
+        ),
+        "LOOP_STALL": float(os.environ.get("TEXTSMITH_LOOP_STALL", 0.25)),
     }
 )
 
@@ -162,6 +273,144 @@ class LogIn(FlaskForm):
 
 
 # ---------- APP EVENTS
+def addresses_from_env(name: str) -> List[str]:
+    """
+    Return the list of "host:port" addresses in the referenced environment
+    variable, whose value is a comma separated list of addresses.
+    """
+    return [
+        address.strip()
+        for address in os.environ.get(name, "").split(",")
+        if address.strip()
+    ]
+
+
+async def connect(
+    addresses: Sequence[str],
+    password: Union[str, None],
+    poolsize: int,
+    max_poolsize: int = 0,
+    wait_timeout: float = 5.0,
+) -> Dict[str, InstrumentedPool]:
+    """
+    Return a dictionary of instrumented connection pools to the Redis
+    instances at the referenced "host:port" addresses. If max_poolsize is
+    greater than poolsize, each pool is resized between the two as needed.
+    """
+    pools = {}
+    for address in addresses:
+        host, _, port = address.rpartition(":")
+        pool = InstrumentedPool(
+            await asyncio_redis.Pool.create(
+                host=host, port=int(port), password=password, poolsize=poolsize
+            ),
+            partial(
+                asyncio_redis.Connection.create,
+                host=host,
+                port=int(port),
+                password=password,
+            ),
+            poolsize,
+            max(poolsize, max_poolsize),
+            wait_timeout,
+        )
+        if pool.max_size > pool.min_size:
+            pool.start()
+        pools[address] = pool
+        logger.msg(
+            "Connected to Redis.",
+            redis_host=host,
+            redis_port=port,
+            redis_poolsize=poolsize,
+            redis_max_poolsize=pool.max_size,
+        )
+    return pools
+
+
+async def subscribe(
+    host: str, port: int, password: Union[str, None]
+) -> asyncio_redis.Subscription:
+    """
+    Return a subscriber with its own connection to Redis, for the PubSub.
+    The connection doesn't reconnect automatically, so the PubSub can tell
+    when it's lost (and reconnect and resubscribe itself).
+    """
+    connection = await asyncio_redis.Connection.create(
+        host=host, port=port, password=password, auto_reconnect=False
+    )
+    return await connection.start_subscribe()
+
+
+def register_metrics(app: Quart) -> None:
+    """
+    Register the gauges whose values are read from the application's
+    objects when the metrics are rendered.
+    """
+    registry = metrics.REGISTRY
+    pubsub = app.pubsub  # type: ignore
+    registry.gauge(
+        "textsmith_pubsub_connected_users",
+        "Users with a message queue on this instance.",
+        function=lambda: len(pubsub.connected_users),
+    )
+    registry.gauge(
+        "textsmith_pubsub_queued_messages",
+        "Messages waiting in users' message queues.",
+        function=lambda: sum(
+            queue.qsize() for queue in pubsub.connected_users.values()
+        ),
+    )
+    registry.gauge(
+        "textsmith_pubsub_max_queue_depth",
+        "Messages waiting in the longest user's message queue.",
+        function=lambda: max(
+            (queue.qsize() for queue in pubsub.connected_users.values()),
+            default=0,
+        ),
+    )
+    pools = app.pools  # type: ignore
+    registry.gauge(
+        "textsmith_redis_poolsize",
+        "Connections in each Redis pool.",
+        ["node"],
+        function=lambda: {
+            (name,): pool.poolsize for name, pool in pools.items()
+        },
+    )
+    registry.gauge(
+        "textsmith_redis_in_use",
+        "Busy connections in each Redis pool.",
+        ["node"],
+        function=lambda: {
+            (name,): pool.connections_in_use for name, pool in pools.items()
+        },
+    )
+    registry.gauge(
+        "textsmith_redis_in_flight",
+        "Commands in flight to each Redis node.",
+        ["node"],
+        function=lambda: {
+            (name,): pool.in_flight for name, pool in pools.items()
+        },
+    )
+    scheduler = app.scheduler  # type: ignore
+    registry.gauge(
+        "textsmith_commands_running",
+        "Commands being evaluated.",
+        function=lambda: scheduler.running,
+    )
+    registry.gauge(
+        "textsmith_commands_queued",
+        "Commands waiting to be evaluated.",
+        function=lambda: scheduler.stats()["queued"],
+    )
+    registry.gauge(
+        "textsmith_outbox_size",
+        "Emails waiting in the outbox.",
+        function=app.outbox.size,  # type: ignore
+    )
+
+
 @app.before_serving
 async def on_start(app: Quart = app) -> None:
     """
@@ -175,32 +424,151 @@ async def on_start(app: Quart = app) -> None:
     port = int(os.environ.get("TEXTSMITH_REDIS_PORT", 6379))
     password = os.environ.get("TEXTSMITH_REDIS_PASSWORD", None)
     poolsize = int(os.environ.get("TEXTSMITH_REDIS_POOLSIZE", 10))
-    logger.msg("Redis Config.", host=host, port=port, poolsize=poolsize)
+    # If greater than the poolsize, pools grow up to this many connections
+    # when commands have to wait for a free connection, and shrink back when
+    # they're idle.
+    max_poolsize = int(
+        os.environ.get("TEXTSMITH_REDIS_MAX_POOLSIZE", poolsize)
+    )
+    # Seconds a command waits for a free connection before failing.
+    wait_timeout = float(os.environ.get("TEXTSMITH_REDIS_WAIT_TIMEOUT", 5.0))
+    # The number of Redis connections used to listen for pub/sub messages.
+    # Each subscriber has its own connection, outside the pool.
+    shards = int(os.environ.get("TEXTSMITH_PUBSUB_SHARDS", 1))
+    # The number of new object ids reserved from Redis at once.
+    id_block_size = int(os.environ.get("TEXTSMITH_ID_BLOCK_SIZE", 100))
+    # Read replicas ("host:port,host:port") used for read-only operations,
+    # and the number of seconds after a write during which reads in the same
+    # context stay on the primary.
+    replica_addresses = addresses_from_env("TEXTSMITH_REDIS_REPLICAS")
+    replica_poolsize = int(
+        os.environ.get("TEXTSMITH_REDIS_REPLICA_POOLSIZE", poolsize)
+    )
+    sticky = float(os.environ.get("TEXTSMITH_REDIS_STICKY", 1.0))
+    # Further Redis nodes ("host:port,host:port") across which objects are
+    # sharded, along with the node above. Replicas aren't used if set.
+    shard_addresses = addresses_from_env("TEXTSMITH_REDIS_SHARDS")
+    logger.msg(
+        "Redis Config.",
+        host=host,
+        port=port,
+        poolsize=poolsize,
+        max_poolsize=max_poolsize,
+        wait_timeout=wait_timeout,
+        pubsub_shards=shards,
+        id_block_size=id_block_size,
+        replicas=replica_addresses,
+        replica_poolsize=replica_poolsize,
+        sticky=sticky,
+        shards=shard_addresses,
+    )
     try:
-        redis = await asyncio_redis.Pool.create(
-            host=host, port=port, password=password, poolsize=poolsize
+        pools = await connect(
+            [f"{host}:{port}"],
+            password,
+            poolsize,
+            max_poolsize,
+            wait_timeout,
         )
-        logger.msg(
-            "Connected to Redis.",
-            redis_host=host,
-            redis_port=port,
-            redis_poolsize=poolsize,
-        )
-        subscriber = await redis.start_subscribe()
+        redis = pools[f"{host}:{port}"]
+        new_subscriber = partial(subscribe, host, port, password)
+        subscribers = [await new_subscriber() for _ in range(shards)]
         # Assemble objects and inject into the global app scope.
-        datastore = DataStore(redis)
+        if shard_addresses:
+            nodes = await connect(
+                shard_addresses,
+                password,
+                poolsize,
+                max_poolsize,
+                wait_timeout,
+            )
+            datastore: DataStore = ShardedDataStore(
+                {f"{host}:{port}": redis, **nodes}, id_block_size
+            )
+        else:
+            nodes = await connect(
+                replica_addresses,
+                password,
+                replica_poolsize,
+                max(replica_poolsize, max_poolsize),
+                wait_timeout,
+            )
+            datastore = DataStore(
+                redis, id_block_size, list(nodes.values()), sticky
+            )
+        pools.update(nodes)
+        app.pools = pools  # type: ignore
+        # Latency of each DataStore method.
+        metrics.instrument(datastore, LATENCY)
+        trace.instrument(datastore, "datastore")
+        trace.configure(app.config["TRACE_SAMPLE"], app.config["TRACE_SLOW"])
+        outbox = Outbox(
+            datastore,
+            app.config["EMAIL_HOST"],
+            app.config["EMAIL_PORT"],
+            app.config["EMAIL_ADDRESS"],
+            app.config["EMAIL_PASSWORD"],
+            app.config["EMAIL_CONNECTIONS"],
+        )
+        outbox.start()
+        app.outbox = outbox  # type: ignore
         logic = Logic(
             datastore,
             app.config["EMAIL_HOST"],
             app.config["EMAIL_PORT"],
             app.config["EMAIL_ADDRESS"],
             app.config["EMAIL_PASSWORD"],
+            outbox,
         )
         app.logic = logic  # type: ignore
-        pubsub = PubSub(subscriber)
+        pubsub = PubSub(*subscribers, connect=new_subscriber)
         app.pubsub = pubsub  # type: ignore
-        app.parser = Parser(logic)  # type: ignore
-        logger.msg("Waiting for connections.")
+        if app.config["RATE_LIMIT_BACKEND"] == "local":
+            app.limiter = RateLimiter(  # type: ignore
+                app.config["RATE_LIMITS"]
+            )
+        else:
+            app.limiter = RateLimiter(  # type: ignore
+                app.config["RATE_LIMITS"], redis
+            )
+        parser = Parser(logic)
+        app.parser = parser  # type: ignore
+        app.scheduler = Scheduler(  # type: ignore
+            parser,
+            logic,
+            app.config["COMMAND_CONCURRENCY"],
+            app.config["COMMAND_QUEUE_LIMIT"],
+        )
+        presence = Presence(
+            datastore,
+            app.config["PRESENCE_INTERVAL"],
+            app.config["IDLE_TIMEOUT"],
+        )
+        presence.start()
+        app.presence = presence  # type: ignore
+        last_seen = LastSeen(datastore, app.config["LAST_SEEN_INTERVAL"])
+        last_seen.start()
+        app.last_seen = last_seen  # type: ignore
+        loop_monitor = metrics.LoopMonitor(
+            LOOP_LAG, app.config["LOOP_INTERVAL"]
+        )
+        loop_monitor.start()
+        app.loop_monitor = loop_monitor  # type: ignore
+        watchdog = Watchdog(loop_monitor, app.config["LOOP_STALL"])
+        if watchdog.threshold > 0:
+            watchdog.start()
+        app.watchdog = watchdog  # type: ignore
+        register_metrics(app)
+        exporter = None
+        if app.config["METRICS_DIR"]:
+            exporter = metrics.Exporter(
+                metrics.REGISTRY,
+                app.config["METRICS_DIR"],
+                app.config["WORKER"] or str(os.getpid()),
+            )
+            exporter.start()
+        app.exporter = exporter  # type: ignore
+        logger.msg("Waiting for connections.", worker=app.config["WORKER"])
     except Exception as ex:  # pragma: no cover
         # If the app can't connect to Redis, log this and exit.
         logger.msg("ABORT. Failed to connect to Redis.", exc_info=ex)
@@ -213,11 +581,46 @@ async def on_start(app: Quart = app) -> None:
 @app.after_serving
 async def on_stop() -> None:
     """
-    Log that the application is stopping, for status update purposes.
+    Stop background tasks and log that the application is stopping, for
+    status update purposes.
     """
+    await app.presence.stop()  # type: ignore
+    await app.last_seen.stop()  # type: ignore
+    await app.scheduler.stop()  # type: ignore
+    await app.outbox.stop()  # type: ignore
+    await app.pubsub.stop()  # type: ignore
+    app.watchdog.stop()  # type: ignore
+    if app.exporter:  # type: ignore
+        await app.exporter.stop()  # type: ignore
+    await app.loop_monitor.stop()  # type: ignore
+    for pool in app.pools.values():  # type: ignore
+        await pool.stop()
     logger.msg("Stopped.")
 
 
+async def drain(grace: float = 5.0) -> None:
+    """
+    Gracefully close the websockets connected to this instance before it
+    shuts down. Users are told the server is restarting, then, after grace
+    seconds (for messages already queued to be sent), the connections are
+    closed so the clients reconnect to another instance.
+    """
+    user_ids = app.presence.user_ids()  # type: ignore
+    logger.msg("Draining connections.", users=len(user_ids), grace=grace)
+    # There's no request (and so no locale) to translate this message.
+    reply = "The server is restarting. Please reconnect."
+    for user_id in user_ids:
+        try:
+            await app.logic.emit_to_user(  # type: ignore
+                user_id, constants.SYSTEM_OUTPUT.format(reply)
+            )
+        except Exception as ex:  # pragma: no cover
+            logger.msg("Error draining user.", user_id=user_id, exc_info=ex)
+    if user_ids:
+        await asyncio.sleep(grace)
+    app.presence.close_all()  # type: ignore
+
+
 @babel.localeselector
 def get_locale() -> None:
     """
@@ -369,14 +772,64 @@ async def client() -> Union[str, Response]:
         return redirect(url_for("login"))
 
 
+@app.route("/health", methods=["GET"])
+async def health() -> Tuple[Response, int]:
+    """
+    Report the state of the pub/sub layer, message latency, the state of
+    the Redis connection pools and the latency of DataStore methods, for
+    health checks. Anything other than a fully connected pub/sub layer
+    results in a 503 response.
+    """
+    stats = current_app.pubsub.stats()
+    status = 200 if stats["state"] == "connected" else 503
+    stats["latency"] = envelope.latency()
+    stats["redis"] = {
+        name: pool.stats()
+        for name, pool in current_app.pools.items()  # type: ignore
+    }
+    stats["datastore"] = {
+        labels[0]: histogram.snapshot()
+        for labels, histogram in LATENCY.children.items()
+    }
+    return jsonify(stats), status
+
+
+@app.route("/metrics", methods=["GET"])
+async def metrics_endpoint() -> Response:
+    """
+    Report the application's metrics in the Prometheus text format.
+    """
+    if current_app.exporter:  # type: ignore
+        # Report the metrics of every worker.
+        body = await current_app.exporter.render()  # type: ignore
+    else:
+        body = await metrics.REGISTRY.render()
+    return Response(body, content_type="text/plain; version=0.0.4")
+
+
 # ----------  WEBSOCKET HANDLERS
 async def sending(user_id: int, connection_id: str) -> None:
     """
     Handle the sending of messages to a connected websocket. Simply read
     messages off a message queue for the current user.
+
+    In batching mode, all the messages currently queued for the user (within
+    the configured limits) are sent together as a single frame.
     """
+    config = current_app.config
     while True:
-        message = await current_app.pubsub.get_message(user_id)
+        if config["WS_BATCH"]:
+            messages = await current_app.pubsub.get_messages(
+                user_id,
+                config["WS_BATCH_COUNT"],
+                config["WS_BATCH_SIZE"],
+                config["WS_BATCH_LINGER"] / 1000,
+            )
+            message = constants.MESSAGE_DELIMITER.join(messages)
+        else:
+            message = await current_app.pubsub.get_message(user_id)
+            if message:
+                message = envelope.send(message)
         await websocket.send(message)
         logger.msg(
             "Outgoing message.",
@@ -388,8 +841,8 @@ async def sending(user_id: int, connection_id: str) -> None:
 
 async def receiving(user_id: int, connection_id: str) -> None:
     """
-    Parse incoming data. Any resulting output will but put in the user's
-    message queue.
+    Schedule incoming data to be parsed. Any resulting output will but put
+    in the user's message queue.
     """
     while True:
         data = await websocket.receive()
@@ -399,7 +852,15 @@ async def receiving(user_id: int, connection_id: str) -> None:
             connection_id=connection_id,
             message=data,
         )
-        await current_app.parser.eval(user_id, connection_id, data)
+        current_app.presence.touch(connection_id)
+        current_app.last_seen.touch(user_id)
+        if await current_app.limiter.allow("command", user_id):
+            await current_app.scheduler.submit(user_id, connection_id, data)
+        else:
+            reply = _("Slow down! You're sending commands too quickly.")
+            await current_app.logic.emit_to_user(
+                user_id, constants.SYSTEM_OUTPUT.format(reply)
+            )
 
 
 def require_user(func) -> Callable:
@@ -435,7 +896,8 @@ def collect_websocket(func) -> Callable:
     use. Log details about the connection starting/closing.
 
     Ensure the user_id is added to the connected_users set upon connection,
-    and removed when the connection is dropped.
+    and removed when the connection is dropped. Presence of the user is
+    tracked while the connection is open.
     """
 
     @wraps(func)
@@ -455,9 +917,19 @@ def collect_websocket(func) -> Callable:
         await current_app.pubsub.subscribe(
             websocket.user_id, websocket.connection_id
         )
+        await current_app.presence.connect(
+            websocket.user_id,
+            websocket.connection_id,
+            asyncio.current_task(),
+        )
+        WEBSOCKETS.inc()
         try:
             return await func(*args, **kwargs)
         finally:
+            WEBSOCKETS.dec()
+            current_app.presence.disconnect(
+                websocket.user_id, websocket.connection_id
+            )
             # Unsubscribe from messages published for this user.
             await current_app.pubsub.unsubscribe(
                 websocket.user_id, websocket.connection_id
@@ -491,9 +963,10 @@ async def ws() -> None:
 
 # ----------  USER STATE HANDLERS
 @app.route("/login", methods=["GET", "POST"])
-async def login() -> Union[str, Response]:
+async def login() -> Union[str, Response, Tuple[str, int]]:
     """
-    Checks the credentials and creates a session.
+    Checks the credentials and creates a session. Attempts to log in are rate
+    limited by IP address and for the endpoint as a whole.
     """
     logger.msg(
         "Log in.",
@@ -504,13 +977,24 @@ async def login() -> Union[str, Response]:
         method=request.method,
     )
     form = LogIn()
+    if request.method == "POST":
+        limiter = current_app.limiter
+        if not (
+            await limiter.allow("login_ip", request.remote_addr)
+            and await limiter.allow("login", "all")
+        ):
+            error = _("Too many attempts to log in. Please try again later.")
+            return (
+                await render_template("login.html", error=error, form=form),
+                429,
+            )
     if form.validate_on_submit():
         email = form.email.data
         password = form.password.data
         user_id = await current_app.logic.verify_credentials(email, password)
         if user_id:
             session["user_id"] = user_id
-            await current_app.logic.set_last_seen(user_id)
+            current_app.last_seen.touch(user_id)
             return redirect(url_for("client"))
     error = None
     if request.method == "POST":
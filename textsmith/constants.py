@@ -97,3 +97,6 @@ HUH = [
 
 #: The HTML fragment template for system or error messages for the user.
 SYSTEM_OUTPUT = "<pre><code>{}</code></pre>"
+#: Separates messages coalesced into a single websocket frame (the ASCII
+#: "record separator" character).
+MESSAGE_DELIMITER = "\x1e"
@@ -18,30 +18,172 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>
 """
 import os
+import asyncio
 import binascii
 import hashlib
 import json
+import time
 import structlog  # type: ignore
+from contextvars import ContextVar
 from datetime import datetime
-from typing import Sequence, Dict, Union, Mapping, Any
-from asyncio_redis import Pool  # type: ignore
-from asyncio_redis.exceptions import Error, ErrorReply  # type: ignore
-from textsmith import constants
+from typing import Sequence, Dict, List, Tuple, Union, Mapping, Any
+from asyncio_redis import Pool, Script, ZScoreBoundary  # type: ignore
+from asyncio_redis.exceptions import (  # type: ignore
+    Error,
+    ErrorReply,
+    ScriptKilledError,
+)
+from textsmith import constants, metrics
 
 
 logger = structlog.get_logger()
 
 
+#: The latency of DataStore methods (see metrics.instrument).
+LATENCY = metrics.REGISTRY.histogram(
+    "textsmith_datastore_seconds", "Latency of DataStore methods.", ["method"]
+)
+
+
+#: The time.monotonic() of the last write made in the current context (e.g.
+#: by the command being evaluated). Used to read-your-writes.
+last_write: ContextVar[Union[float, None]] = ContextVar(
+    "last_write", default=None
+)
+
+
+#: Atomically move an object to a new container. KEYS[1] is the object's
+#: location key. ARGV[1] is the object's id, ARGV[2] the new container's id
+#: (or an empty string if the object is no longer contained) and ARGV[3] the
+#: prefix of inventory keys. Returns the old container's id (or nil).
+SET_CONTAINER = """
+local old = redis.call("GET", KEYS[1])
+if old then
+    redis.call("SREM", ARGV[3] .. old, ARGV[1])
+end
+if ARGV[2] == "" then
+    redis.call("DEL", KEYS[1])
+else
+    redis.call("SADD", ARGV[3] .. ARGV[2], ARGV[1])
+    redis.call("SET", KEYS[1], ARGV[2])
+end
+return old
+"""
+
+
+class IdAllocator:
+    """
+    Hands out unique object ids from blocks reserved in Redis with a single
+    INCRBY, so most new objects don't need a round trip to get their id.
+
+    Ids are unique across instances since each block is reserved atomically.
+    Ids left unused in a block when an instance stops are never handed out.
+    """
+
+    def __init__(
+        self, redis: Pool, key: str = "object_counter", block_size: int = 1
+    ) -> None:
+        """
+        The redis object is a connection pool to a Redis instance. The key
+        references the counter in Redis, and block_size is the minimum number
+        of ids to reserve at once.
+        """
+        self.redis = redis
+        self.key = key
+        self.block_size = block_size
+        self.next_id = 1  # The next id to hand out from the current block.
+        self.last_id = 0  # The last id in the current block.
+        self.lock = asyncio.Lock()
+
+    async def allocate(self, count: int = 1) -> List[int]:
+        """
+        Return a list of count new unique ids. Ids left in the current block
+        are used first. If more are needed a new block big enough for them
+        (and at least block_size) is reserved.
+        """
+        async with self.lock:
+            available = min(self.last_id - self.next_id + 1, count)
+            ids = list(range(self.next_id, self.next_id + available))
+            self.next_id += len(ids)
+            needed = count - len(ids)
+            if needed > 0:
+                size = max(self.block_size, needed)
+                try:
+                    last_id = int(await self.redis.incrby(self.key, size))
+                except (Error, ErrorReply) as ex:  # pragma: no cover
+                    logger.msg(
+                        "Error incrementing object_counter.",
+                        key=self.key,
+                        size=size,
+                        exc_info=ex,
+                        redis_error=True,
+                    )
+                    raise ex
+                first_id = last_id - size + 1
+                ids.extend(range(first_id, first_id + needed))
+                self.next_id = first_id + needed
+                self.last_id = last_id
+                logger.msg(
+                    "Reserved object ids.", first_id=first_id, last_id=last_id
+                )
+            return ids
+
+
 class DataStore:
     """
     Gathers together methods to implement storage related operations via Redis.
     """
 
-    def __init__(self, redis: Pool) -> None:
+    def __init__(
+        self,
+        redis: Pool,
+        id_block_size: int = 1,
+        replicas: Sequence[Pool] = (),
+        sticky: float = 1.0,
+    ) -> None:
         """
-        The redis object is a connection pool to a Redis instance.
+        The redis object is a connection pool to a Redis instance. New object
+        ids are reserved id_block_size at a time.
+
+        The optional replicas are connection pools to read-only replicas of
+        the Redis instance. Read-only operations are shared between them,
+        except in a context that wrote to the primary in the last sticky
+        seconds, so a command always sees its own writes.
         """
         self.redis = redis
+        self.ids = IdAllocator(redis, block_size=id_block_size)
+        self.set_container_script: Union[Script, None] = None
+        self.replicas = list(replicas)
+        self.sticky = sticky
+        self.next_replica = 0
+
+    def reader(self) -> Pool:
+        """
+        Return the connection pool to use for a read-only operation: the next
+        replica in turn, or the primary if there are no replicas or the
+        current context wrote to the primary recently.
+        """
+        if not self.replicas:
+            return self.redis
+        written = last_write.get()
+        if written is not None and time.monotonic() - written < self.sticky:
+            return self.redis
+        pool = self.replicas[self.next_replica % len(self.replicas)]
+        self.next_replica += 1
+        return pool
+
+    def wrote(self) -> None:
+        """
+        Record that the current context has just written to the primary.
+        """
+        last_write.set(time.monotonic())
+
+    def object_key(self, object_id: int) -> str:
+        """
+        Given an object id, return the key of the Redis hash that holds the
+        object's attributes.
+        """
+        return str(object_id)
 
     def user_key(self, email: str) -> str:
         """
@@ -64,6 +206,20 @@ class DataStore:
         """
         return f"lastseen:{user_id}"
 
+    def recently_seen_key(self) -> str:
+        """
+        Return the key of the sorted set of user ids scored by the time (in
+        seconds since the epoch) at which they were last seen.
+        """
+        return "lastseen"
+
+    def presence_key(self) -> str:
+        """
+        Return the key of the sorted set of the ids of online users scored by
+        the time (in seconds since the epoch) of their latest heartbeat.
+        """
+        return "presence"
+
     def inventory_key(self, object_id: int) -> str:
         """
         Given an object id, return the key to use to record the objects
@@ -122,21 +278,54 @@ class DataStore:
         parent_id.
         """
         # Get the new object's unique ID.
+        object_id = (await self.ids.allocate())[0]
+        logger.msg("Created new object.", object_id=object_id)
+        # Add attributes to the object.
+        if attributes:
+            await self.annotate_object(object_id, **attributes)
+        # Return the new object's id
+        return object_id
+
+    async def add_objects(
+        self,
+        *objects: Dict[
+            str,
+            Union[
+                str, int, float, bool, Sequence[Union[str, int, float, bool]]
+            ],
+        ],
+    ) -> List[int]:
+        """
+        Create a new object for each of the referenced dictionaries of
+        attributes, all in a single transaction. Return a list of the ids of
+        the new objects, in the same order.
+        """
+        if not objects:
+            return []
+        object_ids = await self.ids.allocate(len(objects))
         try:
-            object_id = int(await self.redis.incr("object_counter"))
+            self.wrote()
+            transaction = await self.redis.multi()
+            for object_id, attributes in zip(object_ids, objects):
+                if attributes:
+                    await transaction.hmset(
+                        self.object_key(object_id),
+                        {
+                            attribute: json.dumps(value)
+                            for attribute, value in attributes.items()
+                        },
+                    )
+            await transaction.exec()
         except (Error, ErrorReply) as ex:  # pragma: no cover
             logger.msg(
-                "Error incrementing object_counter.",
+                "Error adding objects.",
+                object_ids=object_ids,
                 exc_info=ex,
                 redis_error=True,
             )
             raise ex
-        logger.msg("Created new object.", object_id=object_id)
-        # Add attributes to the object.
-        if attributes:
-            await self.annotate_object(object_id, **attributes)
-        # Return the new object's id
-        return object_id
+        logger.msg("Created new objects.", object_ids=object_ids)
+        return object_ids
 
     async def annotate_object(
         self,
@@ -156,8 +345,9 @@ class DataStore:
             for attribute, value in attributes.items()
         }
         try:
+            self.wrote()
             transaction = await self.redis.multi()
-            await transaction.hmset(str(object_id), data)
+            await transaction.hmset(self.object_key(object_id), data)
             await transaction.exec()
         except (Error, ErrorReply) as ex:  # pragma: no cover
             logger.msg(
@@ -192,10 +382,10 @@ class DataStore:
         """
         try:
             results = {}
-            transaction = await self.redis.multi()
+            transaction = await self.reader().multi()
             for object_id in ids:
                 results[object_id] = await transaction.hgetall_asdict(
-                    str(object_id)
+                    self.object_key(object_id)
                 )
             await transaction.exec()
             # Build result dictionary.
@@ -240,13 +430,10 @@ class DataStore:
         a KeyError to indicate the attribute doesn't exist on the object.
         """
         try:
-            # Check attribute exists.
-            exists = await self.redis.hexists(str(object_id), attribute)
-            if not exists:
-                raise KeyError(
-                    f"Attribute '{attribute}' on #{object_id} does not exist."
-                )
-            result = await self.redis.hget(str(object_id), attribute)
+            # Values are always JSON, so None means no such attribute.
+            result = await self.reader().hget(
+                self.object_key(object_id), attribute
+            )
         except (Error, ErrorReply) as ex:  # pragma: no cover
             logger.msg(
                 "Error getting attribute for object.",
@@ -256,18 +443,61 @@ class DataStore:
                 redis_error=True,
             )
             raise ex
+        if result is None:
+            raise KeyError(
+                f"Attribute '{attribute}' on #{object_id} does not exist."
+            )
         return json.loads(result)
 
+    async def get_attributes(
+        self, requests: Sequence[Tuple[int, str]]
+    ) -> Dict[
+        Tuple[int, str],
+        Union[str, int, float, bool, Sequence[Union[str, int, float, bool]]],
+    ]:
+        """
+        Given a list of (object ID, attribute) pairs, fetch all their values
+        in a single transaction. Return a dictionary whose keys are the pairs
+        and values are the associated values. Pairs for attributes that don't
+        exist are missing from the result, so looking them up raises a
+        KeyError.
+        """
+        try:
+            results = {}
+            transaction = await self.reader().multi()
+            for object_id, attribute in requests:
+                results[(object_id, attribute)] = await transaction.hget(
+                    self.object_key(object_id), attribute
+                )
+            await transaction.exec()
+            values = {}
+            for request, result in results.items():
+                value = await result
+                if value is not None:
+                    values[request] = json.loads(value)
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error getting attributes.",
+                requests=requests,
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+        return values
+
     async def delete_attributes(
         self, object_id: int, attributes: Sequence[str]
-    ) -> None:
+    ) -> int:
         """
         Given an object ID and list of attributes, delete them. Returns the
         number of attributes deleted.
         """
         try:
+            self.wrote()
             transaction = await self.redis.multi()
-            result = await transaction.hdel(str(object_id), attributes)
+            result = await transaction.hdel(
+                self.object_key(object_id), attributes
+            )
             await transaction.exec()
             number_changed = await result
         except (Error, ErrorReply) as ex:  # pragma: no cover
@@ -292,7 +522,7 @@ class DataStore:
         address exists within the system.
         """
         try:
-            result = await self.redis.exists(self.user_key(email))
+            result = await self.reader().exists(self.user_key(email))
         except (Error, ErrorReply) as ex:  # pragma: no cover
             logger.msg(
                 "Error checking if user exists.",
@@ -324,6 +554,7 @@ class DataStore:
                 attribute: json.dumps(value)
                 for attribute, value in user.items()
             }
+            self.wrote()
             transaction = await self.redis.multi()
             # Set the meta-data.
             await transaction.hmset(self.user_key(email), data)
@@ -403,6 +634,7 @@ class DataStore:
             if flag:  # The user exists.
                 is_active = json.loads(flag)
                 if is_active:  # The user is active.
+                    self.wrote()
                     await self.redis.hmset(key, data)
                     logger.msg("Set password.", user_email=email)
                     return True
@@ -436,6 +668,7 @@ class DataStore:
             )
             raise ValueError(msg)
         try:
+            self.wrote()
             await self.redis.delete([self.token_key(confirmation_token)])
         except (Error, ErrorReply) as ex:  # pragma: no cover
             logger.msg(
@@ -483,6 +716,7 @@ class DataStore:
         # JSON-ify for Redis.
         data = {"active": json.dumps(active_flag)}
         try:
+            self.wrote()
             await self.redis.hmset(self.user_key(email), data)
         except (Error, ErrorReply) as ex:  # pragma: no cover
             logger.msg(
@@ -500,13 +734,11 @@ class DataStore:
     async def set_last_seen(self, email: str) -> None:
         """
         Set the last_seen value for the user identified by the referenced
-        object id.
+        email address.
         """
-        now = datetime.now().isoformat()
+        now = time.time()
         try:
             object_id = await self.email_to_object_id(email)
-            key = self.last_seen_key(object_id)
-            await self.redis.set(key, now)
         except (Error, ErrorReply) as ex:  # pragma: no cover
             logger.msg(
                 "Error setting last seen.",
@@ -515,7 +747,42 @@ class DataStore:
                 redis_error=True,
             )
             raise ex
-        logger.msg("Set last seen.", user_email=email, last_seen=now)
+        await self.set_last_seen_many({object_id: now})
+
+    async def set_last_seen_many(self, timestamps: Dict[int, float]) -> None:
+        """
+        Given a dictionary of user ids and the time (in seconds since the
+        epoch) at which each user was last seen, record them all in a single
+        transaction. The last_seen value of each user is set, and the users
+        are added to the sorted set of recently seen users.
+        """
+        if not timestamps:
+            return
+        try:
+            self.wrote()
+            transaction = await self.redis.multi()
+            for user_id, timestamp in timestamps.items():
+                await transaction.set(
+                    self.last_seen_key(user_id),
+                    datetime.fromtimestamp(timestamp).isoformat(),
+                )
+            await transaction.zadd(
+                self.recently_seen_key(),
+                {
+                    str(user_id): timestamp
+                    for user_id, timestamp in timestamps.items()
+                },
+            )
+            await transaction.exec()
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error setting last seen.",
+                users=len(timestamps),
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+        logger.msg("Set last seen.", users=len(timestamps))
 
     async def get_last_seen(self, user_id: int) -> Union[datetime, None]:
         """
@@ -524,7 +791,7 @@ class DataStore:
         """
         try:
             key = self.last_seen_key(user_id)
-            val = await self.redis.get(key)
+            val = await self.reader().get(key)
             if val:  # The user was last seen at a certain time.
                 return datetime.fromisoformat(val)
         except (Error, ErrorReply) as ex:  # pragma: no cover
@@ -537,6 +804,100 @@ class DataStore:
             raise ex
         return None
 
+    async def get_recently_seen(self, since: float) -> Dict[int, datetime]:
+        """
+        Return a dictionary of the ids of users seen since the referenced time
+        (in seconds since the epoch) and a datetime object representing the
+        moment each of them was last seen.
+        """
+        try:
+            reply = await self.reader().zrangebyscore(
+                self.recently_seen_key(), ZScoreBoundary(since)
+            )
+            result = await reply.asdict()
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error getting recently seen.",
+                since=since,
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+        return {
+            int(user_id): datetime.fromtimestamp(timestamp)
+            for user_id, timestamp in result.items()
+        }
+
+    async def set_presence(
+        self,
+        timestamps: Dict[int, float],
+        expire_before: Union[float, None] = None,
+    ) -> None:
+        """
+        Given a dictionary of user ids and the time (in seconds since the
+        epoch) of each user's heartbeat, record them all in a single
+        transaction. If expire_before is given, users whose heartbeat is
+        older than it are removed in the same transaction.
+        """
+        if not timestamps and expire_before is None:
+            return
+        try:
+            self.wrote()
+            transaction = await self.redis.multi()
+            if timestamps:
+                await transaction.zadd(
+                    self.presence_key(),
+                    {
+                        str(user_id): timestamp
+                        for user_id, timestamp in timestamps.items()
+                    },
+                )
+            if expire_before is not None:
+                await transaction.zremrangebyscore(
+                    self.presence_key(),
+                    ZScoreBoundary("-inf"),
+                    ZScoreBoundary(expire_before, exclude_boundary=True),
+                )
+            await transaction.exec()
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error setting presence.",
+                users=len(timestamps),
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+
+    async def get_presence(self, user_ids: Sequence[int]) -> Dict[int, float]:
+        """
+        Return a dictionary of those referenced user ids with a heartbeat,
+        and the time (in seconds since the epoch) of their latest heartbeat.
+        """
+        if not user_ids:
+            return {}
+        try:
+            results = {}
+            transaction = await self.reader().multi()
+            for user_id in user_ids:
+                results[user_id] = await transaction.zscore(
+                    self.presence_key(), str(user_id)
+                )
+            await transaction.exec()
+            scores = {}
+            for user_id, result in results.items():
+                score = await result
+                if score is not None:
+                    scores[user_id] = score
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error getting presence.",
+                user_ids=user_ids,
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+        return scores
+
     async def delete_user(self, email: str) -> None:
         """
         Soft delete the user whilst keeping all the objects owned by the user
@@ -587,44 +948,49 @@ class DataStore:
             raise ex
         logger.msg("Deleted object.", object_id=object_id)
 
-    async def set_container(self, object_id: int, container_id: int) -> None:
+    async def set_container(
+        self, object_id: int, container_id: int
+    ) -> Union[int, None]:
         """
         Ensure the referenced object is set to be contained by the object
         referenced as container_id. If the container_id < 0, then the
         referenced object_id is not contained anywhere.
+
+        The move happens atomically on the Redis server (see SET_CONTAINER).
+        Returns the id of the object's old container, or None if it wasn't
+        contained anywhere.
         """
         try:
-            location_key = self.location_key(object_id)
-            id_val = json.dumps(object_id)
-            # Get current container for the referenced object.
-            old_container_id = await self.redis.get(location_key)
-            transaction = await self.redis.multi()
-            # If required, remove object from old container.
-            if old_container_id:
-                await transaction.srem(
-                    self.inventory_key(json.loads(old_container_id)),
-                    [
-                        id_val,
-                    ],
+            if self.set_container_script is None:
+                self.set_container_script = await self.redis.register_script(
+                    SET_CONTAINER
                 )
-            if container_id < 0:
-                # The object is not contained.
-                await transaction.delete(
-                    [
-                        location_key,
-                    ]
+            self.wrote()
+            keys = [
+                self.location_key(object_id),
+            ]
+            args = [
+                json.dumps(object_id),
+                json.dumps(container_id) if container_id >= 0 else "",
+                self.inventory_key(""),  # type: ignore
+            ]
+            try:
+                reply = await self.set_container_script.run(  # type: ignore
+                    keys=keys, args=args
                 )
-            else:
-                # Add object to new container.
-                await transaction.sadd(
-                    self.inventory_key(container_id),
-                    [
-                        id_val,
-                    ],
+            except ScriptKilledError:
+                # asyncio_redis reports any error from EVALSHA as
+                # ScriptKilledError. Most likely Redis was restarted (or its
+                # script cache flushed) and replied NOSCRIPT, so load the
+                # script again and retry once.
+                logger.msg("Reloading script.", script="set_container")
+                self.set_container_script = await self.redis.register_script(
+                    SET_CONTAINER
                 )
-                # Point object to new container.
-                await transaction.set(location_key, json.dumps(container_id))
-            await transaction.exec()
+                reply = await self.set_container_script.run(  # type: ignore
+                    keys=keys, args=args
+                )
+            old_container_id = await reply.return_value()
         except (Error, ErrorReply) as ex:  # pragma: no cover
             logger.msg(
                 "Error moving object object.",
@@ -635,8 +1001,14 @@ class DataStore:
             )
             raise ex
         logger.msg(
-            "Moved object.", object_id=object_id, container_id=container_id
+            "Moved object.",
+            object_id=object_id,
+            container_id=container_id,
+            old_container_id=old_container_id,
         )
+        if old_container_id:
+            return json.loads(old_container_id)
+        return None
 
     async def get_contents(
         self, object_id: int
@@ -653,11 +1025,18 @@ class DataStore:
         Return a dictionary containing all the objects contained within the
         referenced object.
         """
-        contents = await self.redis.smembers_asset(
+        result = await self.get_objects(await self.get_content_ids(object_id))
+        return result
+
+    async def get_content_ids(self, object_id: int) -> List[int]:
+        """
+        Return the ids of the objects contained within the referenced object,
+        without reading the objects themselves.
+        """
+        contents = await self.reader().smembers_asset(
             self.inventory_key(object_id)
         )
-        result = await self.get_objects([int(i) for i in contents])
-        return result
+        return [int(i) for i in contents]
 
     async def get_user_context(self, user_id: int) -> Dict[str, Any]:
         """
@@ -729,12 +1108,28 @@ class DataStore:
             result["things"] = things
         return result
 
+    async def publish(self, channel: str, message: str) -> int:
+        """
+        Publish the message on the referenced pub/sub channel. Return the
+        number of subscribers that received it.
+        """
+        try:
+            return await self.redis.publish(channel, message)
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error publishing message.",
+                channel=channel,
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+
     async def get_location(self, object_id) -> Union[int, None]:
         """
         Given an object_id, return the id of the object that contains it. If
         the object is not contained within another object, return None.
         """
-        result = await self.redis.get(self.location_key(object_id))
+        result = await self.reader().get(self.location_key(object_id))
         if result:
             return json.loads(result)
         return None
@@ -0,0 +1,133 @@
+"""
+Wraps messages sent to users in an envelope containing the id of the message
+that caused them, a per-recipient sequence number and timestamps recorded
+as the message passes through each stage of the system::
+
+    {
+        "id": "... message_id assigned by Parser.eval ...",
+        "seq": 123,
+        "body": "... HTML fragment to display ...",
+        "t": {
+            "parse": 1600000000.001,
+            "publish": 1600000000.002,
+            "receive": 1600000000.003,
+            "send": 1600000000.004,
+        },
+    }
+
+The timestamps are wall clock time (in seconds) since the stages may happen
+in different processes on different hosts. The latency between stages is
+recorded in histograms when the message is sent to the user.
+
+
+Copyright (C) 2020 Nicholas H.Tollervey (ntoll@ntoll.org).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>
+"""
+import json
+import time
+from contextvars import ContextVar
+from typing import Dict, Any, Union
+from textsmith import metrics
+
+
+#: The message_id and parse time of the user input currently being handled.
+current_message: ContextVar[Union[Dict[str, Any], None]] = ContextVar(
+    "current_message", default=None
+)
+
+
+#: Latency histograms for each stage a message passes through, and for the
+#: message's whole journey from parse to send.
+STAGES = metrics.REGISTRY.histogram(
+    "textsmith_message_latency_seconds",
+    "Latency of messages between the stages of their journey.",
+    ["stage"],
+)
+LATENCY = {
+    name: STAGES.labels(name)
+    for name in [
+        "parse_to_publish",
+        "publish_to_receive",
+        "receive_to_send",
+        "parse_to_send",
+    ]
+}
+
+
+def start(message_id: str) -> None:
+    """
+    Record that the user input with the referenced message_id is being
+    parsed. Messages emitted while handling the input are linked to it.
+    """
+    current_message.set({"message_id": message_id, "parse": time.time()})
+
+
+def wrap(body: str) -> str:
+    """
+    Return a JSON envelope for the referenced message body, ready to be
+    published.
+    """
+    timestamps = {}
+    message_id = None
+    context = current_message.get()
+    if context:
+        message_id = context["message_id"]
+        timestamps["parse"] = context["parse"]
+    timestamps["publish"] = time.time()
+    return json.dumps({"id": message_id, "body": body, "t": timestamps})
+
+
+def receive(raw: str, seq: int) -> Dict[str, Any]:
+    """
+    Unpack a published envelope, annotating the recipient's sequence number
+    and the time it was received. A value that isn't an envelope is treated
+    as the body of a new envelope.
+    """
+    try:
+        envelope = json.loads(raw)
+        if not isinstance(envelope, dict) or "body" not in envelope:
+            raise ValueError("Not an envelope.")
+    except ValueError:
+        envelope = {"id": None, "body": raw, "t": {}}
+    envelope["seq"] = seq
+    envelope["t"]["receive"] = time.time()
+    return envelope
+
+
+def send(envelope: Dict[str, Any]) -> str:
+    """
+    Annotate the time the envelope was sent, record the latency of each
+    stage and return the JSON to send to the user.
+    """
+    timestamps = envelope["t"]
+    timestamps["send"] = time.time()
+    stages = [
+        ("parse_to_publish", "parse", "publish"),
+        ("publish_to_receive", "publish", "receive"),
+        ("receive_to_send", "receive", "send"),
+        ("parse_to_send", "parse", "send"),
+    ]
+    for name, begin, end in stages:
+        if begin in timestamps:
+            duration = max(0.0, timestamps[end] - timestamps[begin])
+            LATENCY[name].observe(duration)
+    return json.dumps(envelope)
+
+
+def latency() -> Dict[str, Any]:
+    """
+    Return snapshots of the latency histograms.
+    """
+    return {name: histogram.snapshot() for name, histogram in LATENCY.items()}
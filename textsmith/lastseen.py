@@ -0,0 +1,103 @@
+"""
+Buffer the times at which users were last seen, and periodically write them
+to the datastore in a single batch.
+
+Copyright (C) 2020 Nicholas H.Tollervey (ntoll@ntoll.org).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>
+"""
+import asyncio
+import time
+import structlog  # type: ignore
+from typing import Dict, Union
+from asyncio_redis.exceptions import Error, ErrorReply  # type: ignore
+from textsmith.datastore import DataStore
+
+
+logger = structlog.get_logger()
+
+
+class LastSeen:
+    """
+    Records user activity in memory so it costs almost nothing per message.
+    Dirty entries are flushed to the datastore every interval seconds.
+    """
+
+    def __init__(self, datastore: DataStore, interval: float = 10.0) -> None:
+        """
+        The datastore object is used to write the buffered timestamps every
+        interval seconds.
+        """
+        self.datastore = datastore
+        self.interval = interval
+        # user_id -> time last seen (seconds since the epoch).
+        self.dirty: Dict[int, float] = {}
+        self.task: Union[asyncio.Task, None] = None
+
+    def touch(self, user_id: int) -> None:
+        """
+        Record that the referenced user has been seen just now.
+        """
+        self.dirty[user_id] = time.time()
+
+    async def flush(self) -> None:
+        """
+        Write all the dirty entries to the datastore in a single batch. If this
+        fails, the entries are kept (unless the user has been seen again in
+        the meantime) so they're written next time.
+        """
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, {}
+        try:
+            await self.datastore.set_last_seen_many(dirty)
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            for user_id, timestamp in dirty.items():
+                self.dirty.setdefault(user_id, timestamp)
+            raise ex
+
+    async def run(self) -> None:
+        """
+        Flush the buffer every interval until cancelled.
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except (Error, ErrorReply):  # pragma: no cover
+                pass  # Already logged. Try again next time.
+
+    def start(self) -> None:
+        """
+        Schedule the task that regularly flushes the buffer.
+        """
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """
+        Cancel the task that regularly flushes the buffer, and flush whatever
+        remains.
+        """
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        try:
+            await self.flush()
+        except (Error, ErrorReply):  # pragma: no cover
+            pass  # Already logged.
+        logger.msg("Stop LastSeen.", unflushed=len(self.dirty))
@@ -1,6 +1,18 @@
 """
 Configure structured logging.
 
+Log entries are rendered as JSON by the code that logs them (since the
+values logged may change afterwards) and put on a bounded queue. A
+background thread writes them to stdout, so logging never waits for I/O. If
+the queue is full, entries are dropped rather than blocking the event loop.
+Noisy events can be sampled so only a fraction of them are logged. Dropped
+entries are counted in the textsmith_log_dropped_total metric.
+
+A policy limits the size of each entry. Long strings are truncated and
+large collections are summarised. Events can be configured to be logged in
+full, with collections summarised (their count and the ids of the objects
+in them) or compactly (with only ids and timings).
+
 Copyright (C) 2020 Nicholas H.Tollervey (ntoll@ntoll.org).
 
 This program is free software: you can redistribute it and/or modify
@@ -16,14 +28,30 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>
 """
-import structlog  # type: ignore
+import atexit
+import json
+import os
 import platform
+import queue
+import random
+import sys
+import threading
+import structlog  # type: ignore
+from typing import Any, Callable, Dict, List, Union
+from textsmith import metrics
 
 
 # Gather host system information.
 host = platform.uname()
 
 
+#: The number of log entries dropped, because they weren't sampled or the
+#: queue of entries to write was full.
+DROPPED = metrics.REGISTRY.counter(
+    "textsmith_log_dropped_total", "Log entries dropped.", ["reason"]
+)
+
+
 def host_info(logger, log_method, event_dict: dict) -> dict:
     """
     Add useful information to each log entry about the system upon which the
@@ -38,13 +66,302 @@ def host_info(logger, log_method, event_dict: dict) -> dict:
     return event_dict
 
 
-# Each log will be timestamped (ISO_8601), have details of the host system,
-# nicely format exceptions if found via the 'exc_info' key, and render as JSON.
-structlog.configure(
-    processors=[
+def parse_pairs(value: str) -> Dict[str, str]:
+    """
+    Return a dictionary of event names and settings from a comma separated
+    list of "event:setting" pairs. Event names may contain spaces.
+    """
+    result = {}
+    for item in value.split(","):
+        event, _, setting = item.strip().rpartition(":")
+        if event:
+            result[event] = setting
+    return result
+
+
+def parse_rates(value: str) -> Dict[str, float]:
+    """
+    Return a dictionary of event names and sample rates from a comma
+    separated list of "event:rate" pairs, e.g. "Message.:0.01".
+    """
+    return {event: float(rate) for event, rate in parse_pairs(value).items()}
+
+
+class Sampler:
+    """
+    A structlog processor that only keeps a fraction of the entries for
+    each of the referenced events. Other events are always kept.
+    """
+
+    def __init__(self, rates: Dict[str, float]) -> None:
+        """
+        The rates are the fraction (0.0 to 1.0) of each event to keep.
+        """
+        self.rates = rates
+        self.dropped = DROPPED.labels("sampled")
+
+    def __call__(self, logger, log_method, event_dict: dict) -> dict:
+        """
+        Drop the entry if its event isn't sampled.
+        """
+        rate = self.rates.get(event_dict.get("event", ""))
+        if rate is not None and random.random() >= rate:
+            self.dropped.inc()
+            raise structlog.DropEvent
+        return event_dict
+
+
+#: The policy modes for logging events.
+MODES = ("full", "summary", "compact")
+#: Fields, other than ids, kept by the compact mode.
+COMPACT_FIELDS = {"event", "duration", "exc_info", "redis_error"}
+
+
+class Policy:
+    """
+    A structlog processor that limits the size of log entries, according to
+    the mode configured for each event:
+
+    * "full" - every field is logged, but strings longer than max_field
+      characters are truncated and collections of more than max_items items
+      are summarised.
+    * "summary" - as full, but every collection is summarised.
+    * "compact" - only the event, ids, durations and errors are logged.
+    """
+
+    def __init__(
+        self,
+        modes: Dict[str, str],
+        max_field: int = 1024,
+        max_items: int = 50,
+        default: str = "full",
+    ) -> None:
+        """
+        The modes are a dictionary of event names and modes. Other events use
+        the default mode.
+        """
+        for mode in list(modes.values()) + [default]:
+            if mode not in MODES:
+                raise ValueError(f"Unknown log policy mode: {mode}")
+        self.modes = modes
+        self.max_field = max_field
+        self.max_items = max_items
+        self.default = default
+
+    def truncate(self, value: str) -> str:
+        """
+        Return the referenced string, truncated to max_field characters.
+        """
+        limit = self.max_field
+        if len(value) <= limit:
+            return value
+        return value[:limit] + f"... ({len(value)} characters)"
+
+    def summarise(self, value: Any) -> Any:
+        """
+        Return a summary of the referenced value. An object (a dictionary
+        with an "id") is summarised as its id. Other collections are
+        summarised as their count and the ids of the objects within them. A
+        dictionary of collections or objects (such as a script context) has
+        each of its values summarised. Other values are left as they are.
+        """
+        limit = self.max_items
+        if isinstance(value, dict):
+            if "id" in value:
+                return value["id"]
+            if any(
+                isinstance(v, (dict, list, tuple, set)) for v in value.values()
+            ):
+                return {key: self.summarise(v) for key, v in value.items()}
+            return {
+                "count": len(value),
+                "keys": [str(key) for key in value][:limit],
+            }
+        if isinstance(value, (list, tuple, set)):
+            ids = [
+                item["id"]
+                for item in value
+                if isinstance(item, dict) and "id" in item
+            ]
+            return {"count": len(value), "ids": ids[:limit]}
+        return value
+
+    def __call__(self, logger, log_method, event_dict: dict) -> dict:
+        """
+        Apply the event's mode to the entry.
+        """
+        mode = self.modes.get(event_dict.get("event", ""), self.default)
+        if mode == "compact":
+            return {
+                key: value
+                for key, value in event_dict.items()
+                if key in COMPACT_FIELDS or key == "id" or key.endswith("_id")
+            }
+        for key, value in event_dict.items():
+            if isinstance(value, str):
+                event_dict[key] = self.truncate(value)
+            elif isinstance(value, (dict, list, tuple, set)) and (
+                mode == "summary" or len(value) > self.max_items
+            ):
+                event_dict[key] = self.summarise(value)
+        return event_dict
+
+
+def serializer(name: str) -> Callable[..., str]:
+    """
+    Return a function to serialize log entries to JSON, using the named
+    library: "json" (the default) or "orjson" (which is much faster, if
+    installed).
+    """
+    if name == "orjson":
+        try:
+            import orjson  # type: ignore
+        except ImportError:  # pragma: no cover
+            return json.dumps
+
+        def dumps(obj: Any, **kwargs: Any) -> str:
+            return orjson.dumps(obj, default=kwargs.get("default")).decode()
+
+        return dumps
+    return json.dumps
+
+
+class QueueSink:
+    """
+    Writes rendered log entries to a stream from a background thread. Used
+    as the logger that structlog sends rendered entries to.
+    """
+
+    def __init__(
+        self, maxsize: int = 10000, stream: Union[Any, None] = None
+    ) -> None:
+        """
+        At most maxsize entries wait to be written. If no stream is given,
+        entries are written to stdout.
+        """
+        self.queue: queue.Queue = queue.Queue(maxsize)
+        self.stream = stream
+        self.dropped = DROPPED.labels("full")
+        self.thread: Union[threading.Thread, None] = None
+
+    def msg(self, message: str) -> None:
+        """
+        Queue the rendered entry to be written, or drop it if the queue is
+        full.
+        """
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self.dropped.inc()
+
+    # The same method handles every log level (as with structlog's
+    # PrintLogger).
+    debug = info = warning = error = critical = exception = msg
+
+    def write(self, lines: List[str]) -> None:
+        """
+        Write the referenced entries to the stream.
+        """
+        stream = self.stream or sys.stdout
+        stream.write("\n".join(lines) + "\n")
+        stream.flush()
+
+    def run(self) -> None:
+        """
+        Write queued entries, in batches, until a None is queued.
+        """
+        while True:
+            lines = [self.queue.get()]
+            while len(lines) < 1000:
+                try:
+                    lines.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = None in lines
+            lines = [line for line in lines if line is not None]
+            if lines:
+                self.write(lines)
+            if done:
+                return
+
+    def start(self) -> None:
+        """
+        Start the thread that writes entries.
+        """
+        self.thread = threading.Thread(
+            target=self.run, name="textsmith-log", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self) -> None:
+        """
+        Write any queued entries and stop the thread.
+        """
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+def configure(
+    sample: Union[Dict[str, float], None] = None,
+    json_library: str = "json",
+    sink: Union[QueueSink, None] = None,
+    policy: Union[Policy, None] = None,
+) -> None:
+    """
+    Configure structlog to sample the referenced events, limit the size of
+    entries with the policy, render entries as JSON with the named library
+    and write them via the referenced sink (or synchronously to stdout if
+    there isn't one).
+    """
+    # Each log will be timestamped (ISO_8601), have details of the host
+    # system, nicely format exceptions if found via the 'exc_info' key, and
+    # render as JSON.
+    processors: List[Any] = [
         structlog.processors.TimeStamper(fmt="iso"),
         host_info,
         structlog.processors.format_exc_info,
-        structlog.processors.JSONRenderer(),
+        structlog.processors.JSONRenderer(serializer(json_library)),
     ]
+    if policy is not None:
+        processors.insert(0, policy)
+    if sample:
+        processors.insert(0, Sampler(sample))
+    if sink is None:
+        structlog.configure(
+            processors=processors,
+            logger_factory=structlog.PrintLoggerFactory(),
+        )
+    else:
+        structlog.configure(
+            processors=processors, logger_factory=lambda *args: sink
+        )
+
+
+# The per-message events are sampled by default.
+sample = parse_rates(
+    os.environ.get(
+        "TEXTSMITH_LOG_SAMPLE",
+        "Message.:0.01,Incoming message.:0.01,Outgoing message.:0.01",
+    )
+)
+json_library = os.environ.get("TEXTSMITH_LOG_JSON", "json")
+# Contexts and request headers are summarised by default.
+policy = Policy(
+    parse_pairs(
+        os.environ.get(
+            "TEXTSMITH_LOG_POLICY",
+            "User context.:summary,Script context.:summary,Access:summary",
+        )
+    ),
+    int(os.environ.get("TEXTSMITH_LOG_MAX_FIELD", 1024)),
+    int(os.environ.get("TEXTSMITH_LOG_MAX_ITEMS", 50)),
 )
+queue_size = int(os.environ.get("TEXTSMITH_LOG_QUEUE", 10000))
+sink = None
+if queue_size > 0:
+    sink = QueueSink(queue_size)
+    sink.start()
+    atexit.register(sink.stop)
+configure(sample, json_library, sink, policy)
@@ -16,20 +16,28 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>
 """
+import time
 import aiosmtplib  # type: ignore
 import structlog  # type: ignore
 import markdown  # type: ignore
-from typing import Sequence, Dict, Union, Tuple
+from typing import Sequence, Dict, List, Union, Tuple
 from email.message import EmailMessage
 from uuid import uuid4
 from flask_babel import gettext as _  # type: ignore
 from textsmith.datastore import DataStore
-from textsmith import constants
+from textsmith.outbox import Outbox
+from textsmith import constants, envelope, metrics
 
 
 logger = structlog.get_logger()
 
 
+#: How long it takes to render messages emitted to users with Markdown.
+MARKDOWN = metrics.REGISTRY.histogram(
+    "textsmith_markdown_seconds", "Time spent rendering Markdown."
+).labels()
+
+
 class Logic:
     """
     Gathers together methods which implement application logic. Uses the
@@ -43,16 +51,20 @@ class Logic:
         email_port: int,
         email_from: str,
         email_password: str,
+        outbox: Union[Outbox, None] = None,
     ) -> None:
         """
         The datastore object contains methods for getting, setting and
-        searching the permenant data store.
+        searching the permenant data store. If an outbox is given, email is
+        queued there for delivery in the background rather than sent
+        immediately.
         """
         self.datastore = datastore
         self.email_host = email_host
         self.email_port = email_port
         self.email_from = email_from
         self.email_password = email_password
+        self.outbox = outbox
 
     async def verify_credentials(self, email: str, password: str) -> int:
         """
@@ -119,12 +131,16 @@ class Logic:
     async def send_email(self, message: EmailMessage) -> None:
         """
         Asynchronously log and send the referenced email.message.EmailMessage.
+        If there's an outbox the message is queued there instead.
         """
         logger.msg(
             "Send email.",
             content=message.get_content(),
             **{k: v for k, v in message.items()},
         )
+        if self.outbox:
+            await self.outbox.put(message)
+            return
         await aiosmtplib.send(
             message,
             hostname=self.email_host,
@@ -137,13 +153,15 @@ class Logic:
     async def emit_to_user(self, user_id: int, message: str) -> None:
         """
         Emit a message to the referenced user. All messages are run through
-        Markdown.
+        Markdown and published in an envelope (see the envelope module).
         """
+        started = time.monotonic()
         output = markdown.markdown(
             str(message),
             extensions=["textsmith.mdx.video", "textsmith.mdx.audio"],
         )
-        await self.datastore.redis.publish(str(user_id), output)
+        MARKDOWN.observe(time.monotonic() - started)
+        await self.datastore.publish(str(user_id), envelope.wrap(output))
 
     async def emit_to_room(
         self, room_id: int, exclude: Sequence[int], message: str
@@ -195,7 +213,11 @@ class Logic:
                 "exits": [{ ... exits from the room ... }, ],
                 "users": [{ ... other users in the room ...}, ],
                 "things": [{ ... other objects in the room ...}, ],
+                "index": { ... see index_context ... },
             }
+
+        The index is built once here so repeated calls to match_object with
+        the same context don't have to scan every candidate object.
         """
         result = await self.datastore.get_script_context(user_id)
         logger.msg(
@@ -205,8 +227,51 @@ class Logic:
             message_id=message_id,
             context=result,
         )
+        result["index"] = self.index_context(result)
         return result
 
+    def index_context(self, context: Dict) -> Dict:
+        """
+        Return an index of the objects in the given script context to which
+        the user may refer::
+
+            {
+                "ids": {object_id: [obj, ], },
+                "names": {"normalised name or alias": [obj, ], },
+                "longest": number of words in the longest name or alias,
+            }
+
+        Names and aliases are normalised to lower case with whitespace
+        collapsed to single spaces. The objects in each list retain the order
+        of the candidates in the context (user, room, exits, users then
+        things) and each object appears at most once per entry.
+        """
+        candidate_objects = (
+            [
+                context["user"],
+                context["room"],
+            ]
+            + context["exits"]
+            + context["users"]
+            + context["things"]
+        )
+        ids: Dict[int, List[Dict]] = {}
+        names: Dict[str, List[Dict]] = {}
+        longest = 0
+        for obj in candidate_objects:
+            ids.setdefault(obj["id"], []).append(obj)
+            keys = set()
+            for name in [obj.get(constants.NAME, "")] + list(
+                obj.get(constants.ALIAS, [])
+            ):
+                words = name.lower().split()
+                if words:
+                    keys.add(" ".join(words))
+                    longest = max(longest, len(words))
+            for key in sorted(keys):
+                names.setdefault(key, []).append(obj)
+        return {"ids": ids, "names": names, "longest": longest}
+
     async def get_attribute_value(self, obj: Dict, attribute: str) -> str:
         """
         Return the value of the referenced object attribute. If the value is
@@ -273,60 +338,34 @@ class Logic:
                 context["room"],
             ], words[0]
 
-        # Candidate objects are things in the current context to which the user
-        # may refer.
-        candidate_objects = (
-            [
-                context["user"],
-                context["room"],
-            ]
-            + context["exits"]
-            + context["users"]
-            + context["things"]
-        )
+        # The index of things in the current context to which the user may
+        # refer. Contexts not created by get_script_context are indexed here.
+        index = context.get("index")
+        if index is None:
+            index = self.index_context(context)
 
         # Check for object id in candidate objects.
         if constants.MATCH_OBJECT_ID.match(words[0]):
             object_id = int(words[0][1:])
-            matches = [
-                obj for obj in candidate_objects if obj["id"] == object_id
-            ]
+            matches = index["ids"].get(object_id, [])
             if matches:
                 # Matches by valid object_id.
-                return matches, words[0]
+                return list(matches), words[0]
             else:
                 # No match for a valid object_id.
                 return [], ""
 
-        # Check for matching names or aliases.
-        matched_objects = []
-        word_list = []
-        for word in words:
-            word_list.append(word)
-            name = " ".join(word_list)
-            for obj in candidate_objects:
-                if self.matches_name(name, obj):
-                    matched_objects.append(obj)
+        # Check for matching names or aliases, shortest first. No name is
+        # longer than index["longest"] words, so stop looking after that.
+        name = ""
+        for word in words[: index["longest"]]:
+            name = f"{name} {word}" if name else word
+            matched_objects = index["names"].get(name)
             if matched_objects:
-                return matched_objects, name
+                return list(matched_objects), name
         # No matches.
         return [], ""
 
-    def matches_name(self, name: str, obj: Dict) -> bool:
-        """
-        Returns a boolean indication if the referenced object matches the
-        given name. This is case insensitive and checks the name and alias list
-        for a name match.
-        """
-        name = name.lower()
-        obj_name = obj.get(constants.NAME, "").lower()
-        if obj_name == name:
-            return True
-        aliases = [alias.lower() for alias in obj.get(constants.ALIAS, [])]
-        if name in aliases:
-            return True
-        return False
-
     async def clarify_object(
         self, user_id: int, message: str, match: Sequence[Dict]
     ) -> None:
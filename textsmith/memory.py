@@ -0,0 +1,435 @@
+"""
+In-process replacements for the Redis backed DataStore and PubSub. They have
+the same async API and semantics, and are useful for fast deterministic
+tests and load tests, single node development, and for measuring the
+overhead of the application separately from the cost of the network.
+
+Nothing is persisted: the world only lasts as long as the process.
+
+Copyright (C) 2020 Nicholas H.Tollervey (ntoll@ntoll.org).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>
+"""
+import asyncio
+import json
+import structlog  # type: ignore
+from datetime import datetime
+from typing import Sequence, Dict, List, Set, Tuple, Union, Any
+from textsmith.datastore import DataStore
+from textsmith.pubsub import PubSub
+from textsmith import constants, envelope
+
+
+logger = structlog.get_logger()
+
+
+class MemoryPubSub(PubSub):
+    """
+    A PubSub whose messages are published in-process rather than via Redis.
+    Messages for users connected to the instance are queued exactly as they
+    would be by PubSub.listen.
+    """
+
+    def __init__(self) -> None:
+        """
+        There are no shards, listeners or watchdog: messages are delivered as
+        soon as they're published.
+        """
+        # Key: user_id Value: queue of pending messages.
+        self.connected_users = {}  # type: dict
+        # Key: user_id Value: sequence number of the last message received
+        # for the user.
+        self.sequences = {}  # type: Dict[int, int]
+        self.shards = []  # type: list
+        self.listeners = []  # type: list
+        self.watchdog = None
+        self.messages = 0
+
+    def listening_for(self, user_id: int) -> bool:
+        """
+        Messages are always retrievable, since there's no connection to lose.
+        """
+        return True
+
+    async def subscribe(self, user_id: int, connection_id: str) -> None:
+        """
+        Ensure there's an entry for the referenced user's message queue.
+        """
+        self.connected_users[user_id] = asyncio.Queue()
+        self.sequences[user_id] = 0
+        logger.msg("Subscribe.", user_id=user_id, connection_id=connection_id)
+
+    async def unsubscribe(self, user_id: int, connection_id: str) -> None:
+        """
+        Delete the message queue for the referenced user.
+        """
+        self.connected_users.pop(user_id, None)
+        self.sequences.pop(user_id, None)
+        logger.msg(
+            "Unsubscribe.", user_id=user_id, connection_id=connection_id
+        )
+
+    async def publish(self, channel: str, message: str) -> int:
+        """
+        Deliver the message to the user whose id is the referenced channel,
+        if they're connected. Return the number of subscribers that received
+        it (0 or 1).
+        """
+        self.messages += 1
+        user_id = int(channel)
+        logger.msg("Message.", user_id=user_id, value=message)
+        if user_id not in self.connected_users:
+            return 0
+        seq = self.sequences.get(user_id, 0) + 1
+        self.sequences[user_id] = seq
+        self.connected_users[user_id].put_nowait(
+            envelope.receive(message, seq)
+        )
+        return 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return a dictionary of statistics in the same form as PubSub.stats.
+        """
+        result = super().stats()
+        result["channels"] = len(self.connected_users)
+        result["messages"] = self.messages
+        return result
+
+
+class MemoryDataStore(DataStore):
+    """
+    A DataStore that keeps the world in Python data structures. Attribute
+    values are stored as JSON, just as they are in Redis, so values behave in
+    exactly the same way (e.g. tuples come back as lists).
+    """
+
+    def __init__(self, pubsub: Union[MemoryPubSub, None] = None) -> None:
+        """
+        If a MemoryPubSub is given, published messages are delivered to it.
+        """
+        super().__init__(None)
+        self.pubsub = pubsub
+        self.object_counter = 0
+        # Key: object id Value: attribute name -> JSON value.
+        self.objects: Dict[int, Dict[str, str]] = {}
+        # Key: email Value: field -> JSON value.
+        self.users: Dict[str, Dict[str, str]] = {}
+        # Key: confirmation token Value: email.
+        self.tokens: Dict[str, str] = {}
+        # Key: object id Value: id of the containing object.
+        self.locations: Dict[int, int] = {}
+        # Key: object id Value: ids of the contained objects.
+        self.inventories: Dict[int, Set[int]] = {}
+        # Key: user id Value: seconds since the epoch.
+        self.last_seen: Dict[int, float] = {}
+        # Key: user id Value: seconds since the epoch of the last heartbeat.
+        self.presence: Dict[int, float] = {}
+
+    async def add_object(self, **attributes: Any) -> int:
+        """
+        Create a new object with the referenced attributes.
+        """
+        return (await self.add_objects(attributes))[0]
+
+    async def add_objects(self, *objects: Dict[str, Any]) -> List[int]:
+        """
+        Create a new object for each of the referenced dictionaries of
+        attributes. Return a list of the ids of the new objects.
+        """
+        object_ids = []
+        for attributes in objects:
+            self.object_counter += 1
+            object_id = self.object_counter
+            if attributes:
+                self.objects[object_id] = {
+                    attribute: json.dumps(value)
+                    for attribute, value in attributes.items()
+                }
+            object_ids.append(object_id)
+        logger.msg("Created new objects.", object_ids=object_ids)
+        return object_ids
+
+    async def annotate_object(self, object_id: int, **attributes: Any) -> None:
+        """
+        Annotate attributes to the object.
+        """
+        self.objects.setdefault(object_id, {}).update(
+            {
+                attribute: json.dumps(value)
+                for attribute, value in attributes.items()
+            }
+        )
+        logger.msg(
+            "Annotated attributes to object.",
+            object_id=object_id,
+            data=attributes,
+        )
+
+    async def get_objects(self, ids: Sequence[int]) -> Dict[int, Dict]:
+        """
+        Given a list of object IDs, return a dictionary whose keys are object
+        IDs and values are a dictionary of the related attributes of each
+        object. Deleted objects are ignored.
+        """
+        result = {}
+        for object_id in ids:
+            values = self.objects.get(object_id, {})
+            if constants.IS_DELETED in values:
+                continue
+            obj = {key: json.loads(value) for key, value in values.items()}
+            obj["id"] = object_id
+            result[object_id] = obj
+        return result
+
+    async def get_attribute(self, object_id: int, attribute: str) -> Any:
+        """
+        Given an object ID and attribute, return the associated value or raise
+        a KeyError to indicate the attribute doesn't exist on the object.
+        """
+        result = self.objects.get(object_id, {}).get(attribute)
+        if result is None:
+            raise KeyError(
+                f"Attribute '{attribute}' on #{object_id} does not exist."
+            )
+        return json.loads(result)
+
+    async def get_attributes(
+        self, requests: Sequence[Tuple[int, str]]
+    ) -> Dict[Tuple[int, str], Any]:
+        """
+        Given a list of (object ID, attribute) pairs, return a dictionary of
+        the values of those that exist.
+        """
+        values = {}
+        for object_id, attribute in requests:
+            value = self.objects.get(object_id, {}).get(attribute)
+            if value is not None:
+                values[(object_id, attribute)] = json.loads(value)
+        return values
+
+    async def delete_attributes(
+        self, object_id: int, attributes: Sequence[str]
+    ) -> int:
+        """
+        Given an object ID and list of attributes, delete them. Returns the
+        number of attributes deleted.
+        """
+        values = self.objects.get(object_id, {})
+        number_changed = 0
+        for attribute in set(attributes):
+            if values.pop(attribute, None) is not None:
+                number_changed += 1
+        logger.msg(
+            f"Deleted {number_changed} attributes from object.",
+            object_id=object_id,
+            attributes=attributes,
+        )
+        return number_changed
+
+    async def user_exists(self, email: str) -> bool:
+        """
+        Returns a boolean indication if a user linked to the referenced email
+        address exists within the system.
+        """
+        return email in self.users
+
+    async def create_user(self, email: str, confirmation_token: str) -> int:
+        """
+        Create the new user identified by the referenced email address, and
+        the link from the confirmation token to the user. Return the id of the
+        object associated with this user.
+        """
+        object_id = await self.add_object(**{constants.IS_USER: True})
+        user = {"email": email, "active": False, "object_id": object_id}
+        data = {key: json.dumps(value) for key, value in user.items()}
+        self.users.setdefault(email, {}).update(data)
+        self.tokens[confirmation_token] = email
+        logger.msg("Created user.", user=data)
+        return object_id
+
+    async def token_to_email(
+        self, confirmation_token: str
+    ) -> Union[str, None]:
+        """
+        Given a confirmation token, return the related email address or None.
+        """
+        return self.tokens.get(confirmation_token) or None
+
+    async def email_to_object_id(self, email: str) -> int:
+        """
+        Return the id of the in game object representing the player identified
+        by the referenced email address, or 0 if there isn't one.
+        """
+        object_id = self.users.get(email, {}).get("object_id")
+        if object_id:
+            return json.loads(object_id)
+        return 0
+
+    async def set_user_password(self, email: str, password: str) -> bool:
+        """
+        Update the password of the referenced active user.
+        """
+        flag = self.users.get(email, {}).get("active")
+        if flag and json.loads(flag):
+            self.users[email]["password"] = json.dumps(
+                self.hash_password(password)
+            )
+            logger.msg("Set password.", user_email=email)
+            return True
+        return False
+
+    async def confirm_user(
+        self, confirmation_token: str, password: str
+    ) -> str:
+        """
+        Given a confirmation token, activate the related user and set their
+        password. The token can only be used once.
+        """
+        email = await self.token_to_email(confirmation_token)
+        if not email:
+            msg = "Unable to confirm user with token."
+            logger.msg(msg, confirmation_token=confirmation_token)
+            raise ValueError(msg)
+        await self.set_user_active(email, True)
+        await self.set_user_password(email, password)
+        self.tokens.pop(confirmation_token, None)
+        logger.msg("User confirmed email address.", user_email=email)
+        return email
+
+    async def verify_user(self, email: str, password: str) -> bool:
+        """
+        Check the credentials are valid for signing into the system.
+        """
+        result = self.users.get(email)
+        if not result:
+            return False
+        user_data = {key: json.loads(val) for key, val in result.items()}
+        if not user_data.get("active", False):
+            return False
+        return self.verify_password(user_data["password"], password)
+
+    async def set_user_active(
+        self, email: str, active_flag: bool = True
+    ) -> None:
+        """
+        Set the "active" flag of the referenced user.
+        """
+        self.users.setdefault(email, {})["active"] = json.dumps(active_flag)
+        logger.msg(
+            "Set user active flag.", user_email=email, active=active_flag
+        )
+
+    async def set_last_seen_many(self, timestamps: Dict[int, float]) -> None:
+        """
+        Record the time at which each of the referenced users was last seen.
+        """
+        if timestamps:
+            self.last_seen.update(timestamps)
+            logger.msg("Set last seen.", users=len(timestamps))
+
+    async def get_last_seen(self, user_id: int) -> Union[datetime, None]:
+        """
+        Return a datetime object representing the moment the referenced user
+        was last seen, or None.
+        """
+        timestamp = self.last_seen.get(user_id)
+        if timestamp is None:
+            return None
+        return datetime.fromtimestamp(timestamp)
+
+    async def get_recently_seen(self, since: float) -> Dict[int, datetime]:
+        """
+        Return the ids of users seen since the referenced time, and when.
+        """
+        return {
+            user_id: datetime.fromtimestamp(timestamp)
+            for user_id, timestamp in self.last_seen.items()
+            if timestamp >= since
+        }
+
+    async def set_presence(
+        self,
+        timestamps: Dict[int, float],
+        expire_before: Union[float, None] = None,
+    ) -> None:
+        """
+        Record the time of each of the referenced users' heartbeat, and
+        remove users whose heartbeat is older than expire_before (if given).
+        """
+        self.presence.update(timestamps)
+        if expire_before is not None:
+            for user_id, timestamp in list(self.presence.items()):
+                if timestamp < expire_before:
+                    del self.presence[user_id]
+
+    async def get_presence(self, user_ids: Sequence[int]) -> Dict[int, float]:
+        """
+        Return the time of the heartbeat of each referenced user who has one.
+        """
+        return {
+            user_id: self.presence[user_id]
+            for user_id in user_ids
+            if user_id in self.presence
+        }
+
+    async def set_container(
+        self, object_id: int, container_id: int
+    ) -> Union[int, None]:
+        """
+        Ensure the referenced object is contained by the object referenced
+        as container_id (or not contained anywhere if container_id < 0).
+        Returns the id of the old container, or None.
+        """
+        old_container_id = self.locations.pop(object_id, None)
+        if old_container_id is not None:
+            self.inventories.get(old_container_id, set()).discard(object_id)
+        if container_id >= 0:
+            self.inventories.setdefault(container_id, set()).add(object_id)
+            self.locations[object_id] = container_id
+        logger.msg(
+            "Moved object.",
+            object_id=object_id,
+            container_id=container_id,
+            old_container_id=old_container_id,
+        )
+        return old_container_id
+
+    async def get_contents(self, object_id: int) -> Dict[int, Dict]:
+        """
+        Return a dictionary containing all the objects contained within the
+        referenced object.
+        """
+        return await self.get_objects(await self.get_content_ids(object_id))
+
+    async def get_content_ids(self, object_id: int) -> List[int]:
+        """
+        Return the ids of the objects contained within the referenced object.
+        """
+        return list(self.inventories.get(object_id, set()))
+
+    async def get_location(self, object_id) -> Union[int, None]:
+        """
+        Return the id of the object that contains the referenced object, or
+        None.
+        """
+        return self.locations.get(object_id)
+
+    async def publish(self, channel: str, message: str) -> int:
+        """
+        Deliver the message via the MemoryPubSub, if there is one.
+        """
+        if self.pubsub:
+            return await self.pubsub.publish(channel, message)
+        return 0
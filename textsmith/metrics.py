@@ -0,0 +1,535 @@
+"""
+Simple in-process metrics for TextSmith.
+
+Metrics are registered with the module level REGISTRY, so any module can
+define and update them, and are rendered in the Prometheus text format by
+the /metrics endpoint. Each metric is a family of counters, gauges or
+histograms, one for each combination of label values::
+
+    COMMANDS = metrics.REGISTRY.counter(
+        "textsmith_commands_total", "Commands evaluated.", ["verb"]
+    )
+    COMMANDS.labels("look").inc()
+
+Updating a metric is a dictionary lookup and an addition. There are no
+locks, since everything happens on the event loop's thread. Values that are
+expensive to keep up to date (such as queue depths) are gauges whose value
+is read from a function only when the metrics are rendered.
+
+When several worker processes serve the application, each worker's
+Exporter periodically writes its samples to a directory shared by the
+workers, so the /metrics endpoint of any worker reports them all (labelled
+by worker).
+
+Copyright (C) 2020 Nicholas H.Tollervey (ntoll@ntoll.org).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>
+"""
+import asyncio
+import bisect
+import functools
+import inspect
+import json
+import math
+import os
+import time
+from typing import Dict, Sequence, Any, Callable, List, Tuple, Union
+
+
+#: Default upper bounds (in seconds) for the buckets of a latency histogram.
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Histogram:
+    """
+    Counts observed values into buckets with fixed upper bounds, and keeps a
+    running count and sum of all the observed values.
+    """
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        """
+        The buckets are the upper bounds of each bucket. An extra bucket
+        counts values greater than the largest bound.
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """
+        Record the referenced value.
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Return a dictionary containing the count, sum and cumulative count of
+        values less than or equal to each bucket's upper bound ("+Inf" for
+        all values).
+        """
+        buckets = {}
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        buckets["+Inf"] = self.count
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+class Counter:
+    """
+    A value that only ever goes up.
+    """
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        """
+        Increase the value by the referenced amount.
+        """
+        self.value += amount
+
+
+class Gauge:
+    """
+    A value that can go up and down.
+    """
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        """
+        Set the value.
+        """
+        self.value = float(value)
+
+    def inc(self, amount: float = 1.0) -> None:
+        """
+        Increase the value by the referenced amount.
+        """
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        """
+        Decrease the value by the referenced amount.
+        """
+        self.value -= amount
+
+
+class Family:
+    """
+    A named metric with a counter, gauge or histogram for each combination
+    of values of its labels.
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        name: str,
+        description: str,
+        labels: Sequence[str],
+        factory: Callable[[], Any],
+        function: Union[Callable[[], Any], None] = None,
+    ) -> None:
+        """
+        The kind is "counter", "gauge" or "histogram", and the factory makes
+        a new child metric. If a function is given, it's called when the
+        metrics are rendered and returns the current value (or a dictionary
+        of tuples of label values and values) of a gauge.
+        """
+        self.kind = kind
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labels)
+        self.factory = factory
+        self.function = function
+        # Key: tuple of label values Value: child metric.
+        self.children: Dict[Tuple[str, ...], Any] = {}
+
+    def labels(self, *values: Any) -> Any:
+        """
+        Return the child metric for the referenced label values.
+        """
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(
+                    f"{self.name} expects labels {self.labelnames}."
+                )
+            child = self.children[values] = self.factory()
+        return child
+
+    async def collect(self) -> Dict[Tuple[str, ...], Any]:
+        """
+        Return the children of the family, reading gauges from the function
+        (which may be a coroutine function) if there is one.
+        """
+        if self.function is None:
+            return self.children
+        value = self.function()
+        if inspect.isawaitable(value):
+            value = await value
+        if not isinstance(value, dict):
+            value = {(): value}
+        result = {}
+        for labels, number in value.items():
+            gauge = Gauge()
+            gauge.set(number)
+            result[tuple(str(label) for label in labels)] = gauge
+        return result
+
+
+def format_value(value: float) -> str:
+    """
+    Return the referenced value as a Prometheus sample value.
+    """
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def format_labels(labels: Dict[str, Any]) -> str:
+    """
+    Return the Prometheus representation of the referenced labels, or an
+    empty string if there aren't any.
+    """
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels.items():
+        escaped = (
+            str(value)
+            .replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n")
+        )
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_families(families: Dict[str, Dict[str, Any]]) -> str:
+    """
+    Return the referenced families of samples (see Registry.collect) in the
+    Prometheus text format.
+    """
+    lines: List[str] = []
+    for name, family in sorted(families.items()):
+        lines.append(f"# HELP {name} {family['description']}")
+        lines.append(f"# TYPE {name} {family['kind']}")
+        for sample, labels, value in family["samples"]:
+            lines.append(
+                f"{sample}{format_labels(labels)} {format_value(value)}"
+            )
+    return "\n".join(lines) + "\n"
+
+
+class Registry:
+    """
+    The metrics of the application, rendered in the Prometheus text format.
+    Registering a metric that already exists returns the existing family.
+    """
+
+    def __init__(self) -> None:
+        # Key: metric name Value: family of metrics.
+        self.families: Dict[str, Family] = {}
+
+    def register(
+        self,
+        kind: str,
+        name: str,
+        description: str,
+        labels: Sequence[str],
+        factory: Callable[[], Any],
+        function: Union[Callable[[], Any], None] = None,
+    ) -> Family:
+        """
+        Return the family with the referenced name, creating it if needed.
+        """
+        family = self.families.get(name)
+        if family is None:
+            family = Family(kind, name, description, labels, factory, function)
+            self.families[name] = family
+        elif family.kind != kind:
+            raise ValueError(f"{name} is already a {family.kind}.")
+        elif function is not None:
+            family.function = function
+        return family
+
+    def counter(
+        self, name: str, description: str, labels: Sequence[str] = ()
+    ) -> Family:
+        """
+        Return the family of counters with the referenced name.
+        """
+        return self.register("counter", name, description, labels, Counter)
+
+    def gauge(
+        self,
+        name: str,
+        description: str,
+        labels: Sequence[str] = (),
+        function: Union[Callable[[], Any], None] = None,
+    ) -> Family:
+        """
+        Return the family of gauges with the referenced name. If a function
+        is given, the gauges are read from it when they're rendered.
+        """
+        return self.register(
+            "gauge", name, description, labels, Gauge, function
+        )
+
+    def histogram(
+        self,
+        name: str,
+        description: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Family:
+        """
+        Return the family of histograms with the referenced name.
+        """
+        return self.register(
+            "histogram",
+            name,
+            description,
+            labels,
+            lambda: Histogram(buckets),
+        )
+
+    async def collect(self, **labels: Any) -> Dict[str, Dict[str, Any]]:
+        """
+        Return a dictionary of the current samples of every metric, keyed by
+        name. Each contains the "kind", "description" and a list of
+        "samples" of [sample name, labels, value]. The referenced labels are
+        added to every sample. The result can be serialized as JSON.
+        """
+        result = {}
+        for name, family in self.families.items():
+            samples: List[List[Any]] = []
+            children = await family.collect()
+            for values, child in sorted(
+                children.items(), key=lambda item: [str(v) for v in item[0]]
+            ):
+                child_labels = dict(zip(family.labelnames, values), **labels)
+                if family.kind != "histogram":
+                    samples.append([name, child_labels, child.value])
+                    continue
+                snapshot = child.snapshot()
+                for bound, count in snapshot["buckets"].items():
+                    samples.append(
+                        [f"{name}_bucket", dict(child_labels, le=bound), count]
+                    )
+                samples.append([f"{name}_sum", child_labels, snapshot["sum"]])
+                samples.append(
+                    [f"{name}_count", child_labels, snapshot["count"]]
+                )
+            result[name] = {
+                "kind": family.kind,
+                "description": family.description,
+                "samples": samples,
+            }
+        return result
+
+    async def render(self) -> str:
+        """
+        Return all the metrics in the Prometheus text format.
+        """
+        return format_families(await self.collect())
+
+
+#: The metrics of the application.
+REGISTRY = Registry()
+
+
+def instrument(obj: Any, family: Family) -> None:
+    """
+    Replace each public coroutine method of the referenced object with one
+    that records how long it took in the family of histograms, labelled with
+    the method's name.
+    """
+
+    def timed(name: str, method: Any) -> Any:
+        histogram = family.labels(name)
+
+        @functools.wraps(method)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            started = time.monotonic()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                histogram.observe(time.monotonic() - started)
+
+        return wrapper
+
+    for name, method in inspect.getmembers(obj, inspect.iscoroutinefunction):
+        if not name.startswith("_"):
+            setattr(obj, name, timed(name, method))
+
+
+class LoopMonitor:
+    """
+    Measures how late the event loop wakes up a task that sleeps for a fixed
+    interval. Lag means something is blocking the loop (or it has more work
+    than it can keep up with), so every coroutine is delayed by as much.
+    """
+
+    def __init__(self, family: Family, interval: float = 0.5) -> None:
+        """
+        The lag is recorded every interval seconds in the referenced family
+        of histograms.
+        """
+        self.histogram = family.labels()
+        self.interval = interval
+        self.lag = 0.0
+        # The time.monotonic() at which the task last woke up.
+        self.beat = time.monotonic()
+        self.task: Union[asyncio.Task, None] = None
+
+    async def run(self) -> None:
+        """
+        Record the lag of the event loop every interval until cancelled.
+        """
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.beat = time.monotonic()
+            self.lag = max(0.0, self.beat - started - self.interval)
+            self.histogram.observe(self.lag)
+
+    def start(self) -> None:
+        """
+        Schedule the task that monitors the event loop.
+        """
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """
+        Cancel the task that monitors the event loop.
+        """
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+class Exporter:
+    """
+    Shares the metrics of one worker process with the other workers, via
+    files in a directory they all use.
+    """
+
+    def __init__(
+        self,
+        registry: Registry,
+        directory: str,
+        worker: str,
+        interval: float = 5.0,
+    ) -> None:
+        """
+        The samples of the registry are labelled with the worker's name and
+        written to the directory every interval seconds.
+        """
+        self.registry = registry
+        self.directory = directory
+        self.worker = worker
+        self.interval = interval
+        self.path = os.path.join(directory, f"{worker}.json")
+        self.task: Union[asyncio.Task, None] = None
+
+    async def export(self) -> None:
+        """
+        Write the worker's current samples to its file. The file is replaced
+        in one step, so other workers never read a partly written file.
+        """
+        families = await self.registry.collect(worker=self.worker)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as output:
+            json.dump(families, output)
+        os.replace(temporary, self.path)
+
+    async def render(self) -> str:
+        """
+        Return the current metrics of this worker, and the last exported
+        metrics of the other workers, in the Prometheus text format.
+        """
+        families = await self.registry.collect(worker=self.worker)
+        for filename in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, filename)
+            if not filename.endswith(".json") or path == self.path:
+                continue
+            try:
+                with open(path) as source:
+                    other = json.load(source)
+            except (OSError, ValueError):  # pragma: no cover
+                continue  # The worker has just stopped.
+            for name, family in other.items():
+                merged = families.setdefault(name, dict(family, samples=[]))
+                merged["samples"].extend(family["samples"])
+        return format_families(families)
+
+    async def run(self) -> None:
+        """
+        Export the worker's metrics every interval until cancelled.
+        """
+        while True:
+            await self.export()
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        """
+        Schedule the task that exports the worker's metrics.
+        """
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """
+        Cancel the task that exports the worker's metrics, and remove the
+        worker's file so its metrics are no longer reported.
+        """
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
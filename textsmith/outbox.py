@@ -0,0 +1,429 @@
+"""
+A persistent outbox for email. Messages are queued in Redis and delivered by
+a background task over a small pool of long-lived SMTP connections, so the
+time taken to talk to the mail relay is never spent in a request handler.
+
+Messages being sent are moved (atomically) to a processing list belonging to
+the instance sending them, and only removed from it once they've been sent
+(or put back into the outbox to try again), so a message is never lost if an
+instance stops or crashes while sending it. Each instance regularly records a
+heartbeat in a Redis sorted set. Once an instance's heartbeat is older than
+the lease, another instance moves the messages left in its processing list
+back into the outbox. Delivery is "at least once": a message may be sent
+twice if an instance stops just after sending it, or is so slow that its
+lease expires while it's sending.
+
+Copyright (C) 2020 Nicholas H.Tollervey (ntoll@ntoll.org).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>
+"""
+import asyncio
+import email
+import email.policy
+import json
+import time
+import uuid
+import aiosmtplib  # type: ignore
+import structlog  # type: ignore
+from typing import Dict, Any, List, Union
+from email.message import EmailMessage
+from asyncio_redis import ZScoreBoundary  # type: ignore
+from asyncio_redis.exceptions import Error, ErrorReply  # type: ignore
+from textsmith.datastore import DataStore
+
+
+logger = structlog.get_logger()
+
+
+class Outbox:
+    """
+    Gathers together methods to queue email and deliver it in the background.
+    """
+
+    #: The key of the Redis list containing messages waiting to be sent.
+    key = "outbox"
+    #: The prefix of the keys of the Redis lists containing messages being
+    #: sent, followed by the id of the instance sending them.
+    processing_prefix = "outbox:processing:"
+    #: The key of the sorted set of instance ids scored by heartbeat time.
+    instances_key = "outbox:instances"
+
+    def __init__(
+        self,
+        datastore: DataStore,
+        email_host: str,
+        email_port: int,
+        email_from: str,
+        email_password: str,
+        connections: int = 2,
+        batch_size: int = 10,
+        interval: float = 1.0,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        max_attempts: int = 5,
+        lease: float = 30.0,
+    ) -> None:
+        """
+        The datastore object provides the connection to Redis. The email_*
+        arguments are the settings for the mail relay.
+
+        Up to batch_size messages are delivered at once, over a pool of
+        connections to the mail relay. When the outbox is empty it is checked
+        again every interval seconds. If a whole batch fails the worker waits
+        for an exponentially increasing number of seconds (starting at backoff
+        and capped at max_backoff) before trying again. A message that fails
+        max_attempts times is dropped (and logged).
+
+        A heartbeat is recorded every third of the lease (in seconds). The
+        messages being sent by an instance whose heartbeat is older than the
+        lease are recovered by the other instances.
+        """
+        self.datastore = datastore
+        self.email_host = email_host
+        self.email_port = email_port
+        self.email_from = email_from
+        self.email_password = email_password
+        self.connections = connections
+        self.batch_size = batch_size
+        self.interval = interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.lease = lease
+        # Identifies this instance's processing list and heartbeat.
+        self.instance = uuid.uuid4().hex
+        self.processing_key = self.processing_prefix + self.instance
+        self.failures = 0  # Consecutive failed batches.
+        self.idle: asyncio.Queue = asyncio.Queue()
+        self.clients: List[aiosmtplib.SMTP] = []
+        # The raw messages this instance has taken but not finished with.
+        self.in_flight: List[str] = []
+        self.task: Union[asyncio.Task, None] = None
+        self.keepalive: Union[asyncio.Task, None] = None
+
+    async def put(self, message: EmailMessage, attempts: int = 0) -> None:
+        """
+        Add the referenced email.message.EmailMessage to the outbox.
+        """
+        item = json.dumps(
+            {"attempts": attempts, "message": message.as_string()}
+        )
+        try:
+            await self.datastore.redis.lpush(self.key, [item])
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error queueing email.",
+                to=message["To"],
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+
+    async def size(self) -> int:
+        """
+        Return the number of messages waiting in the outbox.
+        """
+        try:
+            return await self.datastore.redis.llen(self.key)
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error reading outbox.",
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+
+    async def take(self) -> List[Dict[str, Any]]:
+        """
+        Move up to batch_size of the oldest messages in the outbox to the
+        processing list, in a single transaction, and return them. Each
+        message is a dictionary containing the number of previous "attempts",
+        the "message" itself and the "raw" value in the processing list.
+        """
+        try:
+            transaction = await self.datastore.redis.multi()
+            futures = [
+                await transaction.rpoplpush(self.key, self.processing_key)
+                for _ in range(self.batch_size)
+            ]
+            await transaction.exec()
+            raw = [await future for future in futures]
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error reading outbox.",
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+        result = []
+        for item in raw:
+            if item is not None:
+                self.in_flight.append(item)
+                data = json.loads(item)
+                data["message"] = email.message_from_string(
+                    data["message"], policy=email.policy.default
+                )
+                data["raw"] = item
+                result.append(data)
+        return result
+
+    async def done(self, item: Dict[str, Any]) -> None:
+        """
+        Remove the referenced message, taken from the outbox, from the
+        processing list.
+        """
+        raw = item["raw"]
+        try:
+            await self.datastore.redis.lrem(self.processing_key, 1, raw)
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error updating outbox.",
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+        if raw in self.in_flight:
+            self.in_flight.remove(raw)
+
+    async def requeue(self) -> None:
+        """
+        Put the messages this instance has taken, but not finished with,
+        back at the front of the outbox (so they're sent next).
+        """
+        if not self.in_flight:
+            return
+        try:
+            transaction = await self.datastore.redis.multi()
+            for raw in self.in_flight:
+                await transaction.lrem(self.processing_key, 1, raw)
+            await transaction.rpush(self.key, self.in_flight)
+            await transaction.exec()
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error updating outbox.",
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+        logger.msg("Requeued email.", count=len(self.in_flight))
+        self.in_flight = []
+
+    async def heartbeat(self) -> None:
+        """
+        Record that this instance is alive (and holds on to the messages in
+        its processing list) until the lease expires.
+        """
+        try:
+            await self.datastore.redis.zadd(
+                self.instances_key, {self.instance: time.time()}
+            )
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error refreshing outbox heartbeat.",
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+
+    async def recover(self) -> int:
+        """
+        Move any messages left in the processing lists of instances whose
+        heartbeat is older than the lease (since they stopped without putting
+        them back) into the outbox, and forget those instances. Return the
+        number of messages recovered.
+        """
+        cutoff = time.time() - self.lease
+        count = 0
+        try:
+            reply = await self.datastore.redis.zrangebyscore(
+                self.instances_key,
+                ZScoreBoundary("-inf"),
+                ZScoreBoundary(cutoff, exclude_boundary=True),
+            )
+            gone = await reply.asdict()
+            for instance in gone:
+                if instance == self.instance:
+                    continue
+                while await self.datastore.redis.rpoplpush(
+                    self.processing_prefix + instance, self.key
+                ):
+                    count += 1
+                await self.datastore.redis.zrem(self.instances_key, [instance])
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error recovering outbox.",
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+        if count:
+            logger.msg("Recovered email.", count=count)
+        return count
+
+    async def leave(self) -> None:
+        """
+        Forget this instance's heartbeat, once its processing list is empty.
+        """
+        try:
+            await self.datastore.redis.zrem(
+                self.instances_key, [self.instance]
+            )
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error removing outbox heartbeat.",
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+
+    async def keep_alive(self) -> None:
+        """
+        Record a heartbeat, and recover the messages of instances that have
+        gone, every third of the lease until cancelled.
+        """
+        while True:
+            try:
+                await self.heartbeat()
+                await self.recover()
+            except (Error, ErrorReply):  # pragma: no cover
+                pass  # Already logged. Try again next time.
+            await asyncio.sleep(self.lease / 3)
+
+    async def deliver(self, item: Dict[str, Any]) -> bool:
+        """
+        Send a message taken from the outbox over an idle connection to the
+        mail relay, connecting (and authenticating) if needed. Return a
+        boolean indication of success. Failed messages are put back into the
+        outbox unless they have been attempted max_attempts times. Either way
+        the message is then removed from the processing list.
+        """
+        message = item["message"]
+        attempts = item["attempts"] + 1
+        client = await self.idle.get()
+        try:
+            if not client.is_connected:
+                await client.connect()
+            await client.send_message(message)
+            logger.msg("Email sent.", to=message["To"], attempts=attempts)
+            try:
+                await self.done(item)
+            except (Error, ErrorReply):  # pragma: no cover
+                pass  # Already logged.
+            return True
+        except (aiosmtplib.SMTPException, OSError) as ex:
+            logger.msg(
+                "Error sending email.",
+                to=message["To"],
+                attempts=attempts,
+                exc_info=ex,
+            )
+            client.close()  # Reconnect next time.
+            if attempts < self.max_attempts:
+                try:
+                    await self.put(message, attempts)
+                except (Error, ErrorReply):  # pragma: no cover
+                    pass  # Already logged.
+            else:
+                logger.msg(
+                    "Email dropped.", to=message["To"], attempts=attempts
+                )
+            try:
+                await self.done(item)
+            except (Error, ErrorReply):  # pragma: no cover
+                pass  # Already logged.
+            return False
+        finally:
+            self.idle.put_nowait(client)
+
+    async def run(self) -> None:
+        """
+        Deliver batches of messages from the outbox until cancelled. A
+        heartbeat is recorded first, so this instance's processing list is
+        known to the other instances before any message is taken.
+        """
+        try:
+            await self.heartbeat()
+        except (Error, ErrorReply):  # pragma: no cover
+            pass  # Already logged.
+        while True:
+            try:
+                items = await self.take()
+            except (Error, ErrorReply):  # pragma: no cover
+                items = []  # Already logged. Try again next time.
+            if not items:
+                await asyncio.sleep(self.interval)
+                continue
+            results = await asyncio.gather(
+                *[self.deliver(item) for item in items]
+            )
+            if any(results):
+                self.failures = 0
+            else:
+                self.failures += 1
+                delay = min(
+                    self.max_backoff, self.backoff * 2 ** (self.failures - 1)
+                )
+                await asyncio.sleep(delay)
+
+    def start(self) -> None:
+        """
+        Create the pool of connections to the mail relay and schedule the
+        tasks that deliver messages and keep this instance's lease alive.
+        Connections are opened when first used.
+        """
+        for _ in range(self.connections):
+            client = aiosmtplib.SMTP(
+                hostname=self.email_host,
+                port=self.email_port,
+                username=self.email_from,
+                password=self.email_password,
+                use_tls=True,
+            )
+            self.clients.append(client)
+            self.idle.put_nowait(client)
+        self.task = asyncio.create_task(self.run())
+        self.keepalive = asyncio.create_task(self.keep_alive())
+
+    async def stop(self) -> None:
+        """
+        Cancel the tasks and close the connections to the mail relay. Messages
+        that were being sent when the delivery task was cancelled are put back
+        into the outbox, so no message is lost, and this instance is
+        forgotten.
+        """
+        for task in (self.task, self.keepalive):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.task = None
+        self.keepalive = None
+        try:
+            await self.requeue()
+            await self.leave()
+        except (Error, ErrorReply):  # pragma: no cover
+            # Already logged. Messages left in the processing list are
+            # recovered by another instance once the lease expires.
+            pass
+        for client in self.clients:
+            if client.is_connected:
+                try:
+                    await client.quit()
+                except (aiosmtplib.SMTPException, OSError):  # pragma: no cover
+                    client.close()
+        self.clients = []
+        self.idle = asyncio.Queue()
+        logger.msg("Stop Outbox.")
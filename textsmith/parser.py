@@ -22,9 +22,9 @@ import html
 import structlog  # type: ignore
 from uuid import uuid4
 from textsmith.logic import Logic
-from textsmith.verbs import Verbs, UnknownVerb
+from textsmith.verbs import Verbs, UnknownVerb, COMMANDS
 from flask_babel import gettext as _  # type: ignore
-from textsmith import constants
+from textsmith import constants, envelope, trace
 
 
 logger = structlog.get_logger()
@@ -60,15 +60,22 @@ class Parser:
             user_id=user_id,
             connection_id=connection_id,
         )
+        # Messages emitted while handling the input are linked to it.
+        envelope.start(message_id)
+        # Time the stages of evaluating the input, if it's traced.
+        trace.start(message_id, user_id=user_id, connection_id=connection_id)
         try:
             # All user input is immediately cleaned so it's safe to render
             # client side.
             escaped = html.escape(message)
-            await self.parse(user_id, connection_id, message_id, escaped)
+            with trace.span("parse"):
+                await self.parse(user_id, connection_id, message_id, escaped)
         except Exception as ex:
             await self.handle_exception(
                 user_id, connection_id, message_id, message, ex
             )
+        finally:
+            trace.finish()
 
     async def handle_exception(
         self,
@@ -212,25 +219,33 @@ class Parser:
         message = message.lstrip()
         if message.startswith('"'):
             # " The user is saying something to everyone in their location.
-            return await self.verbs._say(
-                user_id, connection_id, message_id, message[1:]
-            )
+            COMMANDS.labels("say").inc()
+            with trace.span("verb.say"):
+                return await self.verbs._say(
+                    user_id, connection_id, message_id, message[1:]
+                )
         elif message.startswith("!"):
             # ! The user is shouting something to everyone in their location.
-            return await self.verbs._shout(
-                user_id, connection_id, message_id, message[1:]
-            )
+            COMMANDS.labels("shout").inc()
+            with trace.span("verb.shout"):
+                return await self.verbs._shout(
+                    user_id, connection_id, message_id, message[1:]
+                )
         elif message.startswith(":"):
             # : The user is emoting something to everyone in their location.
-            return await self.verbs._emote(
-                user_id, connection_id, message_id, message[1:]
-            )
+            COMMANDS.labels("emote").inc()
+            with trace.span("verb.emote"):
+                return await self.verbs._emote(
+                    user_id, connection_id, message_id, message[1:]
+                )
         elif message.startswith("@"):
             # @ The user is saying something to a specific person in their
             # location.
-            return await self.verbs._tell(
-                user_id, connection_id, message_id, message[1:]
-            )
+            COMMANDS.labels("tell").inc()
+            with trace.span("verb.tell"):
+                return await self.verbs._tell(
+                    user_id, connection_id, message_id, message[1:]
+                )
 
         # Check for verbs built into the game.
         split_input = message.split(" ", 1)
@@ -250,6 +265,7 @@ class Parser:
             pass
 
         # Act of last resort ~ choose a stock fun response. ;-)
+        COMMANDS.labels("unknown").inc()
         response = random.choice(constants.HUH)
         i_give_up = f'"{message}", ' + response
         return await self.logic.emit_to_user(user_id, i_give_up)
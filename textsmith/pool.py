@@ -0,0 +1,271 @@
+"""
+Instrumentation, and optional adaptive sizing, for Redis connection pools.
+
+asyncio_redis pipelines ordinary commands on a connection, but a connection
+is busy (and can't be used by anything else) during a transaction, a
+blocking command or when subscribed to pub/sub channels. If every connection
+is busy the pool immediately raises NoAvailableConnectionsInPoolError. The
+InstrumentedPool instead waits for a connection to become free, and records
+how long that took, so an undersized pool shows up as wait time rather than
+as errors.
+
+Copyright (C) 2020 Nicholas H.Tollervey (ntoll@ntoll.org).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>
+"""
+import asyncio
+import time
+import structlog  # type: ignore
+from typing import Any, Awaitable, Callable, Dict, Union
+from asyncio_redis import Connection, Pool, Script  # type: ignore
+from asyncio_redis.exceptions import (  # type: ignore
+    Error,
+    ErrorReply,
+    NoAvailableConnectionsInPoolError,
+)
+from textsmith.metrics import Histogram
+
+
+logger = structlog.get_logger()
+
+
+#: Attributes of a pool that aren't Redis commands, so aren't instrumented.
+PASSTHROUGH = {
+    "poolsize",
+    "connections_in_use",
+    "connections_connected",
+    "close",
+}
+
+
+class InstrumentedPool:
+    """
+    Wraps an asyncio_redis connection pool, and is used in exactly the same
+    way. Records the latency of each Redis command, the number of commands
+    in flight, and how long each command waited for a free connection.
+
+    If a connect function is given (returning a new asyncio_redis
+    Connection), the pool can be resized with grow and shrink, and starting
+    the pool resizes it every interval between min_size and max_size
+    connections, based on the waits observed.
+    """
+
+    def __init__(
+        self,
+        pool: Pool,
+        connect: Union[Callable[[], Awaitable[Connection]], None] = None,
+        min_size: Union[int, None] = None,
+        max_size: Union[int, None] = None,
+        wait_timeout: float = 5.0,
+        interval: float = 5.0,
+        idle_intervals: int = 6,
+    ) -> None:
+        """
+        Commands wait up to wait_timeout seconds for a free connection. When
+        resizing, the pool grows after any interval in which commands had to
+        wait, and shrinks after idle_intervals intervals in a row in which
+        at least two connections were never busy.
+        """
+        self.pool = pool
+        self.connect = connect
+        self.min_size = pool.poolsize if min_size is None else min_size
+        self.max_size = pool.poolsize if max_size is None else max_size
+        self.wait_timeout = wait_timeout
+        self.interval = interval
+        self.idle_intervals = idle_intervals
+        # Key: Redis command Value: histogram of the command's latency.
+        self.commands: Dict[str, Histogram] = {}
+        self.wait = Histogram()
+        self.in_flight = 0
+        self.timeouts = 0
+        # The number of commands that waited, and the largest number of busy
+        # connections, since the pool was last resized.
+        self.waited = 0
+        self.peak_in_use = 0
+        self.idle = 0  # Intervals in a row with spare connections.
+        self.task: Union[asyncio.Task, None] = None
+
+    def __getattr__(self, name: str) -> Any:
+        """
+        Return the referenced attribute of the pool. Redis commands are
+        wrapped so they wait for a free connection and are measured.
+        """
+        if name.startswith("_") or name in PASSTHROUGH:
+            return getattr(self.pool, name)
+
+        async def command(*args: Any, **kwargs: Any) -> Any:
+            method = await self.acquire(name)
+            started = time.monotonic()
+            self.in_flight += 1
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                self.in_flight -= 1
+                histogram = self.commands.get(name)
+                if histogram is None:
+                    histogram = self.commands[name] = Histogram()
+                histogram.observe(time.monotonic() - started)
+                if self.max_size > self.min_size:
+                    # A transaction or subscription keeps its connection busy.
+                    self.peak_in_use = max(
+                        self.peak_in_use, self.pool.connections_in_use
+                    )
+
+        return command
+
+    async def register_script(self, script: str) -> Script:
+        """
+        Load the referenced Lua script into Redis and return an object to run
+        it. Running the script (with EVALSHA) waits for a free connection and
+        is measured like any other command, rather than always using the
+        connection the script was registered with.
+        """
+        sha = await self.script_load(script)
+        return Script(sha, script, lambda: self.evalsha)
+
+    async def acquire(self, name: str) -> Callable[..., Awaitable[Any]]:
+        """
+        Return the referenced command bound to a free connection, waiting
+        (for no more than wait_timeout seconds) if every connection is busy.
+        """
+        started = time.monotonic()
+        delay = 0.0
+        while True:
+            try:
+                method = getattr(self.pool, name)
+                break
+            except NoAvailableConnectionsInPoolError as ex:
+                if time.monotonic() - started >= self.wait_timeout:
+                    self.timeouts += 1
+                    logger.msg(
+                        "Timed out waiting for a Redis connection.",
+                        command=name,
+                        poolsize=self.pool.poolsize,
+                        exc_info=ex,
+                        redis_error=True,
+                    )
+                    raise ex
+                delay = min(delay * 2 or 0.001, 0.05)
+                await asyncio.sleep(delay)
+        self.wait.observe(time.monotonic() - started)
+        if delay:
+            self.waited += 1
+        return method
+
+    async def grow(self, count: int) -> None:
+        """
+        Add count new connections to the pool.
+        """
+        if self.connect is None:
+            raise ValueError("A connect function is needed to grow the pool.")
+        connections = await asyncio.gather(
+            *(self.connect() for _ in range(count))
+        )
+        self.pool._connections.extend(connections)
+        self.pool._poolsize += len(connections)
+        logger.msg(
+            "Grew Redis pool.", added=count, poolsize=self.pool.poolsize
+        )
+
+    def shrink(self, count: int) -> int:
+        """
+        Close up to count connections that are neither busy nor waiting for
+        replies, and remove them from the pool. Return the number removed.
+        """
+        idle = [
+            connection
+            for connection in self.pool._connections
+            if not (connection.protocol.in_use or connection.protocol._queue)
+        ][:count]
+        for connection in idle:
+            self.pool._connections.remove(connection)
+            connection.close()
+        self.pool._poolsize -= len(idle)
+        if idle:
+            logger.msg(
+                "Shrank Redis pool.",
+                removed=len(idle),
+                poolsize=self.pool.poolsize,
+            )
+        return len(idle)
+
+    async def resize(self) -> None:
+        """
+        Grow the pool (by half, within max_size) if commands had to wait for
+        a connection since it was last resized. Shrink it by one connection
+        (within min_size) if it had spare connections for long enough.
+        """
+        size = self.pool.poolsize
+        waited, peak = self.waited, self.peak_in_use
+        self.waited = 0
+        self.peak_in_use = self.pool.connections_in_use
+        if waited and size < self.max_size:
+            self.idle = 0
+            await self.grow(min(self.max_size - size, max(1, size // 2)))
+        elif not waited and peak < size - 1 and size > self.min_size:
+            self.idle += 1
+            if self.idle >= self.idle_intervals:
+                self.idle = 0
+                self.shrink(1)
+        else:
+            self.idle = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return a dictionary of statistics about the pool and the commands
+        sent through it.
+        """
+        return {
+            "poolsize": self.pool.poolsize,
+            "in_use": self.pool.connections_in_use,
+            "connected": self.pool.connections_connected,
+            "in_flight": self.in_flight,
+            "timeouts": self.timeouts,
+            "wait": self.wait.snapshot(),
+            "commands": {
+                name: histogram.snapshot()
+                for name, histogram in self.commands.items()
+            },
+        }
+
+    async def run(self) -> None:
+        """
+        Resize the pool every interval until cancelled.
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.resize()
+            except (Error, ErrorReply, OSError) as ex:  # pragma: no cover
+                logger.msg(
+                    "Error resizing Redis pool.", exc_info=ex, redis_error=True
+                )
+
+    def start(self) -> None:
+        """
+        Schedule the task that resizes the pool.
+        """
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """
+        Cancel the task that resizes the pool.
+        """
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
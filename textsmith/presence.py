@@ -0,0 +1,201 @@
+"""
+Track which users are online across all instances of TextSmith.
+
+Each instance records the websocket connections it serves and, at a regular
+interval, refreshes the heartbeat of every connected user in a single
+request to a Redis sorted set (scored by the time of the heartbeat). Users
+whose heartbeat is older than the timeout are no longer online. A user is
+online as soon as they connect, and goes offline when their heartbeat
+expires (users may be connected to several instances, so a disconnection
+doesn't remove them). Connections that have been idle for too long are
+evicted so their message queues and subscriptions are cleaned up.
+
+Copyright (C) 2020 Nicholas H.Tollervey (ntoll@ntoll.org).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>
+"""
+import asyncio
+import time
+import structlog  # type: ignore
+from typing import Dict, Any, List, Union
+from asyncio_redis.exceptions import Error, ErrorReply  # type: ignore
+from textsmith.datastore import DataStore
+
+
+logger = structlog.get_logger()
+
+
+class Presence:
+    """
+    Gathers together methods to track the presence of users and the activity
+    of their websocket connections on this instance.
+    """
+
+    def __init__(
+        self,
+        datastore: DataStore,
+        interval: float = 30.0,
+        idle_timeout: float = 1800.0,
+    ) -> None:
+        """
+        The datastore object provides the connection to Redis. The interval is
+        the number of seconds between heartbeats, and idle_timeout is the
+        number of seconds a connection may go without activity before it is
+        evicted. A user is online if their heartbeat is less than three
+        intervals old.
+        """
+        self.datastore = datastore
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.timeout = interval * 3
+        # Key: connection_id Value: dictionary containing the user_id, the
+        # time of the last activity and the task handling the connection.
+        self.connections: Dict[str, Dict[str, Any]] = {}
+        self.task: Union[asyncio.Task, None] = None
+
+    async def connect(
+        self, user_id: int, connection_id: str, task: asyncio.Task
+    ) -> None:
+        """
+        Start tracking the referenced connection, and record a heartbeat for
+        the user so they're online straight away. The task is cancelled if
+        the connection is evicted for being idle.
+        """
+        self.connections[connection_id] = {
+            "user_id": user_id,
+            "last_active": time.monotonic(),
+            "task": task,
+        }
+        await self.datastore.set_presence({user_id: time.time()})
+
+    def touch(self, connection_id: str) -> None:
+        """
+        Record activity on the referenced connection.
+        """
+        connection = self.connections.get(connection_id)
+        if connection:
+            connection["last_active"] = time.monotonic()
+
+    def disconnect(self, user_id: int, connection_id: str) -> None:
+        """
+        Stop tracking the referenced connection. The user's heartbeat is no
+        longer refreshed by this instance (unless they have other connections
+        to it) so it expires after the timeout. It isn't removed from the
+        sorted set straight away, since the user may still be connected to
+        another instance.
+        """
+        self.connections.pop(connection_id, None)
+
+    def user_ids(self) -> List[int]:
+        """
+        Return the ids of users with connections to this instance.
+        """
+        return list(
+            {connection["user_id"] for connection in self.connections.values()}
+        )
+
+    def evict_idle(self) -> List[str]:
+        """
+        Cancel the tasks handling connections that have been idle for longer
+        than the idle timeout. Returns the ids of the evicted connections.
+        """
+        cutoff = time.monotonic() - self.idle_timeout
+        evicted = []
+        for connection_id, connection in list(self.connections.items()):
+            if connection["last_active"] < cutoff:
+                self.connections.pop(connection_id)
+                connection["task"].cancel()
+                evicted.append(connection_id)
+                logger.msg(
+                    "Evicted idle connection.",
+                    user_id=connection["user_id"],
+                    connection_id=connection_id,
+                )
+        return evicted
+
+    def close_all(self) -> int:
+        """
+        Cancel the tasks handling every connection to this instance (so the
+        websockets are closed), e.g. when it is shutting down. Returns the
+        number of connections closed.
+        """
+        connections = list(self.connections.values())
+        for connection in connections:
+            connection["task"].cancel()
+        logger.msg("Closed all connections.", connections=len(connections))
+        return len(connections)
+
+    async def heartbeat(self) -> None:
+        """
+        Evict idle connections, then refresh the heartbeat for all the users
+        connected to this instance and remove users whose heartbeat has
+        expired, all in a single transaction.
+        """
+        self.evict_idle()
+        now = time.time()
+        await self.datastore.set_presence(
+            {user_id: now for user_id in self.user_ids()},
+            now - self.timeout,
+        )
+
+    async def online(self, user_ids: List[int]) -> List[int]:
+        """
+        Return those user ids in the referenced list that are online.
+        """
+        cutoff = time.time() - self.timeout
+        heartbeats = await self.datastore.get_presence(user_ids)
+        return [
+            user_id
+            for user_id in user_ids
+            if user_id in heartbeats and heartbeats[user_id] >= cutoff
+        ]
+
+    async def online_in_room(self, room_id: int) -> List[int]:
+        """
+        Return the ids of the users who are online in the referenced room.
+        Only the room's inventory and the presence of its contents are read,
+        never the objects themselves.
+        """
+        contents = await self.datastore.get_content_ids(room_id)
+        return await self.online(sorted(contents))
+
+    async def run(self) -> None:
+        """
+        Send a heartbeat every interval until cancelled.
+        """
+        while True:
+            try:
+                await self.heartbeat()
+            except (Error, ErrorReply):  # pragma: no cover
+                pass  # Already logged. Try again next time.
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        """
+        Schedule the task that sends regular heartbeats.
+        """
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """
+        Cancel the task that sends regular heartbeats.
+        """
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        logger.msg("Stop Presence.", connections=len(self.connections))
@@ -17,35 +17,214 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>
 """
 import asyncio
+import random
 import structlog  # type: ignore
+from typing import Dict, List, Any, Callable, Awaitable, Union, Tuple
 from asyncio_redis import Subscription  # type: ignore
 from asyncio_redis.exceptions import Error, ErrorReply  # type: ignore
+from textsmith import envelope
+from textsmith.constants import MESSAGE_DELIMITER
 
 
 logger = structlog.get_logger()
 
 
+#: The shard's subscriber is connected and listening for messages.
+CONNECTED = "connected"
+#: The shard lost its connection and is trying to reconnect.
+RECONNECTING = "reconnecting"
+#: The shard has failed to reconnect several times in a row.
+DEGRADED = "degraded"
+
+
+class Shard:
+    """
+    A single Redis connection in "subscribe" mode and the state needed to
+    batch changes to the channels to which it subscribes.
+
+    Requests to subscribe or unsubscribe are grouped: if a request to Redis
+    is already in flight, further requests are collected and sent as soon as
+    the in flight request completes. Requests are sent in the order they were
+    made, with consecutive requests for the same action combined into a
+    single ``SUBSCRIBE`` (or ``UNSUBSCRIBE``) with many channels. A lone
+    request is sent immediately so there is no added latency when the server
+    is quiet.
+    """
+
+    def __init__(self, index: int, subscriber: Subscription) -> None:
+        """
+        The index identifies the shard, the subscriber object represents a
+        connection to Redis in "subscribe" mode.
+        """
+        self.index = index
+        self.subscriber = subscriber
+        # One of CONNECTED, RECONNECTING or DEGRADED.
+        self.state = CONNECTED
+        # Number of times the subscriber connection has been replaced.
+        self.reconnections = 0
+        # Flag to show if the shard's listener is running.
+        self.listening = False
+        # Channels to which this shard is subscribed.
+        self.channels = set()  # type: set
+        # Count of messages received via this shard.
+        self.messages = 0
+        # (action, channel) requests waiting to be sent to Redis in the next
+        # batch, in the order they were made, and the future to resolve when
+        # that batch has been sent.
+        self.pending: List[Tuple[str, str]] = []
+        self.batch = None  # type: Any
+        # Flag to show if a batch is in flight.
+        self.busy = False
+
+    async def request(self, action: str, channel: str) -> None:
+        """
+        Add the channel and action ("subscribe" or "unsubscribe") to the next
+        batch of requests and return once that batch has been sent to Redis.
+        """
+        self.pending.append((action, channel))
+        if self.batch is None:
+            self.batch = asyncio.get_running_loop().create_future()
+        batch = self.batch
+        if not self.busy:
+            await self.flush()
+        await asyncio.shield(batch)
+
+    async def flush(self) -> None:
+        """
+        Send pending batches to Redis until there are no more pending
+        requests. Callers awaiting a batch are told of success or failure via
+        the batch's future. If part of a batch fails, the rest of it isn't
+        sent.
+        """
+        self.busy = True
+        try:
+            while self.pending:
+                requests = self.pending
+                batch = self.batch
+                self.pending = []
+                self.batch = None
+                # Group consecutive requests for the same action, so the
+                # order of subscribes and unsubscribes is kept.
+                groups: List[Tuple[str, List[str]]] = []
+                for action, channel in requests:
+                    if groups and groups[-1][0] == action:
+                        groups[-1][1].append(channel)
+                    else:
+                        groups.append((action, [channel]))
+                try:
+                    for action, channels in groups:
+                        await getattr(self.subscriber, action)(channels)
+                        if action == "subscribe":
+                            self.channels.update(channels)
+                        else:
+                            self.channels.difference_update(channels)
+                except asyncio.CancelledError:
+                    batch.cancel()
+                    if self.pending:
+                        # Hand over waiting callers to a new flush.
+                        asyncio.create_task(self.flush())
+                    raise
+                except Exception as ex:
+                    batch.set_exception(ex)
+                else:
+                    batch.set_result(len(requests))
+        finally:
+            self.busy = False
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return a dictionary of statistics about this shard.
+        """
+        return {
+            "index": self.index,
+            "state": self.state,
+            "listening": self.listening,
+            "reconnections": self.reconnections,
+            "channels": len(self.channels),
+            "messages": self.messages,
+            "pending_subscribe": len(
+                [r for r in self.pending if r[0] == "subscribe"]
+            ),
+            "pending_unsubscribe": len(
+                [r for r in self.pending if r[0] == "unsubscribe"]
+            ),
+        }
+
+
 class PubSub:
     """
     Contains methods needed to manage listening for messages broadcast on the
     pub/sub layer of the game.
+
+    Channels are hashed (by user ID) across one or more subscriber
+    connections to Redis. Each connection has its own listener task so no
+    single reader has to handle every message for the instance.
+
+    If a connect coroutine function is given, a shard whose connection breaks
+    is supervised back to health: a new subscriber is created (with jittered
+    exponential backoff between attempts) and every channel for the shard's
+    connected users is subscribed to again.
+
+    A subscriber waiting for messages isn't told when its connection is lost,
+    so a watchdog task checks the connection of each shard's subscriber every
+    check_interval seconds. Subscribers should be created without
+    asyncio_redis' automatic reconnection, so the PubSub instance knows when
+    a connection is lost (rather than reporting it as connected throughout an
+    outage).
     """
 
-    def __init__(self, subscriber: Subscription) -> None:
+    def __init__(
+        self,
+        *subscribers: Subscription,
+        connect: Union[Callable[[], Awaitable[Subscription]], None] = None,
+        backoff: float = 0.1,
+        max_backoff: float = 10.0,
+        degraded_after: int = 5,
+        check_interval: float = 1.0,
+    ) -> None:
         """
-        The subscriber object represents a connection to Redis in "subscribe"
-        mode (i.e. listening for messages).
+        Each subscriber object represents a connection to Redis in "subscribe"
+        mode (i.e. listening for messages). The optional connect coroutine
+        function returns a new subscriber object. The backoff values are in
+        seconds, and degraded_after is the number of failed attempts to
+        reconnect before a shard is marked as DEGRADED. The connection of
+        each subscriber is checked every check_interval seconds.
         """
+        if not subscribers:
+            raise ValueError("At least one subscriber is required.")
         # Key: user_id Value: deque of pending messages (for all users
         # connected this instance).
         self.connected_users = {}  # type: dict
-        # The Redis connection used to subscribe to pub/sub messages.
-        self.subscriber = subscriber
-        # A flag to show if new messages are retrievable.
-        self.listening = False
-        # Schedule a task to constantly listen for new messages on
+        # Key: user_id Value: sequence number of the last message received
+        # for the user.
+        self.sequences = {}  # type: Dict[int, int]
+        # The Redis connections used to subscribe to pub/sub messages.
+        self.shards = [
+            Shard(index, subscriber)
+            for index, subscriber in enumerate(subscribers)
+        ]
+        # Used to replace a broken subscriber connection.
+        self.connect = connect
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.degraded_after = degraded_after
+        self.check_interval = check_interval
+        # Schedule a task per shard to constantly listen for new messages on
         # subscribed-to channels.
-        self.listener = asyncio.create_task(self.listen())
+        self.listeners = [
+            asyncio.create_task(self.listen(shard.index))
+            for shard in self.shards
+        ]
+        # Schedule a task to check the subscribers are still connected.
+        self.watchdog = asyncio.create_task(
+            self.watch()
+        )  # type: Union[asyncio.Task, None]
+
+    def shard_for(self, user_id: int) -> Shard:
+        """
+        Return the shard responsible for the referenced user's channel.
+        """
+        return self.shards[user_id % len(self.shards)]
 
     async def subscribe(self, user_id: int, connection_id: str) -> None:
         """
@@ -54,12 +233,12 @@ class PubSub:
         via Redis. Log this event.
         """
         self.connected_users[user_id] = asyncio.Queue()
+        self.sequences[user_id] = 0
+        shard = self.shard_for(user_id)
         try:
-            await self.subscriber.subscribe(
-                [
-                    str(user_id),
-                ]
-            )
+            if shard.state == CONNECTED:
+                await shard.request("subscribe", str(user_id))
+            # Otherwise, the channel is subscribed to upon reconnection.
         except (Error, ErrorReply) as ex:  # pragma: no cover
             logger.msg(
                 "Error subscribing to channel.",
@@ -78,12 +257,11 @@ class PubSub:
         Log this event. If there are undelivered messages, log these.
         """
         self.connected_users.pop(user_id, None)
+        self.sequences.pop(user_id, None)
+        shard = self.shard_for(user_id)
         try:
-            await self.subscriber.unsubscribe(
-                [
-                    str(user_id),
-                ]
-            )
+            if shard.state == CONNECTED:
+                await shard.request("unsubscribe", str(user_id))
         except (Error, ErrorReply) as ex:  # pragma: no cover
             logger.msg(
                 "Error unsubscribing from channel.",
@@ -97,48 +275,180 @@ class PubSub:
             "Unsubscribe.", user_id=user_id, connection_id=connection_id
         )
 
-    async def listen(self) -> None:
+    async def listen(self, index: int = 0) -> None:
         """
-        Listen to the messages on subscribed channels. Each channel represents
-        an object ID. If the object ID is a user connected to this application,
-        then it's put into the message queue for that user, to be sent via the
-        websocket connection.
+        Listen to the messages on the channels subscribed to by the shard with
+        the referenced index. Each channel represents an object ID. If the
+        object ID is a user connected to this application, then its envelope
+        (annotated with the user's next sequence number) is put into the
+        message queue for that user, to be sent via the websocket connection.
+
+        If the connection to Redis breaks and there is a way to reconnect, the
+        shard is reconnected and listening continues. Otherwise, listening
+        stops.
         """
-        self.listening = True
-        while self.listening:
+        shard = self.shards[index]
+        shard.listening = True
+        while shard.listening:
             try:
-                message = await self.subscriber.next_published()
+                message = await shard.subscriber.next_published()
+                shard.messages += 1
                 user_id = int(message.channel)
+                # Only a sample of these is written (see TEXTSMITH_LOG_SAMPLE
+                # in textsmith.log) so busy servers aren't slowed by logging.
                 logger.msg("Message.", user_id=user_id, value=message.value)
                 if user_id in self.connected_users:
-                    await self.connected_users[user_id].put(message.value)
+                    seq = self.sequences.get(user_id, 0) + 1
+                    self.sequences[user_id] = seq
+                    await self.connected_users[user_id].put(
+                        envelope.receive(message.value, seq)
+                    )
             except ValueError:
                 logger.msg(
                     "Bad Message.",
                     channel=message.channel,
                     value=message.value,
                 )
-            except StopIteration:  # pragma: no cover
+            except (StopIteration, Error, ErrorReply, OSError) as ex:
                 logger.msg(
-                    "Broken subscriber.",
+                    "Error listening to Redis PubSub.",
+                    shard=index,
+                    exc_info=ex,
+                    redis_error=True,
                 )
-                self.listening = False
-                break
-            except (Error, ErrorReply) as ex:  # pragma: no cover
-                self.listening = False
+                if self.connect is None:
+                    shard.listening = False
+                    break
+                await self.reconnect(shard)
+
+    @staticmethod
+    def is_connected(subscriber: Subscription) -> bool:
+        """
+        Return True unless the referenced subscriber's connection is known to
+        have been lost.
+        """
+        protocol = getattr(subscriber, "protocol", None)
+        return protocol is None or bool(protocol.is_connected)
+
+    @staticmethod
+    def close(subscriber: Subscription) -> None:
+        """
+        Close the referenced subscriber's connection, if it's still open, so
+        it isn't left behind in "subscribe" mode.
+        """
+        protocol = getattr(subscriber, "protocol", None)
+        transport = getattr(protocol, "transport", None)
+        if transport is not None:
+            transport.close()
+
+    async def watch(self) -> None:
+        """
+        Check the connection of each shard's subscriber every check_interval
+        seconds until cancelled. If a connection was lost, the shard's
+        listener is replaced by one that reconnects the shard first (or the
+        shard is DEGRADED if there's no way to reconnect).
+        """
+        while True:
+            await asyncio.sleep(self.check_interval)
+            for shard in self.shards:
+                if shard.state != CONNECTED or self.is_connected(
+                    shard.subscriber
+                ):
+                    continue
                 logger.msg(
-                    "Error listening to Redis PubSub.",
+                    "Lost connection to Redis PubSub.",
+                    shard=shard.index,
+                    redis_error=True,
+                )
+                self.listeners[shard.index].cancel()
+                if self.connect is None:
+                    shard.state = DEGRADED
+                    # The listener was cancelled, so get_message mustn't
+                    # wait for messages that will never arrive.
+                    shard.listening = False
+                else:
+                    self.listeners[shard.index] = asyncio.create_task(
+                        self.resume(shard.index)
+                    )
+
+    async def resume(self, index: int) -> None:
+        """
+        Reconnect the shard with the referenced index, then listen to it.
+        """
+        await self.reconnect(self.shards[index])
+        await self.listen(index)
+
+    async def reconnect(self, shard: Shard) -> None:
+        """
+        Replace the referenced shard's subscriber with a new connection and
+        resubscribe to the channels of the shard's connected users (and only
+        those channels, should users leave while resubscribing). Attempts
+        are retried with "full jitter" exponential backoff. After
+        degraded_after consecutive failures the shard is marked as DEGRADED
+        but attempts continue.
+        """
+        shard.state = RECONNECTING
+        attempt = 0
+        while True:
+            delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+            await asyncio.sleep(random.uniform(0, delay))
+            attempt += 1
+            # Don't leave the broken (or partly resubscribed) connection
+            # behind.
+            self.close(shard.subscriber)
+            try:
+                subscriber = await self.connect()  # type: ignore
+                shard.subscriber = subscriber
+                shard.channels = set()
+                # Users may connect or disconnect while resubscribing (and
+                # their requests aren't sent to Redis until the shard is
+                # CONNECTED), so keep going until the shard is subscribed to
+                # exactly the wanted channels.
+                while True:
+                    wanted = {
+                        str(user_id)
+                        for user_id in self.connected_users
+                        if self.shard_for(user_id) is shard
+                    }
+                    missing = sorted(wanted - shard.channels)
+                    leftover = sorted(shard.channels - wanted)
+                    if not (missing or leftover):
+                        break
+                    if missing:
+                        await subscriber.subscribe(missing)
+                        shard.channels.update(missing)
+                    if leftover:
+                        await subscriber.unsubscribe(leftover)
+                        shard.channels.difference_update(leftover)
+            except (Error, ErrorReply, OSError) as ex:
+                if attempt >= self.degraded_after:
+                    shard.state = DEGRADED
+                logger.msg(
+                    "Error reconnecting to Redis PubSub.",
+                    shard=shard.index,
+                    attempt=attempt,
+                    state=shard.state,
                     exc_info=ex,
                     redis_error=True,
                 )
-                break
+                continue
+            shard.state = CONNECTED
+            shard.reconnections += 1
+            logger.msg(
+                "Reconnected to Redis PubSub.",
+                shard=shard.index,
+                attempt=attempt,
+                channels=len(shard.channels),
+            )
+            return
 
-    async def get_message(self, user_id: int) -> str:
+    async def get_message(self, user_id: int) -> Union[Dict[str, Any], str]:
         """
-        Return the next message in the message queue for the referenced user.
-        Otherwise, return an empty string (indicating no messages).
+        Return the next message envelope in the message queue for the
+        referenced user. Otherwise, return an empty string (indicating no
+        messages).
         """
-        if not self.listening:
+        if not self.listening_for(user_id):
             raise ValueError(f"Cannot get messages for user {user_id}.")
         message_queue = self.connected_users.get(user_id)
         if message_queue:
@@ -147,18 +457,124 @@ class PubSub:
         else:
             return ""
 
+    @property
+    def listening(self) -> bool:
+        """
+        True if every shard is listening for messages.
+        """
+        return all(shard.listening for shard in self.shards)
+
+    def listening_for(self, user_id: int) -> bool:
+        """
+        Return True if the shard for the referenced user is listening for
+        messages.
+        """
+        return self.shard_for(user_id).listening
+
+    @property
+    def state(self) -> str:
+        """
+        The overall state of the instance: DEGRADED if any shard is degraded,
+        RECONNECTING if any shard is reconnecting, otherwise CONNECTED.
+        """
+        states = {shard.state for shard in self.shards}
+        if DEGRADED in states:
+            return DEGRADED
+        if RECONNECTING in states:
+            return RECONNECTING
+        return CONNECTED
+
+    async def get_messages(
+        self,
+        user_id: int,
+        max_count: int = 100,
+        max_size: int = 65536,
+        linger: float = 0.0,
+    ) -> List[str]:
+        """
+        Wait for the next message envelope for the referenced user, then drain
+        any further envelopes already queued for them, up to max_count
+        messages or until the frame containing them (the envelopes as sent,
+        joined by the message delimiter) reaches max_size bytes. If linger
+        (in seconds) is given, wait that long for more messages to arrive
+        before returning.
+
+        Returns the envelopes as sent (see envelope.send), or an empty list if
+        there are no messages.
+        """
+        first = await self.get_message(user_id)
+        if not isinstance(first, dict):
+            return []
+        sent = envelope.send(first)
+        result = [sent]
+        size = len(sent.encode("utf-8"))
+        delimiter = len(MESSAGE_DELIMITER.encode("utf-8"))
+        message_queue = self.connected_users.get(user_id)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + linger
+        while (
+            message_queue is not None
+            and len(result) < max_count
+            and size < max_size
+        ):
+            message: Dict[str, Any]
+            if message_queue.empty():
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    message = await asyncio.wait_for(
+                        message_queue.get(), remaining
+                    )
+                except asyncio.TimeoutError:
+                    break
+            else:
+                message = message_queue.get_nowait()
+            sent = envelope.send(message)
+            result.append(sent)
+            size += delimiter + len(sent.encode("utf-8"))
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return a dictionary of statistics aggregated across all the shards,
+        along with the statistics for each individual shard.
+        """
+        shards = [shard.stats() for shard in self.shards]
+        return {
+            "state": self.state,
+            "listening": self.listening,
+            "connected_users": len(self.connected_users),
+            "queued_messages": sum(
+                queue.qsize() for queue in self.connected_users.values()
+            ),
+            "channels": sum(shard["channels"] for shard in shards),
+            "messages": sum(shard["messages"] for shard in shards),
+            "shards": shards,
+        }
+
     async def stop(self) -> None:
         """
         Cleanly stop listening to the Redis PubSub.
         """
-        self.listener.cancel()
-        try:
-            await self.listener
-        except asyncio.CancelledError:
-            logger.msg("Stop PubSub.", subscribed=self.connected_users)
-        except (Error, ErrorReply) as ex:  # pragma: no cover
-            logger.msg(
-                "Error stopping listener to Redis PubSub.",
-                exc_info=ex,
-                redis_error=True,
-            )
+        if self.watchdog:
+            self.watchdog.cancel()
+        for listener in self.listeners:
+            listener.cancel()
+        if self.watchdog:
+            try:
+                await self.watchdog
+            except asyncio.CancelledError:
+                pass
+        for listener in self.listeners:
+            try:
+                await listener
+            except asyncio.CancelledError:
+                pass
+            except (Error, ErrorReply) as ex:  # pragma: no cover
+                logger.msg(
+                    "Error stopping listener to Redis PubSub.",
+                    exc_info=ex,
+                    redis_error=True,
+                )
+        logger.msg("Stop PubSub.", subscribed=self.connected_users)
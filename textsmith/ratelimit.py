@@ -0,0 +1,182 @@
+"""
+Token bucket rate limiting for user input and sensitive endpoints.
+
+Each limit has a rate (tokens added per second) and a burst (the maximum
+number of tokens in a bucket). Every request takes a token from the bucket
+for its identity (e.g. a user id or IP address) and is refused if the bucket
+is empty. Buckets live in Redis (updated atomically by a Lua script) so
+limits apply across all instances, or in memory for single node use.
+
+
+Copyright (C) 2020 Nicholas H.Tollervey (ntoll@ntoll.org).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>
+"""
+import time
+import structlog  # type: ignore
+from typing import Dict, Tuple, Union
+from asyncio_redis import Pool, Script  # type: ignore
+from asyncio_redis.exceptions import (  # type: ignore
+    Error,
+    ErrorReply,
+    ScriptKilledError,
+)
+
+
+logger = structlog.get_logger()
+
+
+#: Atomically refill the bucket at KEYS[1] for the time elapsed since it was
+#: last updated (using the Redis server's clock), then try to take a token.
+#: ARGV[1] is the rate, ARGV[2] the burst. Returns 1 if allowed, else 0.
+TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call("HMSET", KEYS[1], "tokens", tostring(tokens), "updated",
+    tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+
+def parse_limit(value: str) -> Tuple[float, float]:
+    """
+    Parse a limit expressed as "rate:burst" (e.g. "0.5:10" is one token every
+    two seconds with a burst of ten) into a tuple of floats. Raises a
+    ValueError if the rate or burst isn't positive.
+    """
+    rate, burst = (float(part) for part in value.split(":"))
+    if rate <= 0 or burst <= 0:
+        raise ValueError(f"Rate and burst must be positive: {value}")
+    return rate, burst
+
+
+class RateLimiter:
+    """
+    Gathers together methods to check named rate limits. If a Redis pool is
+    given, buckets are stored in Redis, otherwise they're kept in memory.
+    """
+
+    def __init__(
+        self,
+        limits: Dict[str, Tuple[float, float]],
+        redis: Union[Pool, None] = None,
+        sweep_interval: float = 60.0,
+    ) -> None:
+        """
+        The limits dictionary maps the name of each limit to a tuple of its
+        rate and burst. The redis object is an optional connection pool.
+
+        In memory buckets that have refilled are no more than a full bucket,
+        so they're removed every sweep_interval seconds (just as the keys of
+        buckets in Redis expire).
+        """
+        self.limits = limits
+        self.redis = redis
+        self.script: Union[Script, None] = None
+        self.sweep_interval = sweep_interval
+        # Key: bucket key Value: tuple of tokens, time last updated and time
+        # at which the bucket will have refilled.
+        self.buckets: Dict[str, Tuple[float, float, float]] = {}
+        self.swept = time.monotonic()
+
+    def bucket_key(self, name: str, identity: Union[str, int]) -> str:
+        """
+        Given the name of a limit and an identity, return the key of the
+        associated bucket.
+        """
+        return f"ratelimit:{name}:{identity}"
+
+    async def allow(self, name: str, identity: Union[str, int]) -> bool:
+        """
+        Take a token from the bucket for the referenced identity under the
+        named limit. Returns a boolean indication if the request is allowed.
+        Unknown limits always allow the request. If Redis fails, the error is
+        logged and the request is allowed.
+        """
+        if name not in self.limits:
+            return True
+        rate, burst = self.limits[name]
+        key = self.bucket_key(name, identity)
+        if self.redis is None:
+            return self.take_local(key, rate, burst)
+        try:
+            if self.script is None:
+                self.script = await self.redis.register_script(TOKEN_BUCKET)
+            try:
+                reply = await self.script.run(  # type: ignore
+                    keys=[key], args=[str(rate), str(burst)]
+                )
+            except ScriptKilledError:
+                # asyncio_redis reports any error from EVALSHA (such as
+                # NOSCRIPT after Redis is restarted) as ScriptKilledError.
+                # Load the script again and retry once, rather than failing
+                # open until this instance is restarted.
+                logger.msg("Reloading script.", script="token_bucket")
+                self.script = await self.redis.register_script(TOKEN_BUCKET)
+                reply = await self.script.run(  # type: ignore
+                    keys=[key], args=[str(rate), str(burst)]
+                )
+            allowed = bool(await reply.return_value())
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error checking rate limit.",
+                limit=name,
+                identity=identity,
+                exc_info=ex,
+                redis_error=True,
+            )
+            return True
+        if not allowed:
+            logger.msg("Rate limited.", limit=name, identity=identity)
+        return allowed
+
+    def take_local(self, key: str, rate: float, burst: float) -> bool:
+        """
+        Take a token from the in-memory bucket with the referenced key.
+        """
+        now = time.monotonic()
+        if now - self.swept >= self.sweep_interval:
+            self.sweep(now)
+        tokens, updated, _ = self.buckets.get(key, (burst, now, now))
+        tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+        return allowed
+
+    def sweep(self, now: float) -> int:
+        """
+        Remove the in-memory buckets that will have refilled by the
+        referenced (monotonic) time. Returns the number removed.
+        """
+        full = [
+            key for key, bucket in self.buckets.items() if bucket[2] <= now
+        ]
+        for key in full:
+            del self.buckets[key]
+        self.swept = now
+        return len(full)
@@ -0,0 +1,148 @@
+"""
+Schedule the evaluation of commands sent by users.
+
+Commands from the same user are evaluated one at a time in the order they
+were received, while commands from different users are evaluated
+concurrently. A global limit bounds the number of commands being evaluated
+at once on this instance, and each user may only have a limited number of
+commands waiting. Excess commands are rejected with a polite message.
+
+
+Copyright (C) 2020 Nicholas H.Tollervey (ntoll@ntoll.org).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>
+"""
+import asyncio
+import structlog  # type: ignore
+from typing import Dict, Any
+from flask_babel import gettext as _  # type: ignore
+from textsmith.parser import Parser
+from textsmith.logic import Logic
+from textsmith import constants
+
+
+logger = structlog.get_logger()
+
+
+class Scheduler:
+    """
+    Gathers together methods to queue and evaluate commands. Uses the
+    dependency injection pattern.
+    """
+
+    def __init__(
+        self,
+        parser: Parser,
+        logic: Logic,
+        concurrency: int = 100,
+        queue_limit: int = 20,
+    ) -> None:
+        """
+        The parser object evaluates commands, and the logic object is used to
+        tell users when their commands are rejected. Concurrency is the
+        maximum number of commands evaluated at once, and queue_limit is the
+        maximum number of commands waiting to be evaluated for each user.
+        """
+        self.parser = parser
+        self.logic = logic
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # Number of commands currently being evaluated.
+        self.running = 0
+        # Key: user_id Value: queue of pending commands for the user.
+        self.queues: Dict[int, asyncio.Queue] = {}
+        # Key: user_id Value: task evaluating commands for the user.
+        self.workers: Dict[int, asyncio.Task] = {}
+
+    async def submit(
+        self, user_id: int, connection_id: str, message: str
+    ) -> bool:
+        """
+        Queue the message from the referenced user for evaluation. Returns a
+        boolean indication if the message was accepted. If the user has too
+        many commands waiting, the message is rejected and the user is told.
+        """
+        message_queue = self.queues.get(user_id)
+        if message_queue is None:
+            message_queue = asyncio.Queue(maxsize=self.queue_limit)
+            self.queues[user_id] = message_queue
+            self.workers[user_id] = asyncio.create_task(
+                self.work(user_id, message_queue)
+            )
+        try:
+            message_queue.put_nowait((connection_id, message))
+        except asyncio.QueueFull:
+            logger.msg(
+                "Rejected command.",
+                user_id=user_id,
+                connection_id=connection_id,
+                message=message,
+                queued=message_queue.qsize(),
+            )
+            reply = _(
+                "Slow down! You have too many commands waiting. "
+                "Please wait for them to finish before trying again."
+            )
+            await self.logic.emit_to_user(
+                user_id, constants.SYSTEM_OUTPUT.format(reply)
+            )
+            return False
+        return True
+
+    async def work(self, user_id: int, message_queue: asyncio.Queue) -> None:
+        """
+        Evaluate the referenced user's commands in order until none are left,
+        then stop (a new worker is started when the next command arrives).
+        """
+        try:
+            while not message_queue.empty():
+                connection_id, message = message_queue.get_nowait()
+                async with self.semaphore:
+                    self.running += 1
+                    try:
+                        await self.parser.eval(user_id, connection_id, message)
+                    except Exception as ex:  # pragma: no cover
+                        # Parser.eval handles its own errors, so this is a bug.
+                        logger.msg(
+                            "Error evaluating command.",
+                            user_id=user_id,
+                            connection_id=connection_id,
+                            exc_info=ex,
+                        )
+                    finally:
+                        self.running -= 1
+        finally:
+            self.queues.pop(user_id, None)
+            self.workers.pop(user_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return a dictionary of statistics about the scheduled commands.
+        """
+        return {
+            "running": self.running,
+            "users": len(self.queues),
+            "queued": sum(queue.qsize() for queue in self.queues.values()),
+        }
+
+    async def stop(self) -> None:
+        """
+        Cancel the evaluation of all queued and running commands.
+        """
+        workers = list(self.workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        logger.msg("Stop Scheduler.")
@@ -0,0 +1,519 @@
+"""
+A DataStore that spreads the world across several Redis nodes, so the size
+of the world isn't limited by the memory of a single node.
+
+Objects are placed on nodes by consistent hashing of their ids. Every key
+belonging to an object contains the object's id as a hash tag ("{123}",
+"inventory:{123}" and "location:{123}"), so an object's attributes, contents
+and location always sit together on the same node. Adding a node only moves
+the objects whose ids hash to the new node's points on the ring.
+
+Users, confirmation tokens, the object id counter and last seen times are
+small and stay on the first ("home") node, as do presence, pub/sub, rate
+limits and the email outbox.
+
+Moving an object between containers on different nodes can't be atomic. The
+object's location is the source of truth, and inventories are an index of
+locations that is updated in this order:
+
+1. The object is added to the new container's inventory.
+2. The object's location is set. This is the moment the object moves.
+3. The object is removed from the old container's inventory.
+
+So an object is always listed in the inventory of its location, but may
+also be listed, for a moment (or after a failure between steps), in the
+inventory of a container it has left. When contents are read such entries
+are ignored, since the object's location doesn't match.
+
+Copyright (C) 2020 Nicholas H.Tollervey (ntoll@ntoll.org).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>
+"""
+import asyncio
+import bisect
+import hashlib
+import json
+import structlog  # type: ignore
+from typing import Sequence, Dict, List, Tuple, Union, Any
+from asyncio_redis import Pool  # type: ignore
+from asyncio_redis.exceptions import Error, ErrorReply  # type: ignore
+from textsmith.datastore import DataStore
+from textsmith import constants
+
+
+logger = structlog.get_logger()
+
+
+def hash_tag(key: str) -> str:
+    """
+    Return the part of the key that decides which node stores it: the text
+    between the first "{" and the following "}" (as in Redis Cluster), or
+    the whole key if there's no such text.
+    """
+    _, opened, rest = key.partition("{")
+    tag, closed, _ = rest.partition("}")
+    if opened and closed and tag:
+        return tag
+    return key
+
+
+def ring_position(value: str) -> int:
+    """
+    Return the position of the referenced value on the hash ring.
+    """
+    digest = hashlib.md5(value.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+class HashRing:
+    """
+    A consistent hash ring that maps hash tags to the names of nodes. Each
+    node has many points on the ring so tags are spread evenly between them.
+    """
+
+    def __init__(self, names: Sequence[str], points: int = 64) -> None:
+        """
+        The names identify the nodes, and each node is given points positions
+        on the ring.
+        """
+        if not names:
+            raise ValueError("A hash ring needs at least one node.")
+        ring = sorted(
+            (ring_position(f"{name}#{point}"), name)
+            for name in names
+            for point in range(points)
+        )
+        self.positions = [position for position, _ in ring]
+        self.names = [name for _, name in ring]
+
+    def get(self, tag: str) -> str:
+        """
+        Return the name of the node responsible for the referenced hash tag:
+        the owner of the first point on the ring after the tag's position.
+        """
+        index = bisect.bisect(self.positions, ring_position(tag))
+        return self.names[index % len(self.names)]
+
+
+class ShardedDataStore(DataStore):
+    """
+    A DataStore whose objects are spread across several Redis nodes. Reads
+    of many objects fan out to the nodes in parallel.
+    """
+
+    def __init__(
+        self, nodes: Dict[str, Pool], id_block_size: int = 1, points: int = 64
+    ) -> None:
+        """
+        The nodes dictionary maps the name of each Redis node (e.g.
+        "host:port") to a connection pool. The first node is the home node.
+        Objects are placed by the names of the nodes (not their order), so
+        names must stay the same when nodes are added.
+        """
+        if not nodes:
+            raise ValueError("At least one Redis node is required.")
+        self.nodes = dict(nodes)
+        super().__init__(next(iter(self.nodes.values())), id_block_size)
+        self.ring = HashRing(list(self.nodes), points)
+
+    def object_key(self, object_id: int) -> str:
+        """
+        Given an object id, return the key of the hash of its attributes.
+        """
+        return f"{{{object_id}}}"
+
+    def inventory_key(self, object_id: int) -> str:
+        """
+        Given an object id, return the key of the set of the objects it
+        contains.
+        """
+        return f"inventory:{{{object_id}}}"
+
+    def location_key(self, object_id: int) -> str:
+        """
+        Given an object id, return the key of the id of the object that
+        contains it.
+        """
+        return f"location:{{{object_id}}}"
+
+    def shard(self, object_id: int) -> str:
+        """
+        Return the name of the node that stores the referenced object.
+        """
+        return self.ring.get(hash_tag(self.object_key(object_id)))
+
+    def node(self, object_id: int) -> Pool:
+        """
+        Return the connection pool of the node that stores the referenced
+        object.
+        """
+        return self.nodes[self.shard(object_id)]
+
+    def by_shard(self, object_ids: Sequence[int]) -> Dict[str, List[int]]:
+        """
+        Group the referenced object ids by the name of the node that stores
+        them.
+        """
+        result: Dict[str, List[int]] = {}
+        for object_id in object_ids:
+            result.setdefault(self.shard(object_id), []).append(object_id)
+        return result
+
+    def load(
+        self, object_id: int, values: Dict[str, str]
+    ) -> Union[Dict[str, Any], None]:
+        """
+        Return the object with the referenced id and raw (JSON) attribute
+        values, or None if it has been deleted.
+        """
+        if constants.IS_DELETED in values:
+            return None
+        obj = {key: json.loads(value) for key, value in values.items()}
+        obj["id"] = object_id
+        return obj
+
+    async def fetch(
+        self, object_ids: Sequence[int], locations: bool = False
+    ) -> Dict[int, Tuple[Dict[str, str], Union[int, None]]]:
+        """
+        Read the raw attributes (and, if locations is True, the location) of
+        each of the referenced objects, with a transaction on each node, all
+        at once. Return a dictionary of (attributes, location) tuples.
+        """
+
+        async def fetch_from(name: str, ids: List[int]) -> List[Tuple]:
+            transaction = await self.nodes[name].multi()
+            futures = []
+            for object_id in ids:
+                futures.append(
+                    (
+                        await transaction.hgetall_asdict(
+                            self.object_key(object_id)
+                        ),
+                        await transaction.get(self.location_key(object_id))
+                        if locations
+                        else None,
+                    )
+                )
+            await transaction.exec()
+            replies = []
+            for object_id, (values, future) in zip(ids, futures):
+                location = await future if future is not None else None
+                replies.append(
+                    (
+                        object_id,
+                        await values,
+                        json.loads(location) if location else None,
+                    )
+                )
+            return replies
+
+        try:
+            replies = await asyncio.gather(
+                *(
+                    fetch_from(name, ids)
+                    for name, ids in self.by_shard(object_ids).items()
+                )
+            )
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error getting attributes for objects.",
+                object_ids=object_ids,
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+        return {
+            object_id: (values, location)
+            for reply in replies
+            for object_id, values, location in reply
+        }
+
+    async def add_objects(self, *objects: Dict[str, Any]) -> List[int]:
+        """
+        Create a new object for each of the referenced dictionaries of
+        attributes, with a transaction on each node, all at once. Return a
+        list of the ids of the new objects, in the same order.
+        """
+        if not objects:
+            return []
+        object_ids = await self.ids.allocate(len(objects))
+        by_node: Dict[str, List[Tuple[int, Dict[str, Any]]]] = {}
+        for object_id, attributes in zip(object_ids, objects):
+            if attributes:
+                by_node.setdefault(self.shard(object_id), []).append(
+                    (object_id, attributes)
+                )
+
+        async def add_to(
+            name: str, items: List[Tuple[int, Dict[str, Any]]]
+        ) -> None:
+            transaction = await self.nodes[name].multi()
+            for object_id, attributes in items:
+                await transaction.hmset(
+                    self.object_key(object_id),
+                    {
+                        attribute: json.dumps(value)
+                        for attribute, value in attributes.items()
+                    },
+                )
+            await transaction.exec()
+
+        try:
+            await asyncio.gather(
+                *(add_to(name, items) for name, items in by_node.items())
+            )
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error adding objects.",
+                object_ids=object_ids,
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+        logger.msg("Created new objects.", object_ids=object_ids)
+        return object_ids
+
+    async def annotate_object(self, object_id: int, **attributes: Any) -> None:
+        """
+        Annotate attributes to the object.
+        """
+        data = {
+            attribute: json.dumps(value)
+            for attribute, value in attributes.items()
+        }
+        try:
+            await self.node(object_id).hmset(self.object_key(object_id), data)
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error annotating object.",
+                object_id=object_id,
+                attributes=attributes,
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+        logger.msg(
+            "Annotated attributes to object.",
+            object_id=object_id,
+            data=attributes,
+        )
+
+    async def get_objects(self, ids: Sequence[int]) -> Dict[int, Dict]:
+        """
+        Given a list of object IDs, return a dictionary whose keys are object
+        IDs and values are a dictionary of the related attributes of each
+        object. Deleted objects are ignored.
+        """
+        fetched = await self.fetch(ids)
+        result = {}
+        for object_id in ids:
+            obj = self.load(object_id, fetched[object_id][0])
+            if obj is not None:
+                result[object_id] = obj
+        return result
+
+    async def get_attribute(self, object_id: int, attribute: str) -> Any:
+        """
+        Given an object ID and attribute, return the associated value or raise
+        a KeyError to indicate the attribute doesn't exist on the object.
+        """
+        try:
+            result = await self.node(object_id).hget(
+                self.object_key(object_id), attribute
+            )
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error getting attribute for object.",
+                object_id=object_id,
+                attribute=attribute,
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+        if result is None:
+            raise KeyError(
+                f"Attribute '{attribute}' on #{object_id} does not exist."
+            )
+        return json.loads(result)
+
+    async def get_attributes(
+        self, requests: Sequence[Tuple[int, str]]
+    ) -> Dict[Tuple[int, str], Any]:
+        """
+        Given a list of (object ID, attribute) pairs, fetch all their values
+        with a transaction on each node, all at once. Pairs for attributes
+        that don't exist are missing from the result.
+        """
+        by_node: Dict[str, List[Tuple[int, str]]] = {}
+        for request in requests:
+            by_node.setdefault(self.shard(request[0]), []).append(request)
+
+        async def get_from(name: str, pairs: List[Tuple[int, str]]) -> List:
+            transaction = await self.nodes[name].multi()
+            futures = [
+                await transaction.hget(self.object_key(object_id), attribute)
+                for object_id, attribute in pairs
+            ]
+            await transaction.exec()
+            return [
+                (pair, await future) for pair, future in zip(pairs, futures)
+            ]
+
+        try:
+            replies = await asyncio.gather(
+                *(get_from(name, pairs) for name, pairs in by_node.items())
+            )
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error getting attributes.",
+                requests=requests,
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+        return {
+            pair: json.loads(value)
+            for reply in replies
+            for pair, value in reply
+            if value is not None
+        }
+
+    async def delete_attributes(
+        self, object_id: int, attributes: Sequence[str]
+    ) -> int:
+        """
+        Given an object ID and list of attributes, delete them. Returns the
+        number of attributes deleted.
+        """
+        try:
+            number_changed = await self.node(object_id).hdel(
+                self.object_key(object_id), attributes
+            )
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error deleting attributes from object.",
+                object_id=object_id,
+                attributes=attributes,
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+        logger.msg(
+            f"Deleted {number_changed} attributes from object.",
+            object_id=object_id,
+            attributes=attributes,
+        )
+        return number_changed
+
+    async def set_container(
+        self, object_id: int, container_id: int
+    ) -> Union[int, None]:
+        """
+        Ensure the referenced object is contained by the object referenced
+        as container_id (or not contained anywhere if container_id < 0).
+        Returns the id of the old container, or None.
+
+        The object's location is swapped atomically on its node, after it is
+        added to the new container's inventory and before it is removed from
+        the old container's inventory (see the module docstring).
+        """
+        location_key = self.location_key(object_id)
+        try:
+            if container_id >= 0:
+                await self.node(container_id).sadd(
+                    self.inventory_key(container_id), [str(object_id)]
+                )
+            transaction = await self.node(object_id).multi()
+            old = await transaction.get(location_key)
+            if container_id >= 0:
+                await transaction.set(location_key, json.dumps(container_id))
+            else:
+                await transaction.delete([location_key])
+            await transaction.exec()
+            old = await old
+            old_container_id = json.loads(old) if old else None
+            if old_container_id not in (None, container_id):
+                await self.node(old_container_id).srem(
+                    self.inventory_key(old_container_id), [str(object_id)]
+                )
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error moving object.",
+                object_id=object_id,
+                container_id=container_id,
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+        logger.msg(
+            "Moved object.",
+            object_id=object_id,
+            container_id=container_id,
+            old_container_id=old_container_id,
+        )
+        return old_container_id
+
+    async def get_content_ids(self, object_id: int) -> List[int]:
+        """
+        Return the ids listed in the inventory of the referenced object. This
+        may include objects that are in the middle of leaving it.
+        """
+        try:
+            contents = await self.node(object_id).smembers_asset(
+                self.inventory_key(object_id)
+            )
+        except (Error, ErrorReply) as ex:  # pragma: no cover
+            logger.msg(
+                "Error getting contents.",
+                object_id=object_id,
+                exc_info=ex,
+                redis_error=True,
+            )
+            raise ex
+        return [int(i) for i in contents]
+
+    async def get_contents(self, object_id: int) -> Dict[int, Dict]:
+        """
+        Return a dictionary containing all the objects contained within the
+        referenced object. Inventory entries for objects whose location is
+        elsewhere are ignored.
+        """
+        fetched = await self.fetch(
+            await self.get_content_ids(object_id), locations=True
+        )
+        result = {}
+        for content_id, (values, location) in fetched.items():
+            if location != object_id:
+                logger.msg(
+                    "Ignored stale inventory entry.",
+                    object_id=object_id,
+                    content_id=content_id,
+                    location=location,
+                )
+                continue
+            obj = self.load(content_id, values)
+            if obj is not None:
+                result[content_id] = obj
+        return result
+
+    async def get_location(self, object_id) -> Union[int, None]:
+        """
+        Given an object_id, return the id of the object that contains it. If
+        the object is not contained within another object, return None.
+        """
+        result = await self.node(object_id).get(self.location_key(object_id))
+        if result:
+            return json.loads(result)
+        return None
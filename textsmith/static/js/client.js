@@ -8,8 +8,14 @@ $(document).ready(function(){
 
     // Define what to do when our websocket gets a message from the server.
     websocket.onmessage = function(e) {
-        // Just call onMessageAdded with the raw data from the server.
-        onMessageAdded(e.data);
+        // Several messages may arrive in one frame, separated by the ASCII
+        // "record separator" character. Call onMessageAdded with each.
+        // Each message is a JSON envelope whose body is the HTML to display.
+        e.data.split("\x1e").forEach(function(data) {
+            if(data) {
+                onMessageAdded(JSON.parse(data).body);
+            }
+        });
     }
 
     // Define what to do when the submit button is clicked.
@@ -0,0 +1,187 @@
+"""
+Lightweight tracing of the commands evaluated by the parser.
+
+A trace is started when a command is evaluated and is carried through the
+parser, verbs, logic and DataStore by a context variable, so nothing needs
+to be passed by hand. Spans time the stages the command passes through, and
+when the command finishes a single log entry summarises how long it took
+and how long was spent in each stage::
+
+    {
+      "event": "Trace.",
+      "message_id": "...",
+      "duration": 0.0123,
+      "spans": {
+        "parse": {"count": 1, "duration": 0.0121},
+        "verb.look": {"count": 1, "duration": 0.0119},
+        "datastore.get_objects": {"count": 2, "duration": 0.0094},
+        ...
+      }
+    }
+
+Spans nest, so the duration of a span includes the durations of the spans
+within it. Spans of the same name are added together.
+
+Only a sample of commands are logged (see configure).
+
+Copyright (C) 2020 Nicholas H.Tollervey (ntoll@ntoll.org).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>
+"""
+import contextlib
+import functools
+import inspect
+import random
+import time
+import structlog  # type: ignore
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Union
+
+
+logger = structlog.get_logger()
+
+
+#: The fraction of commands whose traces are logged.
+sample_rate = 0.0
+#: If greater than zero, every command is traced and those that take at least
+#: this many seconds are always logged.
+slow_threshold = 0.0
+
+
+class Trace:
+    """
+    The spans recorded while evaluating a single command.
+    """
+
+    def __init__(self, message_id: str, sampled: bool, **fields: Any) -> None:
+        """
+        The message_id identifies the command. If sampled is True the trace
+        is logged however long the command takes. The fields are added to
+        the logged summary.
+        """
+        self.message_id = message_id
+        self.sampled = sampled
+        self.fields = fields
+        self.started = time.monotonic()
+        # Key: span name Value: [count, total duration].
+        self.spans: Dict[str, List[Union[int, float]]] = {}
+
+    def add(self, name: str, duration: float) -> None:
+        """
+        Add a span of the referenced duration.
+        """
+        span = self.spans.get(name)
+        if span is None:
+            self.spans[name] = [1, duration]
+        else:
+            span[0] += 1
+            span[1] += duration
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Return the duration of the command and the breakdown of its spans.
+        """
+        return {
+            "message_id": self.message_id,
+            "duration": round(time.monotonic() - self.started, 6),
+            "spans": {
+                name: {"count": count, "duration": round(duration, 6)}
+                for name, (count, duration) in self.spans.items()
+            },
+            **self.fields,
+        }
+
+
+#: The trace of the command currently being evaluated, or None if it isn't
+#: being traced.
+current_trace: ContextVar[Union[Trace, None]] = ContextVar(
+    "current_trace", default=None
+)
+
+
+def configure(sample: float = 0.0, slow: float = 0.0) -> None:
+    """
+    Log the traces of the referenced fraction (0.0 to 1.0) of commands. If
+    slow is greater than zero every command is traced, and those that take
+    at least slow seconds are logged too.
+    """
+    global sample_rate, slow_threshold
+    sample_rate = sample
+    slow_threshold = slow
+    logger.msg("Trace Config.", sample=sample, slow=slow)
+
+
+def start(message_id: str, **fields: Any) -> Union[Trace, None]:
+    """
+    Start tracing the command with the referenced message_id in the current
+    context, if it's sampled or slow commands are being traced. Return the
+    trace, or None if the command isn't traced.
+    """
+    sampled = random.random() < sample_rate
+    trace = None
+    if sampled or slow_threshold > 0:
+        trace = Trace(message_id, sampled, **fields)
+    current_trace.set(trace)
+    return trace
+
+
+def finish() -> None:
+    """
+    Stop tracing the current command, logging its summary if it was sampled
+    or was slow.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        return
+    current_trace.set(None)
+    summary = trace.summary()
+    slow = 0 < slow_threshold <= summary["duration"]
+    if trace.sampled or slow:
+        logger.msg("Trace.", slow=slow, **summary)
+
+
+@contextlib.contextmanager
+def span(name: str) -> Iterator[None]:
+    """
+    Time the code within the context as a span of the current trace. Does
+    nothing if the current command isn't being traced.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        trace.add(name, time.monotonic() - started)
+
+
+def instrument(obj: Any, prefix: str) -> None:
+    """
+    Replace each public coroutine method of the referenced object with one
+    that is timed as a span named after the prefix and the method.
+    """
+
+    def traced(name: str, method: Any) -> Any:
+        @functools.wraps(method)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name):
+                return await method(*args, **kwargs)
+
+        return wrapper
+
+    for name, method in inspect.getmembers(obj, inspect.iscoroutinefunction):
+        if not name.startswith("_"):
+            setattr(obj, name, traced(f"{prefix}.{name}", method))
@@ -18,7 +18,8 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>
 """
 import structlog  # type: ignore
-from textsmith import constants
+from typing import Awaitable, Callable, Dict, Sequence, Tuple
+from textsmith import constants, metrics, trace
 from textsmith.logic import Logic
 from flask_babel import gettext as _  # type: ignore
 
@@ -26,6 +27,17 @@ from flask_babel import gettext as _  # type: ignore
 logger = structlog.get_logger()
 
 
+#: The number of commands evaluated, by verb.
+COMMANDS = metrics.REGISTRY.counter(
+    "textsmith_commands_total", "Commands evaluated, by verb.", ["verb"]
+)
+
+
+#: The signature of a verb handler: user_id, connection_id, message_id and
+#: message.
+Handler = Callable[[int, str, str, str], Awaitable[None]]
+
+
 class UnknownVerb(Exception):
     """
     An exception that indicates the passed in verb was not found.
@@ -43,6 +55,10 @@ class Verbs:
     The methods for verbs should NOT be called directly. Rather just call the
     Verb object with the verb written as appropriately for the user's locale
     and the translation to the actual method to use will happen automatically.
+
+    Further verbs may be plugged in via the register method. A verb may be
+    abbreviated to any prefix that identifies only one handler (e.g. "sh" for
+    "shout").
     """
 
     def __init__(self, logic: Logic) -> None:
@@ -54,7 +70,7 @@ class Verbs:
         self.languages = [
             "en",
         ]  # TODO: Add more. :-)
-        self._VERBS = {
+        self._VERBS: Dict[str, Dict[Tuple[str, ...], Handler]] = {
             "en": {
                 # Say something.
                 ("say",): self._say,
@@ -70,6 +86,56 @@ class Verbs:
                 ("tell",): self._tell,
             }
         }
+        # Lower-cased spelling -> handler, for each locale.
+        self._dispatch: Dict[str, Dict[str, Handler]] = {}
+        # Unique abbreviation -> handler, for each locale.
+        self._prefixes: Dict[str, Dict[str, Handler]] = {}
+        for locale in self._VERBS:
+            self._compile(locale)
+
+    def register(
+        self, spellings: Sequence[str], handler: Handler, locale: str = "en"
+    ) -> None:
+        """
+        Register the handler coroutine for the given spellings of a verb in
+        the given locale. The handler is called with the user_id,
+        connection_id, message_id and message.
+
+        Raises a ValueError if a spelling is already used by another verb.
+        """
+        spellings = tuple(spelling.lower() for spelling in spellings)
+        if not spellings:
+            raise ValueError("A verb needs at least one spelling.")
+        dispatch = self._dispatch.get(locale, {})
+        for spelling in spellings:
+            if spelling in dispatch and dispatch[spelling] != handler:
+                raise ValueError(f"Verb already registered: {spelling}")
+        self._VERBS.setdefault(locale, {})[spellings] = handler
+        self._compile(locale)
+        logger.msg("Register verb.", spellings=spellings, locale=locale)
+
+    def _compile(self, locale: str) -> None:
+        """
+        Rebuild the dispatch and unique-prefix tables for the given locale.
+        """
+        dispatch: Dict[str, Handler] = {}
+        for spellings, handler in self._VERBS[locale].items():
+            for spelling in spellings:
+                dispatch[spelling.lower()] = handler
+        candidates: Dict[str, Handler] = {}
+        ambiguous = set()
+        for spelling, handler in dispatch.items():
+            for i in range(1, len(spelling)):
+                prefix = spelling[:i]
+                if candidates.get(prefix, handler) != handler:
+                    ambiguous.add(prefix)
+                candidates[prefix] = handler
+        self._dispatch[locale] = dispatch
+        self._prefixes[locale] = {
+            prefix: handler
+            for prefix, handler in candidates.items()
+            if prefix not in ambiguous
+        }
 
     async def __call__(
         self,
@@ -83,18 +149,22 @@ class Verbs:
         """
         Attempt to call the given verb, in the given context, with the given
         message in the given locale. If the verb wasn't found, this method will
-        raise a ValueError.
+        raise an UnknownVerb exception.
+
+        Exact spellings take precedence over abbreviations.
         """
-        if locale in self._VERBS:
-            verbs = self._VERBS[locale]
-        else:
-            verbs = self._VERBS["en"]  # Default to English if in doubt.
-        for matches in verbs:
-            if verb.lower() in matches:
-                return await verbs[matches](
-                    user_id, connection_id, message_id, message
-                )
-        raise UnknownVerb("No such verb.")
+        if locale not in self._dispatch:
+            locale = "en"  # Default to English if in doubt.
+        verb = verb.lower()
+        handler = self._dispatch[locale].get(verb)
+        if handler is None:
+            handler = self._prefixes[locale].get(verb)
+        if handler is None:
+            raise UnknownVerb("No such verb.")
+        name = getattr(handler, "__name__", verb).lstrip("_")
+        COMMANDS.labels(name).inc()
+        with trace.span(f"verb.{name}"):
+            return await handler(user_id, connection_id, message_id, message)
 
     async def _say(
         self, user_id: int, connection_id: str, message_id: str, message: str
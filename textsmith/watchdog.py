@@ -0,0 +1,126 @@
+"""
+Detects code that blocks the event loop.
+
+Everything in TextSmith (password hashing, Markdown rendering, scripts and
+the websockets of every connected user) runs on a single event loop, so a
+callback or task step that doesn't yield stalls everything else. The
+LoopMonitor task (see the metrics module) wakes up every interval. The
+Watchdog runs in a separate thread and, if the monitor hasn't woken up for
+longer than a threshold, logs a sample of the stack of the event loop's
+thread. The stack shows which code path is holding up the loop.
+
+Copyright (C) 2020 Nicholas H.Tollervey (ntoll@ntoll.org).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>
+"""
+import asyncio
+import sys
+import threading
+import time
+import traceback
+import structlog  # type: ignore
+from typing import Union
+from textsmith import metrics
+
+
+logger = structlog.get_logger()
+
+
+#: The number of times the event loop stalled for longer than the threshold.
+STALLS = metrics.REGISTRY.counter(
+    "textsmith_loop_stalls_total", "Event loop stalls over the threshold."
+).labels()
+
+
+class Watchdog:
+    """
+    Watches the referenced LoopMonitor from a background thread, and logs
+    a stack sample of the event loop's thread whenever the loop stalls.
+    """
+
+    def __init__(
+        self, monitor: metrics.LoopMonitor, threshold: float = 0.25
+    ) -> None:
+        """
+        A stall is logged when the monitor is at least threshold seconds
+        late waking up. The monitor's interval should be shorter than the
+        threshold, so stalls are caught while they are happening.
+        """
+        self.monitor = monitor
+        self.threshold = threshold
+        self.loop: Union[asyncio.AbstractEventLoop, None] = None
+        self.thread_id: Union[int, None] = None
+        self.thread: Union[threading.Thread, None] = None
+        self.stopped = threading.Event()
+        # The beat of the monitor during which a stall was last reported, so
+        # each stall is only reported once.
+        self.reported: Union[float, None] = None
+
+    def check(self) -> Union[float, None]:
+        """
+        Log a stack sample of the event loop's thread if it has stalled since
+        the monitor last woke up. Return the length of the stall (in
+        seconds), or None if it hasn't stalled or was already reported.
+        """
+        beat = self.monitor.beat
+        stalled = time.monotonic() - beat - self.monitor.interval
+        if stalled < self.threshold or beat == self.reported:
+            return None
+        self.reported = beat
+        STALLS.inc()
+        frame = sys._current_frames().get(self.thread_id)  # type: ignore
+        stack = "".join(traceback.format_stack(frame)) if frame else ""
+        task = None
+        if self.loop is not None:
+            current = asyncio.current_task(self.loop)
+            if current is not None:
+                task = current.get_name()
+                coroutine = current.get_coro()
+                task += " " + getattr(coroutine, "__qualname__", "")
+        logger.msg(
+            "Event loop stalled.",
+            stalled=round(stalled, 6),
+            threshold=self.threshold,
+            task=task,
+            stack=stack,
+        )
+        return stalled
+
+    def watch(self) -> None:
+        """
+        Check for stalls every interval of the monitor until stopped.
+        """
+        while not self.stopped.wait(self.monitor.interval):
+            self.check()
+
+    def start(self) -> None:
+        """
+        Start watching the event loop running in the current thread.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self.watch, name="textsmith-watchdog", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop watching the event loop.
+        """
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,287 @@
+"""
+Run several worker processes of the application, to use every core.
+
+Usage::
+
+    python -m textsmith.workers --bind 0.0.0.0:8000 --workers 4
+
+Each worker is a separate process with nothing shared with the others: it
+has its own event loop, Redis connection pools, PubSub subscribers and
+connected users. Each worker binds its own listening socket to the same
+address with SO_REUSEPORT, so the kernel spreads new connections between
+them. Since users are connected to a particular worker, messages reach them
+via Redis pub/sub, as they would across several hosts.
+
+The launcher restarts workers that exit unexpectedly, waiting longer after
+each consecutive failure of a worker. If a worker keeps failing (for
+example, because it can't reach Redis when it starts) the launcher gives up,
+stops the other workers and exits with a non-zero status.
+
+When the launcher is stopped (SIGTERM or SIGINT) each worker tells its
+connected users that the server is restarting, closes their websockets and
+shuts down. The workers share their metrics via a temporary directory, so the
+/metrics endpoint of any worker reports all of them.
+
+Copyright (C) 2020 Nicholas H.Tollervey (ntoll@ntoll.org).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import structlog  # type: ignore
+from typing import Any, Dict, List, Union
+
+
+logger = structlog.get_logger()
+
+
+def bind_socket(address: str) -> socket.socket:
+    """
+    Return a socket bound to the referenced "host:port" address, that other
+    processes may also bind to (with SO_REUSEPORT).
+    """
+    host, _, port = address.rpartition(":")
+    host = host.strip("[]")
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, int(port)))
+    return sock
+
+
+def run_worker(
+    worker: int, address: str, metrics_dir: str, grace: float
+) -> None:  # pragma: no cover
+    """
+    Serve the application, in this process, on the referenced address until
+    sent SIGTERM or SIGINT.
+    """
+    os.environ["TEXTSMITH_WORKER"] = str(worker)
+    os.environ["TEXTSMITH_METRICS_DIR"] = metrics_dir
+    # The application reads its configuration when it's imported.
+    from hypercorn.asyncio import serve  # type: ignore
+    from hypercorn.config import Config  # type: ignore
+    from textsmith.app import app, drain
+
+    sock = bind_socket(address)
+    config = Config()
+    config.bind = [f"fd://{sock.fileno()}"]
+    config.graceful_timeout = grace + 5.0
+
+    async def main() -> None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+
+        async def shutdown() -> None:
+            await stop.wait()
+            await drain(grace)
+
+        # Quart's __call__ doesn't match hypercorn's type for ASGI apps.
+        await serve(app, config, shutdown_trigger=shutdown)  # type: ignore
+
+    asyncio.run(main())
+
+
+class Supervisor:
+    """
+    Starts the worker processes, restarts any that exit unexpectedly, and
+    stops them all.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        address: str,
+        grace: float = 5.0,
+        context: Any = None,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        max_failures: int = 5,
+        stable: float = 60.0,
+    ) -> None:
+        """
+        Run the referenced number of workers on the "host:port" address.
+        Workers are given grace seconds to drain their connections when
+        stopped. The context is the multiprocessing context used to start
+        them (by default, new processes are spawned rather than forked).
+
+        A worker that exits is restarted after an exponentially increasing
+        number of seconds (starting at backoff and capped at max_backoff)
+        for each consecutive failure. A worker fails if it exits within
+        stable seconds of starting. After max_failures consecutive failures
+        of a worker, the supervisor gives up and is stopped.
+        """
+        self.workers = workers
+        self.address = address
+        self.grace = grace
+        self.context = context or multiprocessing.get_context("spawn")
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_failures = max_failures
+        self.stable = stable
+        self.metrics_dir = tempfile.mkdtemp(prefix="textsmith-metrics-")
+        # Key: worker number Value: the worker's process.
+        self.processes: Dict[int, Any] = {}
+        # Key: worker number Value: the (monotonic) time it was started.
+        self.started: Dict[int, float] = {}
+        # Key: worker number Value: its number of consecutive failures.
+        self.failures: Dict[int, int] = {}
+        # Key: worker number Value: the (monotonic) time to restart it.
+        self.restarts: Dict[int, float] = {}
+        # Flag to show the supervisor gave up on a failing worker.
+        self.failed = False
+        self.stopped = threading.Event()
+
+    def start_worker(self, worker: int) -> None:
+        """
+        Start the referenced worker's process.
+        """
+        process = self.context.Process(
+            target=run_worker,
+            args=(worker, self.address, self.metrics_dir, self.grace),
+            name=f"textsmith-worker-{worker}",
+        )
+        process.start()
+        self.processes[worker] = process
+        self.started[worker] = time.monotonic()
+        logger.msg("Started worker.", worker=worker, pid=process.pid)
+
+    def start(self) -> None:
+        """
+        Start all the workers.
+        """
+        # Fail early (in this process) if the address can't be bound.
+        bind_socket(self.address).close()
+        for worker in range(self.workers):
+            self.start_worker(worker)
+
+    def check(self) -> List[int]:
+        """
+        Schedule the restart of any workers that have exited, and restart
+        those that are due. Return the numbers of the restarted workers. If a
+        worker has failed too many times in a row, give up and stop.
+        """
+        now = time.monotonic()
+        restarted = []
+        for worker, process in list(self.processes.items()):
+            if worker in self.restarts:
+                if now >= self.restarts[worker]:
+                    del self.restarts[worker]
+                    self.start_worker(worker)
+                    restarted.append(worker)
+                continue
+            if process.is_alive():
+                continue
+            if now - self.started.get(worker, now) >= self.stable:
+                self.failures[worker] = 0
+            failures = self.failures.get(worker, 0) + 1
+            self.failures[worker] = failures
+            logger.msg(
+                "Worker exited.",
+                worker=worker,
+                pid=process.pid,
+                exitcode=process.exitcode,
+                failures=failures,
+            )
+            if failures > self.max_failures:
+                logger.msg("Worker keeps failing.", worker=worker)
+                self.failed = True
+                self.stopped.set()
+                break
+            delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+            self.restarts[worker] = now + delay
+        return restarted
+
+    def run(self, interval: float = 1.0) -> None:
+        """
+        Check the workers every interval seconds until stopped (or the
+        supervisor gives up).
+        """
+        while not self.stopped.wait(interval):
+            self.check()
+
+    def stop(self, timeout: Union[float, None] = None) -> None:
+        """
+        Ask every worker to shut down, wait for them to drain their
+        connections (killing any that take longer than the timeout) and
+        clean up the shared metrics.
+        """
+        self.stopped.set()
+        if timeout is None:
+            timeout = self.grace + 10.0
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()  # SIGTERM.
+        for worker, process in self.processes.items():
+            process.join(timeout)
+            if process.is_alive():  # pragma: no cover
+                logger.msg("Killing worker.", worker=worker, pid=process.pid)
+                process.kill()
+                process.join()
+        self.processes = {}
+        shutil.rmtree(self.metrics_dir, ignore_errors=True)
+        logger.msg("Stopped workers.")
+
+
+def main(argv: Union[List[str], None] = None) -> None:  # pragma: no cover
+    """
+    Run the workers until sent SIGTERM or SIGINT. Exit with a non-zero
+    status if a worker keeps failing.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m textsmith.workers",
+        description="Run several worker processes of TextSmith.",
+    )
+    parser.add_argument(
+        "--bind", default="127.0.0.1:8000", help="the host:port to serve"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="the number of worker processes (default: one per core)",
+    )
+    parser.add_argument(
+        "--grace",
+        type=float,
+        default=5.0,
+        help="seconds given to workers to drain their websockets",
+    )
+    args = parser.parse_args(argv)
+    supervisor = Supervisor(args.workers, args.bind, args.grace)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: supervisor.stopped.set())
+    supervisor.start()
+    try:
+        supervisor.run()
+    finally:
+        supervisor.stop()
+    if supervisor.failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,464 @@
+"""
+Export and import a whole world as newline delimited JSON records, so it can
+be backed up or moved between Redis instances while the game keeps running.
+
+Usage::
+
+    python -m textsmith.world export world.ndjson
+    python -m textsmith.world import world.ndjson --checkpoint world.ckpt
+
+The Redis instance is configured with the same TEXTSMITH_REDIS_* environment
+variables as the application.
+
+Copyright (C) 2020 Nicholas H.Tollervey (ntoll@ntoll.org).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import time
+import asyncio_redis  # type: ignore
+import structlog  # type: ignore
+import textsmith.log  # noqa
+from typing import Dict, Any, List, Sequence, TextIO, Union
+from asyncio_redis import Script  # type: ignore
+from asyncio_redis.exceptions import Error, ErrorReply  # type: ignore
+from textsmith.datastore import DataStore
+
+
+logger = structlog.get_logger()
+
+
+class Progress:
+    """
+    Counts records and regularly logs the throughput.
+    """
+
+    def __init__(self, name: str, interval: float = 5.0) -> None:
+        """
+        The name describes what is being counted, and the throughput is logged
+        every interval seconds.
+        """
+        self.name = name
+        self.interval = interval
+        self.records = 0
+        self.start = time.monotonic()
+        self.logged = self.start
+
+    def add(self, count: int) -> None:
+        """
+        Count more records, logging the throughput if it's time to do so.
+        """
+        self.records += count
+        now = time.monotonic()
+        if now - self.logged >= self.interval:
+            self.logged = now
+            self.log("progress")
+
+    def log(self, status: str) -> None:
+        """
+        Log the number of records and the throughput so far.
+        """
+        elapsed = time.monotonic() - self.start
+        logger.msg(
+            f"{self.name} {status}.",
+            records=self.records,
+            seconds=round(elapsed, 3),
+            records_per_second=round(self.records / elapsed, 1)
+            if elapsed
+            else 0,
+        )
+
+
+def key_type(datastore: DataStore, key: str) -> Union[str, None]:
+    """
+    Return the type of record ("hash", "set", "zset" or "string") used to
+    export the referenced key, or None if the key isn't part of the world
+    (for example, presence, rate limits or the email outbox).
+    """
+    if key.isdigit() or key.startswith(datastore.user_key("")):
+        return "hash"  # Objects and users.
+    if key.startswith(datastore.inventory_key("")):  # type: ignore
+        return "set"
+    if key == datastore.recently_seen_key():
+        return "zset"
+    if key == datastore.ids.key or key.startswith(
+        (
+            datastore.location_key(""),  # type: ignore
+            datastore.token_key(""),
+            datastore.last_seen_key(""),  # type: ignore
+        )
+    ):
+        return "string"
+    return None
+
+
+def write_record(output: TextIO, kind: str, key: str, value: Any) -> None:
+    """
+    Write a single record to the output.
+    """
+    output.write(json.dumps({"type": kind, "key": key, "value": value}))
+    output.write("\n")
+
+
+async def export_strings(
+    datastore: DataStore, keys: Sequence[str], output: TextIO
+) -> int:
+    """
+    Write a record for each of the referenced string keys, fetched in a
+    single transaction. Return the number of records written (keys deleted
+    since they were found are skipped).
+    """
+    try:
+        transaction = await datastore.redis.multi()
+        futures = [await transaction.get(key) for key in keys]
+        await transaction.exec()
+        values = [await future for future in futures]
+    except (Error, ErrorReply) as ex:  # pragma: no cover
+        logger.msg(
+            "Error exporting strings.",
+            keys=len(keys),
+            exc_info=ex,
+            redis_error=True,
+        )
+        raise ex
+    count = 0
+    for key, value in zip(keys, values):
+        if value is not None:
+            write_record(output, "string", key, value)
+            count += 1
+    return count
+
+
+async def export_collection(
+    datastore: DataStore,
+    kind: str,
+    key: str,
+    output: TextIO,
+    chunk_size: int = 1000,
+) -> int:
+    """
+    Write records for the hash, set or sorted set at the referenced key,
+    iterating over it with HSCAN, SSCAN or ZSCAN. Large collections are split
+    into several records of up to chunk_size items. Return the number of
+    records written.
+    """
+    scan = {
+        "hash": datastore.redis.hscan,
+        "set": datastore.redis.sscan,
+        "zset": datastore.redis.zscan,
+    }[kind]
+    try:
+        cursor = await scan(key)
+        cursor.count = chunk_size
+        count = 0
+        chunk: Union[Dict[str, Any], List[str]] = (
+            [] if kind == "set" else {}
+        )
+        while True:
+            item = await cursor.fetchone()
+            if item is None:
+                break
+            if kind == "set":
+                chunk.append(item)  # type: ignore
+            else:
+                chunk.update(item)  # type: ignore
+            if len(chunk) >= chunk_size:
+                write_record(output, kind, key, chunk)
+                count += 1
+                chunk = [] if kind == "set" else {}
+    except (Error, ErrorReply) as ex:  # pragma: no cover
+        logger.msg(
+            "Error exporting collection.",
+            key=key,
+            exc_info=ex,
+            redis_error=True,
+        )
+        raise ex
+    if chunk:
+        write_record(output, kind, key, chunk)
+        count += 1
+    return count
+
+
+async def export_world(
+    datastore: DataStore, output: TextIO, chunk_size: int = 1000
+) -> int:
+    """
+    Stream every object, user, inventory, location, token and last seen
+    record to the output, one JSON record per line. Keys are found with SCAN
+    so memory use doesn't depend on the size of the world. Return the number
+    of records written.
+
+    The world may change during the export. Each key is exported as it is
+    when it's reached, except the counter of object ids, which is exported
+    last so it's at least as large as the id of every object exported.
+    """
+    progress = Progress("Export")
+    try:
+        cursor = await datastore.redis.scan()
+        cursor.count = chunk_size
+        strings: List[str] = []
+        while True:
+            key = await cursor.fetchone()
+            if key is None:
+                break
+            if key == datastore.ids.key:
+                continue  # Exported once the scan is complete.
+            kind = key_type(datastore, key)
+            if kind == "string":
+                strings.append(key)
+                if len(strings) >= chunk_size:
+                    progress.add(
+                        await export_strings(datastore, strings, output)
+                    )
+                    strings = []
+            elif kind:
+                progress.add(
+                    await export_collection(
+                        datastore, kind, key, output, chunk_size
+                    )
+                )
+    except (Error, ErrorReply) as ex:  # pragma: no cover
+        logger.msg("Error exporting world.", exc_info=ex, redis_error=True)
+        raise ex
+    if strings:
+        progress.add(await export_strings(datastore, strings, output))
+    progress.add(await export_strings(datastore, [datastore.ids.key], output))
+    progress.log("finished")
+    return progress.records
+
+
+#: Set the string at KEYS[1] to the number ARGV[1], unless it already holds a
+#: larger number. Returns the resulting number.
+SET_MAX = """
+local current = tonumber(redis.call("GET", KEYS[1])) or 0
+local new = tonumber(ARGV[1])
+if new > current then
+    redis.call("SET", KEYS[1], ARGV[1])
+    return new
+end
+return current
+"""
+
+
+def read_checkpoint(path: Union[str, None]) -> int:
+    """
+    Return the number of input lines already imported according to the
+    checkpoint file at the referenced path (or 0 if there isn't one).
+    """
+    if path and os.path.exists(path):
+        with open(path) as checkpoint:
+            return int(checkpoint.read().strip() or 0)
+    return 0
+
+
+def write_checkpoint(path: Union[str, None], line: int) -> None:
+    """
+    Atomically record that all the input lines up to and including the
+    referenced line have been imported.
+    """
+    if path:
+        temp = path + ".tmp"
+        with open(temp, "w") as checkpoint:
+            checkpoint.write(str(line))
+        os.replace(temp, path)
+
+
+async def import_batch(
+    datastore: DataStore,
+    records: Sequence[Dict[str, Any]],
+    set_max: Union[Script, None] = None,
+) -> None:
+    """
+    Write the referenced records to Redis in a single transaction. Writes
+    are idempotent, so importing a batch again does no harm.
+
+    The counter of object ids is only ever increased (after the transaction,
+    with the registered SET_MAX script, if given) so ids already allocated
+    by the target are never handed out again.
+    """
+    counters = []
+    try:
+        transaction = await datastore.redis.multi()
+        for record in records:
+            kind, key, value = record["type"], record["key"], record["value"]
+            if key == datastore.ids.key:
+                counters.append(value)
+            elif kind == "hash":
+                await transaction.hmset(key, value)
+            elif kind == "set":
+                await transaction.sadd(key, value)
+            elif kind == "zset":
+                await transaction.zadd(key, value)
+            elif kind == "string":
+                await transaction.set(key, value)
+        await transaction.exec()
+        if counters and set_max is None:
+            set_max = await datastore.redis.register_script(SET_MAX)
+        for value in counters:
+            await set_max.run(  # type: ignore
+                keys=[datastore.ids.key], args=[str(value)]
+            )
+    except (Error, ErrorReply) as ex:  # pragma: no cover
+        logger.msg(
+            "Error importing batch.",
+            records=len(records),
+            exc_info=ex,
+            redis_error=True,
+        )
+        raise ex
+
+
+async def import_world(
+    datastore: DataStore,
+    source: TextIO,
+    workers: int = 4,
+    batch_size: int = 500,
+    checkpoint: Union[str, None] = None,
+) -> int:
+    """
+    Import the records read from the source (as written by export_world)
+    in batches of batch_size records, written by several workers at once.
+    Only a few batches are held in memory at any time.
+
+    If a checkpoint path is given, the number of lines imported so far is
+    recorded there after each batch, and lines already imported are skipped
+    when resuming. Return the number of records imported.
+    """
+    progress = Progress("Import")
+    try:
+        # Registered once and shared by the workers.
+        set_max = await datastore.redis.register_script(SET_MAX)
+    except (Error, ErrorReply) as ex:  # pragma: no cover
+        logger.msg("Error importing world.", exc_info=ex, redis_error=True)
+        raise ex
+    skip = read_checkpoint(checkpoint)
+    if skip:
+        logger.msg("Resume import.", checkpoint=checkpoint, lines=skip)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=workers * 2)
+    # The last line of each batch, in order, and those that are finished.
+    pending: collections.deque = collections.deque()
+    finished = set()
+
+    async def produce() -> None:
+        batch = []
+        line_number = 0
+        for line_number, line in enumerate(source, 1):
+            if line_number <= skip or not line.strip():
+                continue
+            batch.append(json.loads(line))
+            if len(batch) >= batch_size:
+                pending.append(line_number)
+                await queue.put((line_number, batch))
+                batch = []
+        if batch:
+            pending.append(line_number)
+            await queue.put((line_number, batch))
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def work() -> None:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            line_number, batch = item
+            await import_batch(datastore, batch, set_max)
+            progress.add(len(batch))
+            # Advance the checkpoint past every batch that is finished and
+            # only follows finished batches.
+            finished.add(line_number)
+            last = None
+            while pending and pending[0] in finished:
+                last = pending.popleft()
+                finished.remove(last)
+            if last is not None:
+                write_checkpoint(checkpoint, last)
+
+    tasks = [asyncio.create_task(produce())] + [
+        asyncio.create_task(work()) for _ in range(workers)
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    progress.log("finished")
+    return progress.records
+
+
+async def run(args: argparse.Namespace) -> None:  # pragma: no cover
+    """
+    Connect to Redis and run the export or import.
+    """
+    redis = await asyncio_redis.Pool.create(
+        host=os.environ.get("TEXTSMITH_REDIS_HOST", "localhost"),
+        port=int(os.environ.get("TEXTSMITH_REDIS_PORT", 6379)),
+        password=os.environ.get("TEXTSMITH_REDIS_PASSWORD", None),
+        poolsize=args.workers + 1,
+    )
+    datastore = DataStore(redis)
+    try:
+        if args.command == "export":
+            with open(args.path, "w") as output:
+                await export_world(datastore, output, args.batch)
+        else:
+            with open(args.path) as source:
+                await import_world(
+                    datastore,
+                    source,
+                    args.workers,
+                    args.batch,
+                    args.checkpoint,
+                )
+    finally:
+        redis.close()
+
+
+def main(argv: Union[Sequence[str], None] = None) -> None:  # pragma: no cover
+    """
+    Parse the command line arguments and run the export or import.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m textsmith.world",
+        description="Export or import a TextSmith world.",
+    )
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", help="The newline delimited JSON file.")
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=500,
+        help="Number of keys or records handled at once.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of concurrent import workers.",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=None,
+        help="File recording import progress, used to resume an import.",
+    )
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()